@@ -1,9 +1,11 @@
 from django.contrib import admin
 from django.contrib.auth.models import User
 from django.contrib.auth.admin import UserAdmin
+from django.db.models import OuterRef, Subquery
 from django.http import HttpResponseRedirect
 from bridges_api.models import (
-    Question, Tag, UserProfile, Employer, DataFile, Position, Ethnicity, Gender, Disability
+    Question, Tag, UserProfile, Employer, DataFile, IngestionJob, Position, Ethnicity, Gender,
+    Disability
 )
 
 class CustomUserAdmin(UserAdmin):
@@ -32,12 +34,49 @@ class EmployerAdmin(admin.ModelAdmin):
 	list_display = ('name',)
 
 class DataFileAdmin(admin.ModelAdmin):
-    list_display = ('name', )
+    list_display = ('name', 'ingestion_status')
+
+    def get_queryset(self, request):
+        """
+        Annotates the status of each file's latest job, rather than listing
+        the files with a query for each
+        """
+        latest_jobs = IngestionJob.objects.filter(data_file=OuterRef('pk'))
+        return super(DataFileAdmin, self).get_queryset(request).annotate(
+            latest_job_status=Subquery(latest_jobs.values('status')[:1]))
+
+    def ingestion_status(self, obj):
+        return dict(IngestionJob.statuses).get(obj.latest_job_status, '-')
+
+    def save_model(self, request, obj, form, change):
+        super(DataFileAdmin, self).save_model(request, obj, form, change)
+        self.message_user(request, '%s was queued for ingestion as job %d, whose summary '
+                          'will list the values it inserted and updated' % (
+                              obj, obj.ingestion_job.pk))
+
+class IngestionJobAdmin(admin.ModelAdmin):
+    list_display = ('data_file', 'status', 'rows_processed', 'throughput', 'created_at',
+                    'finished_at')
+    list_filter = ('status',)
+    readonly_fields = ('data_file', 'status', 'rows_processed', 'throughput', 'summary',
+                       'error', 'created_at', 'started_at', 'heartbeat_at', 'finished_at')
+
+    def has_add_permission(self, request):
+        return False
 
 class ParticipantAttributeAdmin(admin.ModelAdmin):
-    fields = ('name', 'avg_salary', 'num_participants')
+    fields = ('name', 'avg_salary', 'num_participants', 'min_salary', 'max_salary')
     list_display = ('name', )
 
+    def get_readonly_fields(self, request, obj=None):
+        """
+        A value's stats can be entered when it is added, but after that only
+        come from the data files, which keep its sums in step with them
+        """
+        if obj is None:
+            return ('min_salary', 'max_salary')
+        return ('avg_salary', 'num_participants', 'min_salary', 'max_salary')
+
 class PositionAdmin(ParticipantAttributeAdmin):
     pass
 
@@ -57,6 +96,7 @@ admin.site.register(Question, QuestionAdmin)
 admin.site.register(Tag, TagAdmin)
 admin.site.register(Employer, EmployerAdmin)
 admin.site.register(DataFile, DataFileAdmin)
+admin.site.register(IngestionJob, IngestionJobAdmin)
 admin.site.register(Position, PositionAdmin)
 admin.site.register(Disability, DisabilityAdmin)
 admin.site.register(Ethnicity, EthnicityAdmin)
@@ -0,0 +1,23 @@
+from django.utils.translation import ugettext_lazy as _
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+
+class ProfileTokenAuthentication(TokenAuthentication):
+    """
+    TokenAuthentication that loads the token, its user and the user's
+    profile in one query, so the profile comes along as
+    request.user.userprofile instead of costing a query of its own. Nothing
+    is cached: a token deleted, or a user deactivated or demoted, in any
+    worker is refused on the next request.
+    """
+    def authenticate_credentials(self, key):
+        try:
+            token = Token.objects.select_related('user__userprofile').get(key=key)
+        except Token.DoesNotExist:
+            raise exceptions.AuthenticationFailed(_('Invalid token.'))
+
+        if not token.user.is_active:
+            raise exceptions.AuthenticationFailed(_('User inactive or deleted.'))
+
+        return (token.user, token)
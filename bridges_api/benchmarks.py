@@ -0,0 +1,221 @@
+"""
+Synthetic corpus generation and measurements for the recommender, used by
+the benchmark_recommendations management command
+"""
+import bisect
+import random
+import resource
+import time
+
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+
+from bridges_api.caching import recommendation_cache
+from bridges_api.models import (
+    profile_attribute_rows, ProfileAttribute, Question, Tag, UserProfile
+)
+from bridges_api import recommendations
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+# Number of distinct values of each attribute in the synthetic vocabulary
+vocabulary_sizes = {
+    'gender': 2,
+    'ethnicity': 12,
+    'position': 100,
+    'current_employer': 200,
+    'disabilities': 30,
+}
+
+# How often each attribute shows up among the tags of a question
+tag_attribute_weights = {
+    'gender': 1,
+    'ethnicity': 2,
+    'position': 3,
+    'current_employer': 3,
+    'disabilities': 4,
+}
+
+BULK_BATCH_SIZE = 5000
+
+# Differences smaller than these are run to run noise, whatever the tolerance
+LATENCY_NOISE_MS = 2.0
+MEMORY_NOISE_KB = 1024
+
+class ZipfChoice(object):
+    """
+    Picks items with probability proportional to 1 / rank ** exponent, which
+    is roughly how tags, employers and positions are spread in real data
+    """
+    def __init__(self, items, exponent=1.0):
+        self.items = list(items)
+        self.cumulative = []
+        total = 0.0
+        for rank in range(1, len(self.items) + 1):
+            total += 1.0 / rank ** exponent
+            self.cumulative.append(total)
+
+    def __call__(self, rng):
+        point = rng.random() * self.cumulative[-1]
+        return self.items[bisect.bisect(self.cumulative, point)]
+
+def attribute_value(attribute, index):
+    if attribute == 'gender':
+        return ('male', 'female')[index]
+    return '%s%d' % (attribute.replace('_', ''), index)
+
+class CorpusGenerator(object):
+    """
+    Grows a synthetic corpus of tags, users and tagged questions with bulk
+    inserts, so that no signals fire and each size builds on the last one
+    """
+    def __init__(self, seed=0):
+        self.rng = random.Random(seed)
+        self.values = {attribute: ZipfChoice([attribute_value(attribute, index)
+                                              for index in range(size)])
+                       for attribute, size in vocabulary_sizes.items()}
+        attributes = []
+        for attribute, weight in tag_attribute_weights.items():
+            attributes += [attribute] * weight
+        self.attributes = attributes
+
+    def create_tags(self):
+        tags = [Tag(attribute=attribute, value=attribute_value(attribute, index),
+                    slug=attribute + attribute_value(attribute, index))
+                for attribute, size in vocabulary_sizes.items() for index in range(size)]
+        Tag.objects.bulk_create(tags, batch_size=BULK_BATCH_SIZE)
+        self.tag_ids = dict(((tag.attribute, tag.value), tag.id)
+                            for tag in Tag.objects.all())
+
+    def profile_values(self, attribute, most):
+        chosen = set(self.values[attribute](self.rng)
+                     for _ in range(self.rng.randint(1, most)))
+        return ','.join(sorted(chosen))
+
+    def create_users(self, count):
+        with transaction.atomic():
+            User.objects.bulk_create([User(username='benchmark%d' % index, password='!')
+                                      for index in range(count)], batch_size=BULK_BATCH_SIZE)
+            UserProfile.objects.bulk_create([
+                UserProfile(id=user_id, user_id=user_id,
+                            first_name='Benchmark', last_name='User',
+                            gender=self.values['gender'](self.rng),
+                            ethnicity=self.profile_values('ethnicity', 2),
+                            position=self.profile_values('position', 1),
+                            current_employer=self.profile_values('current_employer', 1),
+                            disabilities=self.profile_values('disabilities', 2))
+                for user_id in User.objects.filter(
+                    username__startswith='benchmark').values_list('id', flat=True)
+            ], batch_size=BULK_BATCH_SIZE)
+            ProfileAttribute.objects.bulk_create(profile_attribute_rows(
+                UserProfile.objects.filter(user__username__startswith='benchmark')
+            ), batch_size=BULK_BATCH_SIZE)
+        return list(UserProfile.objects.all())
+
+    def grow_questions(self, total, owner):
+        """
+        Adds questions, each with one to four tags, until there are total
+        """
+        next_id = (Question.objects.order_by('-id').values_list('id', flat=True).first() or 0) + 1
+        remaining = total - Question.objects.count()
+        Through = Question.tags.through
+        while remaining > 0:
+            count = min(BULK_BATCH_SIZE, remaining)
+            questions, taggings = [], []
+            for question_id in range(next_id, next_id + count):
+                questions.append(Question(id=question_id, owner=owner,
+                                          title='Synthetic question %d' % question_id))
+                tags = set()
+                for _ in range(self.rng.randint(1, 4)):
+                    attribute = self.rng.choice(self.attributes)
+                    tags.add(self.tag_ids[(attribute, self.values[attribute](self.rng))])
+                taggings += [Through(question_id=question_id, tag_id=tag_id) for tag_id in tags]
+            with transaction.atomic():
+                Question.objects.bulk_create(questions)
+                Through.objects.bulk_create(taggings)
+            next_id += count
+            remaining -= count
+
+def summarize(samples):
+    ordered = sorted(samples)
+    return {
+        'mean': round(sum(ordered) / len(ordered), 3),
+        'p50': round(ordered[len(ordered) // 2], 3),
+        'p95': round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 3),
+    }
+
+def measure_peak_memory(function):
+    """
+    Runs function and returns the peak memory it allocated in KB. Without
+    tracemalloc (Python 2) this falls back to how much the process's peak
+    resident set grew, which misses peaks below an earlier high water mark.
+    """
+    if tracemalloc is not None:
+        tracemalloc.start()
+        try:
+            function()
+            return tracemalloc.get_traced_memory()[1] // 1024
+        finally:
+            tracemalloc.stop()
+
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    function()
+    return max(0, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before)
+
+def measure_recommend(profiles):
+    """
+    Times recommend() for each profile, cold (nothing cached, nothing
+    materialized) and then warm, counting the queries of the cold run
+    """
+    cold, warm, queries, memory = [], [], [], []
+    for profile in profiles:
+        recommendation_cache.clear()
+        with CaptureQueriesContext(connection) as captured:
+            started = time.time()
+            recommendations.recommend(profile, Question)
+            cold.append((time.time() - started) * 1000)
+        queries.append(len(captured))
+
+        started = time.time()
+        recommendations.recommend(profile, Question)
+        warm.append((time.time() - started) * 1000)
+
+        recommendation_cache.clear()
+        memory.append(measure_peak_memory(
+            lambda: recommendations.recommend(profile, Question)))
+
+    return {
+        'cold_ms': summarize(cold),
+        'warm_ms': summarize(warm),
+        'queries': max(queries),
+        'peak_memory_kb': max(memory),
+    }
+
+def compare_to_baseline(results, baseline, tolerance=0.2):
+    """
+    Lists every measurement that got worse than the baseline by more than
+    tolerance and by more than the noise floor. Query counts may not grow
+    at all.
+    """
+    regressions = []
+    for size, measured in sorted(results.items()):
+        expected = baseline.get(size)
+        if expected is None:
+            continue
+        for metric in ('cold_ms', 'warm_ms'):
+            if (measured[metric]['p50'] > expected[metric]['p50'] * (1 + tolerance) and
+                    measured[metric]['p50'] - expected[metric]['p50'] > LATENCY_NOISE_MS):
+                regressions.append('%s questions: %s p50 went from %sms to %sms' % (
+                    size, metric, expected[metric]['p50'], measured[metric]['p50']))
+        if measured['queries'] > expected['queries']:
+            regressions.append('%s questions: queries went from %s to %s' % (
+                size, expected['queries'], measured['queries']))
+        if (measured['peak_memory_kb'] > expected['peak_memory_kb'] * (1 + tolerance) and
+                measured['peak_memory_kb'] - expected['peak_memory_kb'] > MEMORY_NOISE_KB):
+            regressions.append('%s questions: peak memory went from %sKB to %sKB' % (
+                size, expected['peak_memory_kb'], measured['peak_memory_kb']))
+    return regressions
@@ -0,0 +1,132 @@
+import threading
+from collections import OrderedDict
+
+from django.apps import apps
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import six
+
+class LRUCache(object):
+    """
+    A bounded, thread safe, in-process mapping that evicts the least
+    recently used entry once max_size is reached. Keeps hit/miss counters
+    so we can tell whether it is earning its keep.
+    """
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._entries[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def discard(self, predicate):
+        """
+        Drops every entry whose key satisfies predicate
+        """
+        with self._lock:
+            for key in [key for key in self._entries if predicate(key)]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+class RecommendationCache(LRUCache):
+    """
+    Caches the ranked question ids recommended to each profile. Entries are
+    keyed by (profile id, corpus version): editing a profile drops that
+    profile's entries, and any change to questions or tags bumps the corpus
+    version once it commits. The version is one of the shared model_versions,
+    so the bump makes the older entries of every worker unreachable.
+    """
+    corpus_label = 'recommendations.corpus'
+
+    def key(self, profile_id):
+        return (profile_id, model_versions.get(self.corpus_label))
+
+    def invalidate_profile(self, profile_id):
+        self.discard(lambda key: key[0] == profile_id)
+
+    def bump_corpus_version(self):
+        model_versions.bump(self.corpus_label)
+        # Unreachable entries would only wait to be evicted
+        transaction.on_commit(self.clear)
+
+recommendation_cache = RecommendationCache(
+    getattr(settings, 'RECOMMENDATION_CACHE_SIZE', 1024))
+
+class ModelVersions(object):
+    """
+    A change counter per model, kept in the ModelVersion table so that every
+    worker agrees on it and concurrent bumps add up. A bump waits for the
+    transaction that made the change to commit, so no request can pair the
+    new version with the old rows.
+    """
+    @property
+    def rows(self):
+        return apps.get_model('bridges_api', 'ModelVersion').objects
+
+    def key(self, model):
+        """
+        A model's label, or the label of a counter that isn't a model's
+        """
+        if isinstance(model, six.string_types):
+            return model
+        return model._meta.label_lower
+
+    def get_many(self, models):
+        """
+        The versions of models, in one query
+        """
+        keys = [self.key(model) for model in models]
+        versions = dict(self.rows.filter(label__in=keys).values_list('label', 'version'))
+        return [versions.get(key, 0) for key in keys]
+
+    def get(self, model):
+        return self.get_many([model])[0]
+
+    def bump(self, model):
+        key = self.key(model)
+        transaction.on_commit(lambda: self.increment(key))
+
+    def increment(self, key):
+        if self.rows.filter(label=key).update(version=F('version') + 1):
+            return
+        try:
+            with transaction.atomic():
+                self.rows.create(label=key, version=1)
+        except IntegrityError:
+            # Another worker created it first
+            self.rows.filter(label=key).update(version=F('version') + 1)
+
+model_versions = ModelVersions()
@@ -0,0 +1,157 @@
+"""
+Write-behind counting of question views. Views are added up in process
+memory and written out in batches of F() updates, so a popular question
+costs one UPDATE per flush instead of one per request.
+"""
+import atexit
+import logging
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F
+
+from bridges_api.models import Question, QuestionActivity
+
+logger = logging.getLogger(__name__)
+
+class ViewCounter(object):
+    """
+    Buffers view increments per question and flushes them once flush_size
+    views are pending or flush_interval seconds have passed since the last
+    flush, and once more when the process exits. Counts read from the
+    database lag behind by whatever is still pending.
+
+    Like the recommendation cache, every worker process keeps its own
+    buffer; the F() updates make flushes from several workers add up.
+    """
+    def __init__(self, flush_size=100, flush_interval=30):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.pending = defaultdict(int)
+        self.pending_views = 0
+        self.flushes = 0
+        self.flushed_views = 0
+        self.last_flush = time.time()
+        self.last_flush_seconds = None
+        self.total_flush_seconds = 0.0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def increment(self, question_id, views=1):
+        with self._lock:
+            self.pending[question_id] += views
+            self.pending_views += views
+            due = (self.pending_views >= self.flush_size or
+                   time.time() - self.last_flush >= self.flush_interval)
+        if due:
+            # Counting is best effort: a failed flush keeps the views for the
+            # next one instead of failing the request that was counted
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Flushing question views failed')
+
+    def flush(self):
+        """
+        Writes every pending increment, one UPDATE per distinct increment
+        rather than one per question. Returns the number of views written.
+        """
+        with self._flush_lock:
+            with self._lock:
+                pending, self.pending = self.pending, defaultdict(int)
+                self.pending_views = 0
+                self.last_flush = time.time()
+            if not pending:
+                return 0
+
+            by_increment = defaultdict(list)
+            for question_id, views in pending.items():
+                by_increment[views].append(question_id)
+
+            started = time.time()
+            try:
+                with transaction.atomic():
+                    for views, question_ids in by_increment.items():
+                        Question.objects.filter(pk__in=question_ids).update(
+                            number_of_views=F('number_of_views') + views)
+                    # Also leave the views of the questions that still exist
+                    # for the trending refresh to pick up
+                    existing_ids = Question.objects.filter(
+                        pk__in=list(pending)).values_list('pk', flat=True)
+                    QuestionActivity.objects.bulk_create([
+                        QuestionActivity(question_id=question_id, views=pending[question_id])
+                        for question_id in existing_ids])
+            except Exception:
+                # Put the views back so the next flush retries them
+                with self._lock:
+                    for question_id, views in pending.items():
+                        self.pending[question_id] += views
+                        self.pending_views += views
+                raise
+
+            elapsed = time.time() - started
+            flushed = sum(pending.values())
+            with self._lock:
+                self.flushes += 1
+                self.flushed_views += flushed
+                self.last_flush_seconds = elapsed
+                self.total_flush_seconds += elapsed
+            return flushed
+
+    def clear(self):
+        with self._lock:
+            self.pending = defaultdict(int)
+            self.pending_views = 0
+
+    def start(self):
+        """
+        Flushes every flush_interval seconds from one daemon thread, so that
+        views on an idle worker are not held back until the next request
+        """
+        def run():
+            try:
+                while not self._stopped.wait(self.flush_interval):
+                    try:
+                        self.flush()
+                    except Exception:
+                        logger.exception('Flushing question views failed')
+            finally:
+                connection.close()
+
+        self._stopped.clear()
+        self._thread = threading.Thread(target=run, name='view-counter')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def stats(self):
+        with self._lock:
+            return {
+                'pending_questions': len(self.pending),
+                'pending_views': self.pending_views,
+                'flushes': self.flushes,
+                'flushed_views': self.flushed_views,
+                'last_flush_seconds': self.last_flush_seconds,
+                'mean_flush_seconds': (self.total_flush_seconds / self.flushes
+                                       if self.flushes else None),
+            }
+
+view_counter = ViewCounter(getattr(settings, 'VIEW_COUNT_FLUSH_SIZE', 100),
+                           getattr(settings, 'VIEW_COUNT_FLUSH_INTERVAL', 30))
+
+@atexit.register
+def flush_on_exit():
+    try:
+        view_counter.flush()
+    except Exception:
+        logger.exception('Flushing question views on exit failed')
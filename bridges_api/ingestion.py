@@ -0,0 +1,174 @@
+"""
+Background ingestion of uploaded data files. Saving a DataFile only stores
+it and queues an IngestionJob, so the admin request returns as soon as the
+upload is on disk; the run_ingestion command then converts, parses and
+folds in the queued files across a pool of worker processes, recording
+their progress on the job rows as it goes.
+
+Only one job per data file runs at a time, and a queued job is superseded
+by any newer one for the same file. Running jobs keep a heartbeat, and any
+whose heartbeat stops for STALE_AFTER seconds (the worker was killed or
+the host restarted) are queued again by the next run_pending.
+"""
+import json
+import logging
+import multiprocessing
+import threading
+import time
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, connections, transaction
+from django.utils import timezone
+
+from bridges_api import parser
+from bridges_api.models import DataFile, IngestionJob
+
+logger = logging.getLogger(__name__)
+
+PROCESSES = getattr(settings, 'INGESTION_PROCESSES', None)
+POLL_INTERVAL = getattr(settings, 'INGESTION_POLL_INTERVAL', 5)
+STALE_AFTER = getattr(settings, 'INGESTION_STALE_AFTER', 600)
+HEARTBEAT_INTERVAL = getattr(settings, 'INGESTION_HEARTBEAT_INTERVAL', STALE_AFTER / 4.0)
+
+class Heartbeat(threading.Thread):
+    """
+    Touches a running job's heartbeat_at every interval seconds until
+    stopped, independently of how often the ingestion reports progress
+    """
+    def __init__(self, job_id, interval=HEARTBEAT_INTERVAL):
+        super(Heartbeat, self).__init__()
+        self.daemon = True
+        self.job_id = job_id
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        try:
+            while not self.stopped.wait(self.interval):
+                IngestionJob.objects.filter(pk=self.job_id, status=IngestionJob.RUNNING).update(
+                    heartbeat_at=timezone.now())
+        finally:
+            # Django opened a connection just for this thread
+            connection.close()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+def requeue_stale_jobs(stale_after=STALE_AFTER):
+    """
+    Queues again every running job whose heartbeat is more than stale_after
+    seconds old, returning how many there were. Their ingestion rolled back
+    with the dead worker, so they can safely be run from the start.
+    """
+    cutoff = timezone.now() - timedelta(seconds=stale_after)
+    return IngestionJob.objects.filter(status=IngestionJob.RUNNING, heartbeat_at__lt=cutoff).update(
+        status=IngestionJob.QUEUED, rows_processed=0, started_at=None, heartbeat_at=None)
+
+def claim_job(job_id):
+    """
+    Marks a queued job as running, returning False if another worker got
+    to it first, its data file has a job running already, or it has been
+    superseded by a newer job for the same file
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        # Claiming before reading anything takes the job's write lock first
+        jobs = IngestionJob.objects.filter(pk=job_id)
+        if not jobs.filter(status=IngestionJob.QUEUED).update(
+                status=IngestionJob.RUNNING, started_at=now, heartbeat_at=now):
+            return False
+        data_file_id = jobs.values_list('data_file_id', flat=True).get()
+        # Serializes the claims of every job for this data file
+        list(DataFile.objects.select_for_update().filter(pk=data_file_id))
+        others = IngestionJob.objects.filter(data_file_id=data_file_id).exclude(pk=job_id)
+        # A newer job ingests the file again whatever state it is in
+        if others.filter(pk__gt=job_id).exists():
+            jobs.update(status=IngestionJob.SUPERSEDED, started_at=None, heartbeat_at=None,
+                        finished_at=now)
+            return False
+        if others.filter(status=IngestionJob.RUNNING).exists():
+            # Left queued for a later run_pending
+            jobs.update(status=IngestionJob.QUEUED, started_at=None, heartbeat_at=None)
+            return False
+    return True
+
+def process_job(job_id):
+    """
+    Runs a queued job and returns its final status, or None if it was not
+    claimed. Failures are recorded on the job, not raised.
+    """
+    if not claim_job(job_id):
+        return None
+    jobs = IngestionJob.objects.filter(pk=job_id)
+    heartbeat = Heartbeat(job_id)
+    heartbeat.start()
+
+    def progress(rows):
+        # Parsing comes before the transaction that folds the stats in, so
+        # this is visible to the admin as it happens
+        jobs.update(rows_processed=rows)
+
+    try:
+        summary = jobs.select_related('data_file').get().data_file.ingest(progress)
+    except Exception:
+        logger.exception('Ingestion job %s failed', job_id)
+        jobs.update(status=IngestionJob.FAILED, error=traceback.format_exc(),
+                    finished_at=timezone.now())
+        return IngestionJob.FAILED
+    finally:
+        heartbeat.stop()
+    jobs.update(status=IngestionJob.DONE, summary=json.dumps(dict(summary), sort_keys=True),
+                finished_at=timezone.now())
+    return IngestionJob.DONE
+
+def is_large(data_file):
+    """
+    Whether the file is big enough for its parsing to be split into shards
+    across processes
+    """
+    try:
+        return data_file.data_file.size >= parser.SERIAL_BELOW_BYTES
+    except (IOError, OSError):
+        # Left to the job to fail on
+        return False
+
+def run_pending(processes=PROCESSES):
+    """
+    Runs every queued job, oldest first, after queueing again any stale
+    ones. Small files are ingested in a process pool unless processes is 1
+    or there is only one job; large ones in this process meanwhile, since
+    only a process outside a pool can shard their parsing. Returns how many
+    jobs this call ran.
+    """
+    requeue_stale_jobs()
+    jobs = list(IngestionJob.objects.filter(status=IngestionJob.QUEUED)
+                .select_related('data_file').order_by('id'))
+    if len(jobs) <= 1 or processes == 1:
+        statuses = [process_job(job.pk) for job in jobs]
+        return len([job_status for job_status in statuses if job_status])
+
+    large_ids = [job.pk for job in jobs if is_large(job.data_file)]
+    small_ids = [job.pk for job in jobs if job.pk not in large_ids]
+    # The forked workers must open connections of their own
+    connections.close_all()
+    pool = multiprocessing.Pool(processes)
+    try:
+        small_statuses = pool.map_async(process_job, small_ids)
+        statuses = [process_job(job_id) for job_id in large_ids]
+        statuses += small_statuses.get()
+    finally:
+        pool.close()
+        pool.join()
+    return len([job_status for job_status in statuses if job_status])
+
+def run_worker(processes=PROCESSES, poll_interval=POLL_INTERVAL):
+    """
+    Runs queued jobs as they come in, checking every poll_interval seconds
+    when there are none
+    """
+    while True:
+        if not run_pending(processes):
+            time.sleep(poll_interval)
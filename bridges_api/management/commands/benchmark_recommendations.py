@@ -0,0 +1,68 @@
+import json
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import setup_databases, teardown_databases
+
+from bridges_api import benchmarks
+
+class Command(BaseCommand):
+    help = ('Measures recommend() latency, query count and peak memory against '
+            'synthetic corpora of growing size, in a throwaway test database')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='1000,10000,100000,1000000',
+                            help='Comma separated numbers of questions to measure at')
+        parser.add_argument('--users', type=int, default=100)
+        parser.add_argument('--samples', type=int, default=20,
+                            help='Number of profiles to time recommend() for at each size')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', default='recommendation_benchmarks.json')
+        parser.add_argument('--baseline', default='recommendation_baseline.json',
+                            help='Results to compare against, if the file exists')
+        parser.add_argument('--save-baseline', action='store_true', dest='save_baseline',
+                            help='Store these results as the new baseline')
+        parser.add_argument('--tolerance', type=float, default=0.2,
+                            help='Allowed relative slowdown before failing')
+
+    def handle(self, *args, **options):
+        sizes = sorted(int(size) for size in options['sizes'].split(','))
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            results = self.run_benchmarks(sizes, options)
+        finally:
+            teardown_databases(old_config, verbosity=0)
+
+        self.write_json(options['output'], results)
+        self.stdout.write('Results written to %s' % options['output'])
+
+        if options['save_baseline']:
+            self.write_json(options['baseline'], results)
+            self.stdout.write('Baseline written to %s' % options['baseline'])
+        elif os.path.exists(options['baseline']):
+            with open(options['baseline']) as baseline_file:
+                baseline = json.load(baseline_file)
+            regressions = benchmarks.compare_to_baseline(results, baseline,
+                                                         options['tolerance'])
+            if regressions:
+                raise CommandError('Regressions against %s:\n%s' % (
+                    options['baseline'], '\n'.join(regressions)))
+            self.stdout.write('No regressions against %s' % options['baseline'])
+
+    def run_benchmarks(self, sizes, options):
+        generator = benchmarks.CorpusGenerator(options['seed'])
+        generator.create_tags()
+        profiles = generator.create_users(options['users'])
+        sampled = profiles[:options['samples']]
+
+        results = {}
+        for size in sizes:
+            generator.grow_questions(size, profiles[0])
+            results[str(size)] = benchmarks.measure_recommend(sampled)
+            self.stdout.write('%d questions: %s' % (size, json.dumps(results[str(size)],
+                                                                      sort_keys=True)))
+        return results
+
+    def write_json(self, path, results):
+        with open(path, 'w') as results_file:
+            json.dump(results, results_file, indent=2, sort_keys=True)
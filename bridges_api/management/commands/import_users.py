@@ -0,0 +1,29 @@
+import multiprocessing
+
+from django.core.management.base import BaseCommand, CommandError
+
+from bridges_api import user_import
+
+class Command(BaseCommand):
+    help = ('Creates a user, profile and token for every row of a CSV or JSON file, '
+            'or for none of them if any row is invalid')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=('csv', 'json'),
+                            help='Defaults to the extension of the file')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        format = options['format'] or path.rsplit('.', 1)[-1].lower()
+        try:
+            with open(path, 'rb') as stream:
+                created = user_import.import_users(user_import.read_rows(stream, format),
+                                                   multiprocessing.Pool,
+                                                   user_import.HASH_PROCESSES)
+        except user_import.UserImportError as error:
+            raise CommandError('\n'.join('row %s: %s' % (number, errors) for number, errors
+                                         in sorted(error.errors.items())))
+        for user in created:
+            self.stdout.write('%(username)s\t%(user_id)s\t%(token)s' % user)
+        self.stdout.write('Imported %d users' % len(created))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from bridges_api.models import Question, UserProfile
+from bridges_api import recommendations
+
+class Command(BaseCommand):
+    help = 'Fills the RecommendedQuestion table for every profile'
+
+    def handle(self, *args, **options):
+        profiles = list(UserProfile.objects.all())
+        matrix = recommendations.TagMatrix(Question)
+        recommendations.refresh_recommended_questions(profiles, Question, matrix)
+        self.stdout.write('Materialized recommendations for %d profiles' % len(profiles))
@@ -0,0 +1,35 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from bridges_api.models import Question, UserProfile
+from bridges_api import recommendations
+
+class Command(BaseCommand):
+    help = 'Prints recommended question ids for a list of users, or for every user'
+
+    def add_arguments(self, parser):
+        parser.add_argument('usernames', nargs='*')
+        parser.add_argument('--all', action='store_true', dest='all',
+                            help='Recommend questions to every user')
+        parser.add_argument('--limit', type=int,
+                            default=recommendations.RECOMMENDATION_LIMIT,
+                            help='Number of questions to recommend to each user')
+
+    def handle(self, *args, **options):
+        usernames = options['usernames']
+        if not usernames and not options['all']:
+            raise CommandError('Give some usernames or pass --all')
+
+        profiles = UserProfile.objects.select_related('user')
+        if not options['all']:
+            profiles = profiles.filter(user__username__in=usernames)
+            missing = set(usernames) - set(profile.user.username for profile in profiles)
+            if missing:
+                raise CommandError('No profile for: %s' % ', '.join(sorted(missing)))
+
+        profiles = list(profiles)
+        recommended = recommendations.batch_recommend(profiles, Question, options['limit'])
+        self.stdout.write(json.dumps({
+            profile.user.username: recommended[profile.pk] for profile in profiles
+        }, indent=2, sort_keys=True))
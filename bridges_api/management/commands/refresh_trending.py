@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from bridges_api import trending
+
+class Command(BaseCommand):
+    help = ('Folds the views and bookmarks recorded since the last run into the '
+            'trending question scores. Run it every few minutes from cron.')
+
+    def handle(self, *args, **options):
+        updated = trending.refresh_trending()
+        self.stdout.write('Updated the trending scores of %d questions' % updated)
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from bridges_api import ingestion
+
+class Command(BaseCommand):
+    help = ('Converts and folds in the data files uploaded through the admin, '
+            'across a pool of processes. Keeps polling for new uploads unless --once.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=ingestion.PROCESSES,
+                            help='Defaults to the number of CPUs')
+        parser.add_argument('--poll-interval', type=float, default=ingestion.POLL_INTERVAL,
+                            help='Seconds to wait between checks for new uploads')
+        parser.add_argument('--once', action='store_true',
+                            help='Run the queued jobs and exit')
+
+    def handle(self, *args, **options):
+        if options['once']:
+            ran = ingestion.run_pending(options['processes'])
+            self.stdout.write('Ran %d ingestion jobs' % ran)
+        else:
+            ingestion.run_worker(options['processes'], options['poll_interval'])
@@ -0,0 +1,117 @@
+"""
+Per-request SQL instrumentation that works with DEBUG off. Django's own
+debug cursor wrapper is switched on for the request with
+force_debug_cursor, which is what DEBUG would do, and its log is read back
+when the response goes out.
+"""
+import json
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger('bridges_api.sql')
+
+SEND_HEADERS = getattr(settings, 'SQL_INSTRUMENTATION_HEADERS', False)
+SLOW_REQUEST_MS = getattr(settings, 'SLOW_REQUEST_MS', 500)
+SLOWEST_STATEMENTS = getattr(settings, 'SQL_SLOWEST_STATEMENTS', 3)
+STATEMENT_LENGTH = 500
+
+class RouteStats(object):
+    """
+    Request, query and time totals per route, for this process
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.routes = {}
+
+    def record(self, route, queries, sql_ms, duration_ms):
+        with self._lock:
+            stats = self.routes.setdefault(route, {
+                'requests': 0, 'queries': 0, 'max_queries': 0,
+                'sql_ms': 0.0, 'duration_ms': 0.0, 'max_duration_ms': 0.0,
+            })
+            stats['requests'] += 1
+            stats['queries'] += queries
+            stats['max_queries'] = max(stats['max_queries'], queries)
+            stats['sql_ms'] += sql_ms
+            stats['duration_ms'] += duration_ms
+            stats['max_duration_ms'] = max(stats['max_duration_ms'], duration_ms)
+
+    def stats(self):
+        with self._lock:
+            return dict((route, dict(stats,
+                                     mean_queries=float(stats['queries']) / stats['requests'],
+                                     mean_sql_ms=stats['sql_ms'] / stats['requests'],
+                                     mean_duration_ms=stats['duration_ms'] / stats['requests']))
+                        for route, stats in self.routes.items())
+
+route_stats = RouteStats()
+
+def request_route(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return request.path
+    return match.view_name
+
+class QueryInstrumentationMiddleware(object):
+    """
+    Counts and times the SQL each request runs. Totals are kept per route
+    in route_stats, requests slower than SLOW_REQUEST_MS are logged with
+    their slowest statements, and SQL_INSTRUMENTATION_HEADERS adds the
+    counts to every response.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        started = time.time()
+        states = []
+        for connection in connections.all():
+            forced = connection.force_debug_cursor
+            if not forced:
+                # Nobody else is reading the log, so start it afresh
+                connection.queries_log.clear()
+            states.append((connection, forced, len(connection.queries_log)))
+            connection.force_debug_cursor = True
+
+        try:
+            response = self.get_response(request)
+        finally:
+            queries = []
+            for connection, forced, start in states:
+                queries += list(connection.queries_log)[start:]
+                connection.force_debug_cursor = forced
+                if not forced:
+                    connection.queries_log.clear()
+
+        duration_ms = (time.time() - started) * 1000
+        sql_ms = sum(float(query['time']) for query in queries) * 1000
+        route = request_route(request)
+        route_stats.record(route, len(queries), sql_ms, duration_ms)
+
+        if SEND_HEADERS:
+            response['X-SQL-Queries'] = str(len(queries))
+            response['X-SQL-Time-Ms'] = '%.1f' % sql_ms
+
+        if duration_ms >= SLOW_REQUEST_MS:
+            slowest = sorted(queries, key=lambda query: float(query['time']),
+                             reverse=True)[:SLOWEST_STATEMENTS]
+            logger.warning('slow request %s', json.dumps({
+                'route': route,
+                'method': request.method,
+                'path': request.path,
+                'status': response.status_code,
+                'duration_ms': round(duration_ms, 1),
+                'queries': len(queries),
+                'sql_ms': round(sql_ms, 1),
+                'slowest': [{'sql': query['sql'][:STATEMENT_LENGTH],
+                             'ms': round(float(query['time']) * 1000, 1)}
+                            for query in slowest],
+            }, sort_keys=True))
+        return response
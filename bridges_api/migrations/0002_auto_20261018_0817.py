@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 08:17
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bridges_api', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DataFile',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('data_file', models.FileField(upload_to='data/')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Disability',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100)),
+                ('slug', models.CharField(max_length=100, unique=True)),
+                ('avg_salary', models.DecimalField(decimal_places=4, max_digits=7)),
+                ('num_participants', models.IntegerField()),
+            ],
+            options={
+                'verbose_name_plural': 'Disabilities',
+            },
+        ),
+        migrations.CreateModel(
+            name='Ethnicity',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100)),
+                ('slug', models.CharField(max_length=100, unique=True)),
+                ('avg_salary', models.DecimalField(decimal_places=4, max_digits=7)),
+                ('num_participants', models.IntegerField()),
+            ],
+            options={
+                'verbose_name': 'Ethnicity',
+                'verbose_name_plural': 'Ethnicities',
+            },
+        ),
+        migrations.CreateModel(
+            name='Gender',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100)),
+                ('slug', models.CharField(max_length=100, unique=True)),
+                ('avg_salary', models.DecimalField(decimal_places=4, max_digits=7)),
+                ('num_participants', models.IntegerField()),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='Position',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100)),
+                ('slug', models.CharField(max_length=100, unique=True)),
+                ('avg_salary', models.DecimalField(decimal_places=4, max_digits=7)),
+                ('num_participants', models.IntegerField()),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='RecommendedQuestion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('score', models.IntegerField()),
+                ('rank', models.PositiveIntegerField()),
+            ],
+            options={
+                'ordering': ('profile', 'rank'),
+            },
+        ),
+        migrations.AlterField(
+            model_name='question',
+            name='owner',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='userprofile', to='bridges_api.UserProfile'),
+        ),
+        migrations.AlterField(
+            model_name='tag',
+            name='attribute',
+            field=models.CharField(choices=[('gender', 'Gender'), ('ethnicity', 'Ethnicity'), ('position', 'Position'), ('current_employer', 'Current Employer'), ('disabilities', 'Disabilities')], max_length=100),
+        ),
+        migrations.AlterField(
+            model_name='userprofile',
+            name='bookmarks',
+            field=models.ManyToManyField(blank=True, to='bridges_api.Question'),
+        ),
+        migrations.AddField(
+            model_name='recommendedquestion',
+            name='profile',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='recommended_questions', to='bridges_api.UserProfile'),
+        ),
+        migrations.AddField(
+            model_name='recommendedquestion',
+            name='question',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='bridges_api.Question'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='recommendedquestion',
+            unique_together=set([('profile', 'rank')]),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+from bridges_api import search
+
+def create_search_index(apps, schema_editor):
+    backend = search.get_backend(schema_editor.connection)
+    if backend:
+        with schema_editor.connection.cursor() as cursor:
+            backend.create(cursor)
+
+def drop_search_index(apps, schema_editor):
+    backend = search.get_backend(schema_editor.connection)
+    if backend:
+        with schema_editor.connection.cursor() as cursor:
+            backend.drop(cursor)
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bridges_api', '0002_auto_20261018_0817'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
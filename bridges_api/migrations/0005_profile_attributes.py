@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 08:36
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bridges_api', '0004_trending'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProfileAttribute',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('attribute', models.CharField(choices=[('gender', 'Gender'), ('ethnicity', 'Ethnicity'), ('position', 'Position'), ('current_employer', 'Current Employer'), ('disabilities', 'Disabilities')], max_length=100)),
+                ('value', models.CharField(max_length=255)),
+                ('profile', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='attribute_values', to='bridges_api.UserProfile')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='profileattribute',
+            unique_together=set([('profile', 'attribute', 'value')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='profileattribute',
+            index_together=set([('attribute', 'value')]),
+        ),
+    ]
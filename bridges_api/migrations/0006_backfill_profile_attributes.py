@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+ATTRIBUTES = ('gender', 'ethnicity', 'position', 'current_employer', 'disabilities')
+BATCH_SIZE = 1000
+
+def backfill_profile_attributes(apps, schema_editor):
+    UserProfile = apps.get_model('bridges_api', 'UserProfile')
+    ProfileAttribute = apps.get_model('bridges_api', 'ProfileAttribute')
+    rows = []
+    for profile in UserProfile.objects.values('pk', *ATTRIBUTES).iterator():
+        for attribute in ATTRIBUTES:
+            for value in set((profile[attribute] or '').split(',')):
+                if value:
+                    rows.append(ProfileAttribute(profile_id=profile['pk'],
+                                                 attribute=attribute, value=value))
+        if len(rows) >= BATCH_SIZE:
+            ProfileAttribute.objects.bulk_create(rows)
+            rows = []
+    ProfileAttribute.objects.bulk_create(rows)
+
+def clear_profile_attributes(apps, schema_editor):
+    apps.get_model('bridges_api', 'ProfileAttribute').objects.all().delete()
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bridges_api', '0005_profile_attributes'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_profile_attributes, clear_profile_attributes),
+    ]
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 08:45
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+DEMOGRAPHIC_MODELS = (('position', 'Position'), ('ethnicity', 'Ethnicity'),
+                      ('gender', 'Gender'), (None, 'Disability'))
+# The old parser counted every participant once per demographic key
+LEGACY_ROW_REPEATS = 4
+
+def backfill_salary_statistics(apps, schema_editor):
+    """
+    Only the averages were stored, so every participant of a value is taken
+    to have earned its average. Counts that the old parser multiplied by
+    LEGACY_ROW_REPEATS are divided back down; those that aren't a multiple
+    of it were entered by hand and are kept. The stats of positions,
+    ethnicities and genders are also kept as contributions without a data
+    file, for deleting files later to subtract from.
+    """
+    DemographicContribution = apps.get_model('bridges_api', 'DemographicContribution')
+    for data_type, model_name in DEMOGRAPHIC_MODELS:
+        ModelClass = apps.get_model('bridges_api', model_name)
+        contributions = []
+        for row in ModelClass.objects.all():
+            if row.num_participants % LEGACY_ROW_REPEATS == 0:
+                row.num_participants //= LEGACY_ROW_REPEATS
+            row.salary_sum = row.avg_salary * row.num_participants
+            row.salary_sum_squares = row.avg_salary * row.salary_sum
+            row.min_salary = row.max_salary = row.avg_salary
+            row.save(update_fields=['num_participants', 'salary_sum', 'salary_sum_squares',
+                                    'min_salary', 'max_salary'])
+            if data_type:
+                contributions.append(DemographicContribution(
+                    data_type=data_type, slug=row.slug, num_participants=row.num_participants,
+                    salary_sum=row.salary_sum, salary_sum_squares=row.salary_sum_squares,
+                    min_salary=row.min_salary, max_salary=row.max_salary))
+        DemographicContribution.objects.bulk_create(contributions, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bridges_api', '0006_backfill_profile_attributes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DemographicContribution',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('data_type', models.CharField(choices=[('position', 'position'), ('ethnicity', 'ethnicity'), ('gender', 'gender')], max_length=20)),
+                ('slug', models.CharField(max_length=100)),
+                ('num_participants', models.IntegerField()),
+                ('salary_sum', models.DecimalField(decimal_places=4, max_digits=20)),
+                ('salary_sum_squares', models.DecimalField(decimal_places=4, max_digits=24)),
+                ('min_salary', models.DecimalField(decimal_places=4, max_digits=7, null=True)),
+                ('max_salary', models.DecimalField(decimal_places=4, max_digits=7, null=True)),
+                ('data_file', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='contributions', to='bridges_api.DataFile')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='disability',
+            name='max_salary',
+            field=models.DecimalField(blank=True, decimal_places=4, max_digits=7, null=True),
+        ),
+        migrations.AddField(
+            model_name='disability',
+            name='min_salary',
+            field=models.DecimalField(blank=True, decimal_places=4, max_digits=7, null=True),
+        ),
+        migrations.AddField(
+            model_name='disability',
+            name='salary_sum',
+            field=models.DecimalField(decimal_places=4, default=0, max_digits=20),
+        ),
+        migrations.AddField(
+            model_name='disability',
+            name='salary_sum_squares',
+            field=models.DecimalField(decimal_places=4, default=0, max_digits=24),
+        ),
+        migrations.AddField(
+            model_name='ethnicity',
+            name='max_salary',
+            field=models.DecimalField(blank=True, decimal_places=4, max_digits=7, null=True),
+        ),
+        migrations.AddField(
+            model_name='ethnicity',
+            name='min_salary',
+            field=models.DecimalField(blank=True, decimal_places=4, max_digits=7, null=True),
+        ),
+        migrations.AddField(
+            model_name='ethnicity',
+            name='salary_sum',
+            field=models.DecimalField(decimal_places=4, default=0, max_digits=20),
+        ),
+        migrations.AddField(
+            model_name='ethnicity',
+            name='salary_sum_squares',
+            field=models.DecimalField(decimal_places=4, default=0, max_digits=24),
+        ),
+        migrations.AddField(
+            model_name='gender',
+            name='max_salary',
+            field=models.DecimalField(blank=True, decimal_places=4, max_digits=7, null=True),
+        ),
+        migrations.AddField(
+            model_name='gender',
+            name='min_salary',
+            field=models.DecimalField(blank=True, decimal_places=4, max_digits=7, null=True),
+        ),
+        migrations.AddField(
+            model_name='gender',
+            name='salary_sum',
+            field=models.DecimalField(decimal_places=4, default=0, max_digits=20),
+        ),
+        migrations.AddField(
+            model_name='gender',
+            name='salary_sum_squares',
+            field=models.DecimalField(decimal_places=4, default=0, max_digits=24),
+        ),
+        migrations.AddField(
+            model_name='position',
+            name='max_salary',
+            field=models.DecimalField(blank=True, decimal_places=4, max_digits=7, null=True),
+        ),
+        migrations.AddField(
+            model_name='position',
+            name='min_salary',
+            field=models.DecimalField(blank=True, decimal_places=4, max_digits=7, null=True),
+        ),
+        migrations.AddField(
+            model_name='position',
+            name='salary_sum',
+            field=models.DecimalField(decimal_places=4, default=0, max_digits=20),
+        ),
+        migrations.AddField(
+            model_name='position',
+            name='salary_sum_squares',
+            field=models.DecimalField(decimal_places=4, default=0, max_digits=24),
+        ),
+        migrations.AlterUniqueTogether(
+            name='demographiccontribution',
+            unique_together=set([('data_file', 'data_type', 'slug')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='demographiccontribution',
+            index_together=set([('data_type', 'slug')]),
+        ),
+        migrations.RunPython(backfill_salary_statistics, migrations.RunPython.noop),
+    ]
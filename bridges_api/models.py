@@ -1,47 +1,160 @@
 from __future__ import unicode_literals
 
+import os
+from decimal import Decimal
+
 from django.db import models
+from django.db.backends.utils import format_number
 from django.contrib.auth.models import User
-from django.db.models.signals import post_save
-from django.db import transaction, IntegrityError
+from django.db.models.signals import (
+    post_save, post_delete, pre_save, pre_delete, m2m_changed
+)
+from django.db import transaction
 from django.dispatch import receiver
 from django.conf import settings
 from rest_framework.authtoken.models import Token
+from django.utils import timezone
 from django.utils.text import slugify
 from django.core.exceptions import ValidationError
+from django.core.files.base import ContentFile
 
 import parser
+from bridges_api.caching import model_versions, recommendation_cache
+from bridges_api import search
 
 gender_options = (('male', 'Male'), ('female', 'Female'))
 profile_attributes = (
     ('gender', 'Gender'), ('ethnicity', 'Ethnicity'), ('position', 'Position'),
     ('current_employer', 'Current Employer'), ('disabilities', 'Disabilities'))
 
-class DataFile(models.Model):
-    data_file = models.FileField(upload_to='data/')
+UPSERT_BATCH_SIZE = 200
+# Clears every materialized rank when ranks are moved down in place
+RANK_SHIFT = 1000000
 
-    def _batch_prepare(self, ModelClass, data_type, data, averages, counts):
-        make_model_obj = lambda x: ModelClass(name=x,
-                                              num_participants=counts[data_type][x],
-                                              avg_salary=averages[data_type][x])
+def decimal_value(field, value):
+    """
+    value as the DecimalField field would store it
+    """
+    return Decimal(format_number(field.to_python(value), field.max_digits,
+                                 field.decimal_places))
 
-        return map(lambda x: make_model_obj(x), data[data_type])
+def bulk_update(ModelClass, rows, fields):
+    """
+    Writes fields of rows back with one UPDATE per batch of rows
+    """
+    for offset in range(0, len(rows), UPSERT_BATCH_SIZE):
+        batch = rows[offset:offset + UPSERT_BATCH_SIZE]
+        ModelClass.objects.filter(pk__in=[row.pk for row in batch]).update(**dict(
+            (name, models.Case(*[models.When(pk=row.pk, then=models.Value(getattr(row, name)))
+                                 for row in batch],
+                               output_field=ModelClass._meta.get_field(name)))
+            for name in fields))
+
+def split_attribute(string):
+    """
+    The values in a comma separated profile attribute
+    """
+    return frozenset(value for value in (string or '').split(',') if value)
 
-    def get_demographic_data(self):
-        data, avgs, counts = parser.parse_demographic_data(self.data_file)
-        position_objs = self._batch_prepare(Position, 'position', data, avgs, counts)
-        ethnicity_objs = self._batch_prepare(Ethnicity, 'ethnicity', data, avgs, counts)
-        gender_objs = self._batch_prepare(Gender, 'gender', data, avgs, counts)
+def profile_attribute_rows(profiles):
+    """
+    The ProfileAttribute rows the attribute strings of profiles describe
+    """
+    return [ProfileAttribute(profile_id=profile.pk, attribute=attribute, value=value)
+            for profile in profiles
+            for attribute, values in profile.attribute_sets.items()
+            for value in values]
 
-        demographics = (position_objs, ethnicity_objs, gender_objs)
+class DataFile(models.Model):
+    data_file = models.FileField(upload_to='data/')
+
+    def ingest(self, progress=None):
+        """
+        Converts and folds in the file, as an IngestionJob does
+        """
+        self.convert_excel()
+        return self.get_demographic_data(progress)
+
+    def convert_excel(self):
+        """
+        Replaces an Excel upload with a CSV of its first sheet
+        """
+        base, extension = os.path.splitext(self.data_file.name)
+        if extension.lower() not in ('.xlsx', '.xls'):
+            return
+        excel_name = self.data_file.name
+        self.data_file.open('rb')
+        try:
+            contents = parser.convert_excel_to_csv(self.data_file.read())
+        finally:
+            self.data_file.close()
+        self.data_file.save(os.path.basename(base) + '.csv', ContentFile(contents), save=False)
+        self.data_file.storage.delete(excel_name)
+        # Not save(), which would queue the file again
+        DataFile.objects.filter(pk=self.pk).update(data_file=self.data_file.name)
+
+    def get_demographic_data(self, progress=None):
+        """
+        Folds the wage statistics of the file into the positions, ethnicities
+        and genders it mentions, in place of what an earlier version of the
+        file added, and keeps them as DemographicContributions so that
+        deleting the file can take them back out. progress is called with
+        the number of rows read so far. Returns [(data type, counts)] for
+        each of them.
+        """
+        try:
+            path = self.data_file.path
+        except NotImplementedError:
+            # Storage without local files can't be read in shards
+            path = None
+        if path:
+            stats = parser.parse_salary_statistics_file(path, progress)
+        else:
+            self.data_file.open('rb')
+            try:
+                stats = parser.parse_salary_statistics(self.data_file, progress)
+            finally:
+                self.data_file.close()
+        summary = []
+        with transaction.atomic():
+            self.retract_demographic_data()
+            for data_type, ModelClass in demographic_models:
+                contributions = {}
+                # Values that share a slug share a row, named after the first
+                for name in sorted(stats[data_type]):
+                    slug = slugify(name)
+                    if slug not in contributions:
+                        contributions[slug] = (name, parser.SalaryStats())
+                    contributions[slug][1].merge(stats[data_type][name])
+                contributions = [DemographicContribution.from_stats(
+                    self, data_type, slug, salary_stats, name=name)
+                    for slug, (name, salary_stats) in contributions.items()]
+                summary.append((data_type, ModelClass.fold(contributions)))
+                DemographicContribution.objects.bulk_create(contributions,
+                                                            batch_size=UPSERT_BATCH_SIZE)
+        return summary
+
+    def retract_demographic_data(self):
+        """
+        Subtracts what the file added to the positions, ethnicities and
+        genders, deleting the values only it mentioned
+        """
+        with transaction.atomic():
+            self.lock()
+            for data_type, ModelClass in demographic_models:
+                contributions = self.contributions.filter(data_type=data_type)
+                ModelClass.retract(data_type, list(contributions))
+                contributions.delete()
+
+    def lock(self):
+        """
+        Locks the file's row for the rest of the transaction with a write
+        rather than a read, which on SQLite takes the database write lock up
+        front too, so concurrent ingestions wait for each other instead of
+        failing to upgrade their read locks
+        """
+        DataFile.objects.filter(pk=self.pk).update(data_file=models.F('data_file'))
 
-        for demographic in demographics:
-            for obj in demographic:
-                try:
-                    with transaction.atomic():
-                        obj.save()
-                except IntegrityError:
-                    continue
     @property
     def name(self):
         return self.data_file.name.split('/')[-1]
@@ -49,23 +162,31 @@ class DataFile(models.Model):
     def __unicode__(self):
         return self.name
 
-    def clean(self):
-        excel_filename = self.data_file.name
-        extension = excel_filename.split('.')[1]
-        if extension in ('xlsx', 'xls'):
-            csvFile, csv_filepath = parser.convert_excel_to_csv(self.data_file)
-            self.data_file.save(csv_filepath, csvFile)
-        return self
-
     def save(self, *args, **kwargs):
-        self.get_demographic_data()
-        super(DataFile, self).save(*args, **kwargs)
+        """
+        Stores the file and queues it for the ingestion worker
+        """
+        with transaction.atomic():
+            super(DataFile, self).save(*args, **kwargs)
+            self.ingestion_job = IngestionJob.objects.create(data_file=self)
 
 class ParticipantAttribute(models.Model):
+    """
+    A demographic value and the wages of the participants with it. The
+    sums, count and bounds merge across data files; avg_salary is derived
+    from them.
+    """
     name = models.CharField(max_length=100)
     slug = models.CharField(max_length=100, unique=True)
     avg_salary = models.DecimalField(max_digits=7, decimal_places=4)
     num_participants = models.IntegerField()
+    salary_sum = models.DecimalField(max_digits=20, decimal_places=4, default=0)
+    salary_sum_squares = models.DecimalField(max_digits=24, decimal_places=4, default=0)
+    min_salary = models.DecimalField(max_digits=7, decimal_places=4, null=True, blank=True)
+    max_salary = models.DecimalField(max_digits=7, decimal_places=4, null=True, blank=True)
+
+    stats_fields = ('avg_salary', 'num_participants', 'salary_sum', 'salary_sum_squares',
+                    'min_salary', 'max_salary')
 
     def __unicode__(self):
         return self.name
@@ -78,7 +199,115 @@ class ParticipantAttribute(models.Model):
 
     def save(self, *args, **kwargs):
         self.slug = slugify(self.name)
-        super(ParticipantAttribute, self).save(*args, **kwargs)
+        if not (self.pk is None and self.num_participants and not self.salary_sum):
+            super(ParticipantAttribute, self).save(*args, **kwargs)
+            return
+
+        # Entered by hand: all we know is the average. Like the stats stored
+        # before files were tracked, it is kept as a contribution without a
+        # data file, so retracting files later leaves it in place.
+        average = self._meta.get_field('avg_salary').to_python(self.avg_salary)
+        self.salary_sum = average * self.num_participants
+        self.salary_sum_squares = average * self.salary_sum
+        self.min_salary = self.max_salary = average
+        with transaction.atomic():
+            super(ParticipantAttribute, self).save(*args, **kwargs)
+            data_type = dict((ModelClass, data_type) for data_type, ModelClass
+                             in demographic_models).get(type(self))
+            if data_type:
+                DemographicContribution.objects.create(
+                    data_type=data_type, slug=self.slug,
+                    **dict((name, getattr(self, name)) for name in self.stats_fields
+                           if name != 'avg_salary'))
+
+    def add_stats(self, contribution, sign=1):
+        """
+        Adds (or with sign -1 subtracts) a contribution's sums and count.
+        Bounds can only be widened here; retract recomputes them.
+        """
+        self.num_participants += sign * contribution.num_participants
+        self.salary_sum += sign * contribution.salary_sum
+        self.salary_sum_squares += sign * contribution.salary_sum_squares
+        if sign > 0:
+            self.min_salary = min(bound for bound in (self.min_salary, contribution.min_salary)
+                                  if bound is not None)
+            self.max_salary = max(bound for bound in (self.max_salary, contribution.max_salary)
+                                  if bound is not None)
+        if self.num_participants:
+            self.avg_salary = decimal_value(self._meta.get_field('avg_salary'),
+                                            self.salary_sum / self.num_participants)
+
+    @classmethod
+    def fold(cls, contributions):
+        """
+        Adds contributions to the values they are for, creating the values
+        that have no row yet, and returns how many rows were inserted and
+        updated. Every contribution counts at least one participant, so
+        every value the file mentions is one or the other.
+        """
+        slugs = [contribution.slug for contribution in contributions]
+        existing = {}
+        for start in range(0, len(slugs), UPSERT_BATCH_SIZE):
+            rows = cls.objects.select_for_update().filter(
+                slug__in=slugs[start:start + UPSERT_BATCH_SIZE]).only('slug', *cls.stats_fields)
+            existing.update((row.slug, row) for row in rows)
+        inserted, updated = [], []
+        for contribution in contributions:
+            row = existing.get(contribution.slug)
+            if row is None:
+                row = cls(name=contribution.name, slug=contribution.slug, num_participants=0,
+                          salary_sum=0, salary_sum_squares=0)
+                inserted.append(row)
+            else:
+                updated.append(row)
+            row.add_stats(contribution)
+
+        cls.objects.bulk_create(inserted, batch_size=UPSERT_BATCH_SIZE)
+        bulk_update(cls, updated, cls.stats_fields)
+        # Bulk writes skip the receivers that bump the ETag versions
+        if inserted or updated:
+            model_versions.bump(cls)
+        return {'inserted': len(inserted), 'updated': len(updated)}
+
+    @classmethod
+    def retract(cls, data_type, contributions):
+        """
+        Subtracts contributions from the values they were added to. The
+        bounds are taken again from the contributions that remain, and
+        values nothing else contributed to are deleted.
+        """
+        if not contributions:
+            return
+        slugs = [contribution.slug for contribution in contributions]
+        rows = dict((row.slug, row) for row in
+                    cls.objects.select_for_update().only('slug', *cls.stats_fields))
+        remaining = DemographicContribution.objects.filter(data_type=data_type).exclude(
+            pk__in=[contribution.pk for contribution in contributions])
+        bounds = {}
+        for offset in range(0, len(slugs), UPSERT_BATCH_SIZE):
+            bounds.update((row['slug'], row) for row in remaining.filter(
+                slug__in=slugs[offset:offset + UPSERT_BATCH_SIZE]
+            ).values('slug').annotate(min_salary=models.Min('min_salary'),
+                                      max_salary=models.Max('max_salary')))
+
+        updated, emptied = [], []
+        for contribution in contributions:
+            row = rows.get(contribution.slug)
+            if row is None:
+                continue
+            row.add_stats(contribution, -1)
+            if contribution.slug not in bounds and not row.num_participants:
+                emptied.append(row.pk)
+                continue
+            row_bounds = bounds.get(contribution.slug, {})
+            row.min_salary = row_bounds.get('min_salary')
+            row.max_salary = row_bounds.get('max_salary')
+            updated.append(row)
+
+        bulk_update(cls, updated, cls.stats_fields)
+        cls.objects.filter(pk__in=emptied).delete()
+        if updated or emptied:
+            model_versions.bump(cls)
 
     class Meta:
         abstract = True
@@ -98,6 +327,91 @@ class Position(ParticipantAttribute):
 class Gender(ParticipantAttribute):
     pass
 
+demographic_models = (('position', Position), ('ethnicity', Ethnicity), ('gender', Gender))
+
+class DemographicContribution(models.Model):
+    """
+    What one data file added to one position, ethnicity or gender, kept so
+    that deleting the file subtracts exactly that. Contributions without a
+    data file hold the stats that were stored before files were tracked.
+    """
+    data_file = models.ForeignKey(DataFile, null=True, on_delete=models.CASCADE,
+                                  related_name='contributions')
+    data_type = models.CharField(max_length=20, choices=[(data_type, data_type)
+                                                         for data_type, _ in demographic_models])
+    slug = models.CharField(max_length=100)
+    num_participants = models.IntegerField()
+    salary_sum = models.DecimalField(max_digits=20, decimal_places=4)
+    salary_sum_squares = models.DecimalField(max_digits=24, decimal_places=4)
+    min_salary = models.DecimalField(max_digits=7, decimal_places=4, null=True)
+    max_salary = models.DecimalField(max_digits=7, decimal_places=4, null=True)
+
+    @classmethod
+    def from_stats(cls, data_file, data_type, slug, stats, name):
+        """
+        A contribution of SalaryStats, rounded as it will be stored so that
+        what is added is exactly what will be subtracted
+        """
+        field = lambda name: cls._meta.get_field(name)
+        contribution = cls(
+            data_file=data_file, data_type=data_type, slug=slug,
+            num_participants=stats.count,
+            salary_sum=decimal_value(field('salary_sum'), stats.total),
+            salary_sum_squares=decimal_value(field('salary_sum_squares'), stats.total_squares),
+            min_salary=decimal_value(field('min_salary'), stats.minimum),
+            max_salary=decimal_value(field('max_salary'), stats.maximum))
+        # Only needed to name a value that has no row yet
+        contribution.name = name
+        return contribution
+
+    def __unicode__(self):
+        return u'%s: %s' % (self.data_type, self.slug)
+
+    class Meta:
+        unique_together = ('data_file', 'data_type', 'slug')
+        index_together = ('data_type', 'slug')
+
+class IngestionJob(models.Model):
+    """
+    A saved data file waiting for, or done with, being converted and folded
+    into the demographic stats by the run_ingestion worker
+    """
+    QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+    # Dropped in favour of a newer job queued for the same data file
+    SUPERSEDED = 'superseded'
+    statuses = ((QUEUED, 'Queued'), (RUNNING, 'Running'), (DONE, 'Done'), (FAILED, 'Failed'),
+                (SUPERSEDED, 'Superseded'))
+
+    data_file = models.ForeignKey(DataFile, on_delete=models.CASCADE,
+                                  related_name='ingestion_jobs')
+    status = models.CharField(max_length=10, choices=statuses, default=QUEUED, db_index=True)
+    rows_processed = models.IntegerField(default=0)
+    # JSON of what DataFile.get_demographic_data returned
+    summary = models.TextField(blank=True)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    # Touched by the worker while the job runs, so a job whose worker died
+    # can be told apart from a slow one and queued again
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    @property
+    def throughput(self):
+        """
+        Rows processed per second, so far if the job is still running
+        """
+        if self.started_at is None:
+            return None
+        elapsed = ((self.finished_at or timezone.now()) - self.started_at).total_seconds()
+        return self.rows_processed / elapsed if elapsed > 0 else None
+
+    def __unicode__(self):
+        return u'%s: %s' % (self.data_file, self.status)
+
+    class Meta:
+        ordering = ('-created_at', '-id')
+
 class Tag(models.Model):
     slug = models.CharField(max_length=50, unique=True)
     attribute = models.CharField(max_length=100, choices=profile_attributes)
@@ -116,6 +430,30 @@ class Tag(models.Model):
         self.slug = slugify(self.attribute + self.value)
         super(Tag, self).save(*args, **kwargs)
 
+class QuestionQuerySet(models.QuerySet):
+    def for_serializer(self, fields=None, expand_owner=True):
+        """
+        Loads the owner, the owner's username and the tags that
+        QuestionSerializer renders along with every question. Given the
+        fields actually rendered, loads only what those need.
+        """
+        if fields is None:
+            return self.select_related('owner__user').prefetch_related('tags')
+
+        questions = self.only(*[name for name in fields if name != 'tags'] or ['id'])
+        if 'tags' in fields:
+            questions = questions.prefetch_related('tags')
+        if 'owner' in fields and expand_owner:
+            questions = questions.select_related('owner__user')
+        return questions
+
+    def in_order(self, pks):
+        """
+        The questions with the given pks, in the order of pks
+        """
+        questions = self.in_bulk(pks)
+        return [questions[pk] for pk in pks if pk in questions]
+
 class Question(models.Model):
     title = models.CharField(max_length=300)
     owner = models.ForeignKey('UserProfile', related_name='userprofile',
@@ -124,6 +462,11 @@ class Question(models.Model):
     answer = models.TextField(blank=True)
     tags = models.ManyToManyField(Tag, blank=True)
     number_of_views = models.IntegerField(default=0)
+    # The trigram indexes of the other processes catch up from this, so
+    # update()s that change the text have to set it too
+    modified = models.DateTimeField(auto_now=True, db_index=True)
+
+    objects = QuestionQuerySet.as_manager()
 
     def __unicode__(self):
         return u'%s' % (self.title)
@@ -151,6 +494,21 @@ class UserProfile(models.Model):
     def full_name(self):
         return "%s %s" % (self.first_name, self.last_name)
 
+    @property
+    def attribute_sets(self):
+        """
+        {attribute: frozenset of values} for every taggable attribute,
+        split out of the comma separated strings once and split again only
+        after one of those strings changes
+        """
+        strings = tuple(getattr(self, attribute) for attribute, _ in profile_attributes)
+        cached = getattr(self, '_attribute_sets', None)
+        if cached is None or cached[0] != strings:
+            cached = (strings, dict((attribute, split_attribute(string)) for
+                                    (attribute, _), string in zip(profile_attributes, strings)))
+            self._attribute_sets = cached
+        return cached[1]
+
     def __unicode__(self):
         return self.full_name
 
@@ -158,6 +516,24 @@ class UserProfile(models.Model):
        self.pk = self.user.pk
        super(UserProfile, self).save(*args, **kwargs)
 
+class ProfileAttribute(models.Model):
+    """
+    One (attribute, value) pair held by a profile, kept in sync with the
+    comma separated strings on UserProfile so that the profiles holding a
+    value can be found through an index
+    """
+    profile = models.ForeignKey(UserProfile, related_name='attribute_values',
+    on_delete=models.CASCADE)
+    attribute = models.CharField(max_length=100, choices=profile_attributes)
+    value = models.CharField(max_length=255)
+
+    def __unicode__(self):
+        return u'%s: %s' % (self.attribute, self.value)
+
+    class Meta:
+        unique_together = ('profile', 'attribute', 'value')
+        index_together = ('attribute', 'value')
+
 class Employer(models.Model):
     name = models.CharField(max_length=255)
     address = models.CharField(max_length=255, blank=True)
@@ -165,6 +541,60 @@ class Employer(models.Model):
     averagesalary = models.DecimalField(max_digits=10, decimal_places=2, default=0)
     questions = models.ManyToManyField(Question)
 
+class RecommendedQuestion(models.Model):
+    """
+    Materialized recommendations: the top ranked questions for each profile,
+    refreshed only for the profiles a change actually affects
+    """
+    profile = models.ForeignKey(UserProfile, related_name='recommended_questions',
+    on_delete=models.CASCADE)
+    question = models.ForeignKey(Question, related_name='+', on_delete=models.CASCADE)
+    score = models.IntegerField()
+    rank = models.PositiveIntegerField()
+
+    def __unicode__(self):
+        return u'%s: %s' % (self.rank, self.question)
+
+    class Meta:
+        unique_together = ('profile', 'rank')
+        ordering = ('profile', 'rank')
+
+class QuestionActivity(models.Model):
+    """
+    Views and bookmarks a question got, waiting for the next trending
+    refresh to fold them into its score
+    """
+    question = models.ForeignKey(Question, related_name='+', on_delete=models.CASCADE)
+    views = models.PositiveIntegerField(default=0)
+    bookmarks = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(default=timezone.now)
+
+class ModelVersion(models.Model):
+    """
+    The change counters behind caching.model_versions
+    """
+    label = models.CharField(max_length=100, primary_key=True)
+    version = models.BigIntegerField(default=0)
+
+    def __unicode__(self):
+        return u'%s: %s' % (self.label, self.version)
+
+class TrendingQuestion(models.Model):
+    """
+    The time-decayed activity of every question that has had any, kept as
+    a logarithm relative to a fixed epoch so scores never need decaying
+    and their order only changes for questions with new activity
+    """
+    question = models.OneToOneField(Question, primary_key=True, related_name='+',
+    on_delete=models.CASCADE)
+    score = models.FloatField(db_index=True)
+
+    def __unicode__(self):
+        return u'%s: %s' % (self.score, self.question)
+
+    class Meta:
+        ordering = ('-score', '-question')
+
 @receiver(post_save, sender=User)
 def create_user_profile(sender, instance, created, **kwargs):
    """
@@ -184,3 +614,199 @@ def save_user_profile(sender, instance, **kwargs):
 def create_auth_token(sender, instance=None, created=False, **kwargs):
     if created:
         Token.objects.create(user=instance)
+
+@receiver(post_save, sender=UserProfile)
+def invalidate_profile_recommendations(sender, instance, **kwargs):
+    """
+    A profile's recommendations only depend on its own attributes, so
+    editing one profile leaves every other cached list alone
+    """
+    recommendation_cache.invalidate_profile(instance.pk)
+
+@receiver(post_save, sender=UserProfile)
+def sync_profile_attributes(sender, instance, created, **kwargs):
+    """
+    Rewrites only the ProfileAttribute rows whose values came or went, and
+    re-ranks the profile's recommendations when any did, since nothing else
+    on a profile affects them
+    """
+    current = dict(((attribute, value), pk) for pk, attribute, value in
+                   instance.attribute_values.values_list('pk', 'attribute', 'value'))
+    wanted = dict(((row.attribute, row.value), row)
+                  for row in profile_attribute_rows([instance]))
+    removed = [pk for pair, pk in current.items() if pair not in wanted]
+    if removed:
+        ProfileAttribute.objects.filter(pk__in=removed).delete()
+    added = [row for pair, row in wanted.items() if pair not in current]
+    if added:
+        ProfileAttribute.objects.bulk_create(added)
+    if created or removed or added:
+        refresh_recommendations([instance])
+
+@receiver(post_save, sender=Question)
+@receiver(post_delete, sender=Question)
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+@receiver(m2m_changed, sender=Question.tags.through)
+def invalidate_recommendations(sender, **kwargs):
+    recommendation_cache.bump_corpus_version()
+
+def refresh_recommendations(profiles):
+    from bridges_api import recommendations
+    recommendations.refresh_recommended_questions(profiles, Question)
+
+def refresh_recommendations_for_tags(tags):
+    from bridges_api import recommendations
+    refresh_recommendations(recommendations.profiles_matching_tags(tags))
+
+@receiver(post_delete, sender=UserProfile)
+def delete_profile_recommendations(sender, instance, **kwargs):
+    """
+    Deleting a user cascades to their questions before their profile, and
+    those deletions may have refreshed this profile's rows again
+    """
+    RecommendedQuestion.objects.filter(profile_id=instance.pk).delete()
+
+@receiver(post_save, sender=Question)
+def refresh_recommendations_for_new_question(sender, instance, created, **kwargs):
+    """
+    A new question has no tags yet, so it scores 0 for everyone and, being
+    the newest, comes first among the unscored questions. It is slotted in
+    there in every materialized list that has unscored questions or isn't
+    full yet, the unscored questions after it moving down a rank, instead
+    of re-ranking every profile.
+    """
+    if not created:
+        return
+    from bridges_api import recommendations
+    limit = recommendations.MATERIALIZED_RECOMMENDATIONS
+    # Unordered, since Meta.ordering would split the GROUP BYs below by rank
+    rows = RecommendedQuestion.objects.exclude(question=instance).order_by()
+
+    with transaction.atomic():
+        ranks = dict(rows.filter(score=0).values('profile_id')
+                     .annotate(first_unscored=models.Min('rank'))
+                     .values_list('profile_id', 'first_unscored'))
+        if Question.objects.count() <= limit:
+            # Lists holding every question so far and nothing unscored
+            # just get one longer
+            for profile_id, last_rank in (rows.values('profile_id')
+                                          .annotate(last_rank=models.Max('rank'))
+                                          .values_list('profile_id', 'last_rank')):
+                ranks.setdefault(profile_id, last_rank + 1)
+            for profile_id in UserProfile.objects.filter(
+                    recommended_questions__isnull=True).values_list('pk', flat=True):
+                ranks[profile_id] = 1
+
+        if Question.objects.filter(pk__gt=instance.pk).exists():
+            # Created with an explicit id older than others, so it isn't
+            # the first unscored question: rank the lists it enters again
+            refresh_recommendations(UserProfile.objects.filter(pk__in=list(ranks)))
+            return
+
+        rows.filter(score=0, rank__gte=limit).delete()
+        # In two steps, so that no two rows of a profile ever share a rank
+        unscored = rows.filter(score=0, profile_id__in=list(ranks))
+        unscored.update(rank=models.F('rank') + RANK_SHIFT)
+        unscored.update(rank=models.F('rank') - RANK_SHIFT + 1)
+        RecommendedQuestion.objects.bulk_create([
+            RecommendedQuestion(profile_id=profile_id, question=instance, score=0, rank=rank)
+            for profile_id, rank in ranks.items()], batch_size=UPSERT_BATCH_SIZE)
+
+@receiver(pre_delete, sender=DataFile)
+def retract_data_file(sender, instance, **kwargs):
+    instance.retract_demographic_data()
+
+@receiver(post_delete, sender=Position)
+@receiver(post_delete, sender=Ethnicity)
+@receiver(post_delete, sender=Gender)
+def forget_contributions(sender, instance, **kwargs):
+    """
+    A value deleted by hand takes what every file added to it along, so
+    that retracting those files later doesn't subtract from a new row
+    """
+    data_type = dict((ModelClass, data_type) for data_type, ModelClass
+                     in demographic_models)[sender]
+    DemographicContribution.objects.filter(data_type=data_type, slug=instance.slug).delete()
+
+@receiver(pre_delete, sender=Question)
+def find_recommendations_of_deleted_question(sender, instance, **kwargs):
+    instance._recommended_to = list(RecommendedQuestion.objects.filter(
+        question=instance).values_list('profile_id', flat=True))
+
+@receiver(post_delete, sender=Question)
+def refresh_recommendations_of_deleted_question(sender, instance, **kwargs):
+    profile_ids = getattr(instance, '_recommended_to', [])
+    if profile_ids:
+        refresh_recommendations(UserProfile.objects.filter(pk__in=profile_ids))
+
+@receiver(m2m_changed, sender=Question.tags.through)
+def refresh_tagged_recommendations(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Only profiles holding the (attribute, value) of a tag that was added to or
+    removed from a question can see their scores change
+    """
+    if action == 'pre_clear' and not reverse:
+        instance._cleared_tag_ids = list(instance.tags.values_list('id', flat=True))
+    elif action in ('post_add', 'post_remove', 'post_clear'):
+        if reverse:
+            tags = [instance]
+        elif action == 'post_clear':
+            tags = Tag.objects.filter(id__in=instance._cleared_tag_ids)
+        else:
+            tags = Tag.objects.filter(id__in=pk_set)
+        refresh_recommendations_for_tags(tags)
+
+@receiver(pre_save, sender=Tag)
+def find_previous_tag(sender, instance, **kwargs):
+    instance._previous = Tag.objects.filter(pk=instance.pk).first() if instance.pk else None
+
+@receiver(post_save, sender=Tag)
+def refresh_recommendations_for_edited_tag(sender, instance, created, **kwargs):
+    if not created:
+        refresh_recommendations_for_tags([tag for tag in (instance, instance._previous) if tag])
+
+@receiver(post_delete, sender=Tag)
+def refresh_recommendations_for_deleted_tag(sender, instance, **kwargs):
+    refresh_recommendations_for_tags([instance])
+
+@receiver(post_save, sender=Question)
+def index_question(sender, instance, **kwargs):
+    search.index_question(instance)
+
+@receiver(post_delete, sender=Question)
+def unindex_question(sender, instance, **kwargs):
+    search.unindex_question(instance.pk)
+
+@receiver(m2m_changed, sender=UserProfile.bookmarks.through)
+def record_bookmark_activity(sender, instance, action, reverse, pk_set, **kwargs):
+    if action != 'post_add' or not pk_set:
+        return
+    if reverse:
+        QuestionActivity.objects.create(question=instance, bookmarks=len(pk_set))
+    else:
+        QuestionActivity.objects.bulk_create([
+            QuestionActivity(question_id=question_id, bookmarks=1) for question_id in pk_set])
+
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+@receiver(post_save, sender=Position)
+@receiver(post_delete, sender=Position)
+@receiver(post_save, sender=Ethnicity)
+@receiver(post_delete, sender=Ethnicity)
+@receiver(post_save, sender=Gender)
+@receiver(post_delete, sender=Gender)
+@receiver(post_save, sender=Disability)
+@receiver(post_delete, sender=Disability)
+@receiver(post_save, sender=Employer)
+@receiver(post_delete, sender=Employer)
+def bump_model_version(sender, **kwargs):
+    model_versions.bump(sender)
+
+@receiver(m2m_changed, sender=Employer.questions.through)
+@receiver(post_delete, sender=Question)
+def bump_employer_version(sender, **kwargs):
+    # Employers list their question ids, and deleting a question drops
+    # them from its employers without an m2m_changed
+    model_versions.bump(Employer)
+
@@ -1,6 +1,101 @@
-from rest_framework.pagination import PageNumberPagination
+from django.db.models.query import QuerySet
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import Cursor, CursorPagination, PageNumberPagination
+
+class KeysetPagination(CursorPagination):
+    """
+    Cursor pagination that seeks past the last row of the previous page on
+    an indexed ordering instead of counting and offsetting, so a page costs
+    the same however deep it is. Querysets are ordered by the view's
+    cursor_ordering, primary key by default.
+
+    Ranked sequences (recommendations, search results, trending questions)
+    are cursored on their position in the sequence. That is only a seek
+    where the sequence is stored by rank, as the materialized
+    recommendations and trending questions are; search results and
+    recommendations past the materialized ones are still offset-paged.
+    """
+    page_size = 25
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+    ordering = 'pk'
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        if page_size <= 0:
+            return self.page_size
+        return min(page_size, self.max_page_size)
+
+    def get_ordering(self, request, queryset, view):
+        return (getattr(view, 'cursor_ordering', self.ordering),)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.rank = None
+        if isinstance(queryset, QuerySet):
+            return super(KeysetPagination, self).paginate_queryset(queryset, request, view)
+
+        self.page_size = self.get_page_size(request)
+        self.base_url = request.build_absolute_uri()
+        self.cursor = self.decode_cursor(request)
+        try:
+            self.rank = int(self.cursor.position) if self.cursor and self.cursor.position else 0
+        except ValueError:
+            raise NotFound(self.invalid_cursor_message)
+        if self.rank < 0:
+            raise NotFound(self.invalid_cursor_message)
+
+        # One extra item tells us whether there is a next page without a count
+        results = list(queryset[self.rank:self.rank + self.page_size + 1])
+        self.page = results[:self.page_size]
+        self.has_next = len(results) > self.page_size
+        self.has_previous = self.rank > 0
+        self.display_page_controls = self.has_next or self.has_previous
+        return self.page
+
+    def get_next_link(self):
+        if self.rank is None:
+            return super(KeysetPagination, self).get_next_link()
+        if not self.has_next:
+            return None
+        return self.encode_cursor(Cursor(offset=0, reverse=False,
+                                         position=str(self.rank + self.page_size)))
+
+    def get_previous_link(self):
+        if self.rank is None:
+            return super(KeysetPagination, self).get_previous_link()
+        if not self.has_previous:
+            return None
+        return self.encode_cursor(Cursor(offset=0, reverse=False,
+                                         position=str(max(0, self.rank - self.page_size))))
 
 class StandardResultsSetPagination(PageNumberPagination):
+    """
+    Page number pagination, or keyset pagination for clients that pass a
+    cursor parameter (empty for the first page) and don't need the count
+    """
     page_size = 25
     page_size_query_param = 'page_size'
     max_page_size = 1000
+    cursor_query_param = 'cursor'
+    keyset = None
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if self.cursor_query_param in request.query_params:
+            self.keyset = KeysetPagination()
+            page = self.keyset.paginate_queryset(queryset, request, view)
+            self.display_page_controls = self.keyset.display_page_controls
+            return page
+        return super(StandardResultsSetPagination, self).paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        if self.keyset:
+            return self.keyset.get_paginated_response(data)
+        return super(StandardResultsSetPagination, self).get_paginated_response(data)
+
+    def to_html(self):
+        if self.keyset:
+            return self.keyset.to_html()
+        return super(StandardResultsSetPagination, self).to_html()
@@ -1,66 +1,364 @@
 import os
 import xlrd
 import csv
+import multiprocessing
+from decimal import Decimal, InvalidOperation, localcontext
+from io import BytesIO
 
-def convert_excel_to_csv(excel_file_obj):
-    workbook = xlrd.open_workbook(file_contents=excel_file_obj.read())
-    sheet_names = workbook.sheet_names()
-    sheet = workbook.sheet_by_name(sheet_names[0])
-    excel_file_obj.name = excel_file_obj.name.replace('xlsx', 'csv').replace('xls', 'csv')
-    excel_file_obj.open('w+')
-    csv_writer = csv.writer(excel_file_obj, quoting=csv.QUOTE_ALL)
+from django.conf import settings
+
+def convert_excel_to_csv(contents):
+    """
+    The first sheet of an Excel workbook as CSV
+    """
+    workbook = xlrd.open_workbook(file_contents=contents)
+    sheet = workbook.sheet_by_index(0)
+    out = BytesIO()
+    csv_writer = csv.writer(out, quoting=csv.QUOTE_ALL)
     for row_number in xrange(sheet.nrows):
-        csv_writer.writerow(sheet.row_values(row_number))
-    return (excel_file_obj, excel_file_obj.path.replace('xlsx', 'csv').replace('xls', 'csv'))
+        csv_writer.writerow([value.encode('utf-8') if isinstance(value, unicode) else value
+                             for value in sheet.row_values(row_number)])
+    return out.getvalue()
+
+
+# Mapping from dictionary keys to column names:
+params = {
+    'wage' : 'Ending Wage', # NOTE: starting vs ending wage?
+    'employer' : 'Employer Name',
+    'position' : 'Position Title',
+    'ethnicity' : 'Ethnicity',
+    'gender' : 'Gender'
+}
+demographic_keys = ('employer', 'position', 'ethnicity', 'gender')
+
+# The original nested loop aggregated every row once per demographic key, so
+# each participant is counted (and their wage summed) this many times. The
+# averages come out the same, and parse_demographic_data keeps doing it so
+# its output doesn't change; the stored statistics count everyone once.
+ROW_REPEATS = len(demographic_keys)
+# How many rows parse_salary_statistics reads between progress reports
+PROGRESS_ROWS = 1000
+# How many processes parse a file in byte-range shards, by default one per CPU
+SHARDS = getattr(settings, 'DATA_FILE_PARSE_SHARDS', None)
+# Files smaller than this are parsed serially, where starting the processes
+# would cost more than it saves
+SERIAL_BELOW_BYTES = getattr(settings, 'DATA_FILE_SERIAL_BELOW_BYTES', 8 * 1024 * 1024)
+BLOCK_SIZE = 1024 * 1024
+# Enough digits for the sums of squares of SalaryStats to be exact, so they
+# come out the same whatever order the wages are added in
+EXACT_PRECISION = 80
+
+def empty_demographic_data():
+    return tuple(dict((key, container()) for key in demographic_keys)
+                 for container in (set, dict, dict))
+
+def aggregate_demographic_data(header, rows):
+    """
+    The non-empty values of every demographic column of rows, and the sum
+    and count of the wages of each value
+    """
+    sets, sums, counts = empty_demographic_data()
+
+    # DictReader semantics: the last column with a given name wins
+    columns = dict((name, index) for index, name in enumerate(header))
+    wage_index = columns[params['wage']]
+    key_indexes = [(key, columns[params[key]], sets[key], sums[key], counts[key])
+                   for key in demographic_keys]
+
+    for row in rows:
+        if not row:
+            continue
+
+        for key, index, values, key_sums, key_counts in key_indexes:
+            if row[index]:
+                values.add(row[index])
 
+        wage = row[wage_index]
+        if not wage:
+            continue
+        try:
+            salary = float(wage)
+        except ValueError:
+            continue
+
+        for key, index, values, key_sums, key_counts in key_indexes:
+            value = row[index]
+            total = key_sums.get(value, 0.0)
+            # Added one at a time, like the original, so the sums round the same
+            for _ in range(ROW_REPEATS):
+                total += salary
+            key_sums[value] = total
+            key_counts[value] = key_counts.get(value, 0) + ROW_REPEATS
+
+    return sets, sums, counts
+
+def merge_demographic_data(results):
+    """
+    Adds up the aggregate_demographic_data of several parts of a file
+    """
+    sets, sums, counts = empty_demographic_data()
+    for part_sets, part_sums, part_counts in results:
+        for key in demographic_keys:
+            sets[key].update(part_sets[key])
+            for value, total in part_sums[key].items():
+                sums[key][value] = sums[key].get(value, 0.0) + total
+            for value, count in part_counts[key].items():
+                counts[key][value] = counts[key].get(value, 0) + count
+    return sets, sums, counts
+
+def demographic_averages(sets, sums, counts):
+    avgs = sums
+    for key in demographic_keys:
+        for value, count in counts[key].items():
+            avgs[key][value] /= count
+    return sets, avgs, counts
 
 def parse_demographic_data(csvFile):
-    data = csv.DictReader(csvFile)
+    """
+    Returns the non-empty values of every demographic column, the average
+    wage for each value and how many times it was counted. One pass over
+    the rows: each row is read once, from the file as it streams in, and
+    only the running sums and counts per distinct value are kept.
+    """
+    rows = csv.reader(csvFile)
+    header = next(rows, None)
+    if header is None:
+        return empty_demographic_data()
+    return demographic_averages(*aggregate_demographic_data(header, rows))
 
-    # Mapping from dictionary keys to column names:
-    params = {
-        'wage' : 'Ending Wage', # NOTE: starting vs ending wage?
-        'employer' : 'Employer Name',
-        'position' : 'Position Title',
-        'ethnicity' : 'Ethnicity',
-        'gender' : 'Gender'
-    }
-    keys = {
-        'employer',
-        'position',
-        'ethnicity',
-        'gender'
-    }
-    sets = {k : set() for k in keys}
-    avgs = {k : {} for k in keys}
-    counts = {k : {} for k in keys}
+class SalaryStats(object):
+    """
+    Count, sum, sum of squares, min and max of some wages. Stats of separate
+    files merge by adding them up, so a new file can be folded into what is
+    stored without re-reading the files before it.
+    """
+    def __init__(self):
+        self.count = 0
+        self.total = Decimal(0)
+        self.total_squares = Decimal(0)
+        self.minimum = None
+        self.maximum = None
 
-    for row in data:
-        for key in sets.keys():
-            val = row[params[key]]
-            if len(val) > 0:
-                sets[key].add(val)
-
-            if len(row[params['wage']]) > 0:
-                try:
-                    salary = float(row[params['wage']])
-                except ValueError:
+    def add(self, salary):
+        self.count += 1
+        self.total += salary
+        self.total_squares += salary * salary
+        self.minimum = salary if self.minimum is None else min(self.minimum, salary)
+        self.maximum = salary if self.maximum is None else max(self.maximum, salary)
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        self.total_squares += other.total_squares
+        for bound in (other.minimum, other.maximum):
+            if bound is not None:
+                self.minimum = bound if self.minimum is None else min(self.minimum, bound)
+                self.maximum = bound if self.maximum is None else max(self.maximum, bound)
+
+def report_progress(rows, progress):
+    """
+    rows, calling progress with how many have been read every
+    PROGRESS_ROWS rows and once they are all read
+    """
+    row_count = 0
+    for row in rows:
+        row_count += 1
+        if row_count % PROGRESS_ROWS == 0:
+            progress(row_count)
+        yield row
+    progress(row_count)
+
+def aggregate_salary_statistics(header, rows):
+    """
+    {key: {value: SalaryStats}} for the rows of a file with header
+    """
+    stats = dict((key, {}) for key in demographic_keys)
+    columns = dict((name, index) for index, name in enumerate(header))
+    wage_index = columns[params['wage']]
+    key_indexes = [(columns[params[key]], stats[key]) for key in demographic_keys]
+
+    with localcontext() as context:
+        context.prec = EXACT_PRECISION
+        for row in rows:
+            if not row or not row[wage_index]:
+                continue
+            try:
+                salary = Decimal(row[wage_index].strip())
+            except InvalidOperation:
+                continue
+            if not salary.is_finite():
+                continue
+
+            for index, key_stats in key_indexes:
+                value = row[index]
+                if value:
+                    if value not in key_stats:
+                        key_stats[value] = SalaryStats()
+                    key_stats[value].add(salary)
+
+    return stats
+
+def merge_salary_statistics(results):
+    """
+    Adds up the aggregate_salary_statistics of several parts of a file
+    """
+    stats = dict((key, {}) for key in demographic_keys)
+    with localcontext() as context:
+        context.prec = EXACT_PRECISION
+        for part in results:
+            for key in demographic_keys:
+                for value, value_stats in part[key].items():
+                    if value not in stats[key]:
+                        stats[key][value] = SalaryStats()
+                    stats[key][value].merge(value_stats)
+    return stats
+
+def parse_salary_statistics(csvFile, progress=None):
+    """
+    Returns {key: {value: SalaryStats}} for the non-empty values of every
+    demographic column that have at least one wage, in one pass. Wages are
+    read as exact decimals and, unlike parse_demographic_data, counted once
+    per row. progress, if given, is called with the number of rows read
+    every PROGRESS_ROWS rows and at the end.
+    """
+    rows = csv.reader(csvFile)
+    header = next(rows, None)
+    if header is None:
+        return dict((key, {}) for key in demographic_keys)
+    if progress:
+        rows = report_progress(rows, progress)
+    return aggregate_salary_statistics(header, rows)
+
+def record_boundaries(path, targets, block_size=BLOCK_SIZE):
+    """
+    The offset just past the first line break at or after each of the
+    sorted targets that isn't inside a quoted field, skipping targets that
+    fall within a record already found. A line break is quoted when an odd
+    number of quote characters come before it, which holds for escaped
+    quotes too since they come in pairs.
+    """
+    boundaries = []
+    targets = iter(targets)
+    target = next(targets, None)
+    quotes = offset = 0
+    with open(path, 'rb') as stream:
+        while target is not None:
+            block = stream.read(block_size)
+            if not block:
+                break
+            while target is not None:
+                line_break = block.find(b'\n', max(target - offset, 0))
+                if line_break == -1:
+                    break
+                if (quotes + block.count(b'"', 0, line_break)) % 2:
+                    target = offset + line_break + 1
                     continue
-                for key in avgs.keys():
-                    val = row[params[key]]
-                    if val in avgs[key].keys():
-                        avgs[key][val] += salary
-                        counts[key][val] += 1
-                    else:
-                        avgs[key][val] = salary
-                        counts[key][val] = 1
-
-    for k in counts.keys():
-        for l in counts[k].keys():
-            if counts[k][l] > 0:
-                avgs[k][l] /= counts[k][l]
+                boundaries.append(offset + line_break + 1)
+                while target is not None and target < boundaries[-1]:
+                    target = next(targets, None)
+            quotes += block.count(b'"')
+            offset += len(block)
+    return boundaries
 
-    return sets, avgs, counts
+def read_lines(path, start, end):
+    """
+    The lines of the file at path from byte start up to byte end
+    """
+    with open(path, 'rb') as stream:
+        stream.seek(start)
+        position = start
+        while position < end:
+            line = stream.readline()
+            if not line:
+                break
+            position += len(line)
+            yield line
+
+def aggregate_shard(shard):
+    """
+    Runs aggregate over the records of one shard, in a worker process.
+    Returns the result and the number of rows.
+    """
+    path, start, end, header, aggregate = shard
+    row_count = [0]
+
+    def record(rows):
+        row_count[0] = rows
+
+    rows = report_progress(csv.reader(read_lines(path, start, end)), record)
+    return aggregate(header, rows), row_count[0]
+
+def parse_in_shards(path, aggregate, merge, shards=None, serial_below=None, progress=None):
+    """
+    Splits the CSV file at path into shards byte ranges on record
+    boundaries, runs aggregate(header, rows) over each in its own process
+    and merges the results. Files smaller than serial_below bytes or with
+    too few records are aggregated in this process instead, and so is every
+    file when this is itself a process pool's worker, which can't start
+    processes of its own; run_ingestion keeps large files out of its pool
+    for that reason. shards and serial_below default to SHARDS (or a shard
+    per CPU) and SERIAL_BELOW_BYTES. progress is called with the rows read
+    so far as shards finish. Returns None for a file without a header.
+    """
+    shards = shards or SHARDS or multiprocessing.cpu_count()
+    if serial_below is None:
+        serial_below = SERIAL_BELOW_BYTES
+    size = os.path.getsize(path)
+    boundaries = []
+    if (shards > 1 and size >= serial_below and
+            not multiprocessing.current_process().daemon):
+        boundaries = record_boundaries(path, [0] + [size * shard // shards
+                                                    for shard in range(1, shards)])
+
+    if len(boundaries) < 2:
+        with open(path, 'rb') as stream:
+            rows = csv.reader(stream)
+            header = next(rows, None)
+            if header is None:
+                return None
+            if progress:
+                rows = report_progress(rows, progress)
+            return merge([aggregate(header, rows)])
+
+    header = next(csv.reader(read_lines(path, 0, boundaries[0])))
+    jobs = [(path, start, end, header, aggregate)
+            for start, end in zip(boundaries, boundaries[1:] + [size])]
+    results = []
+    rows_read = 0
+    pool = multiprocessing.Pool(len(jobs))
+    try:
+        for result, row_count in pool.imap_unordered(aggregate_shard, jobs):
+            results.append(result)
+            rows_read += row_count
+            if progress:
+                progress(rows_read)
+    finally:
+        pool.close()
+        pool.join()
+    return merge(results)
+
+def parse_demographic_file(path, shards=None, serial_below=None):
+    """
+    parse_demographic_data of the file at path, parsed in shards across
+    processes when it is big enough. The sums of different shards are added
+    in a different order, so the averages can differ in their last bits.
+    """
+    merged = parse_in_shards(path, aggregate_demographic_data, merge_demographic_data,
+                             shards, serial_below)
+    if merged is None:
+        return empty_demographic_data()
+    return demographic_averages(*merged)
+
+def parse_salary_statistics_file(path, progress=None, shards=None, serial_below=None):
+    """
+    parse_salary_statistics of the file at path, parsed in shards across
+    processes when it is big enough. Sharded or not, the result is the same.
+    """
+    merged = parse_in_shards(path, aggregate_salary_statistics, merge_salary_statistics,
+                             shards, serial_below, progress)
+    if merged is None:
+        return dict((key, {}) for key in demographic_keys)
+    return merged
 
 def get_barriers(csvFile):
     data = csv.DictReader(csvFile)
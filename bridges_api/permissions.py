@@ -19,3 +19,10 @@ class IsOwnerOrCreateOnly(permissions.BasePermission):
         if request.method in permissions.SAFE_METHODS:
             return obj.user == request.user
         return True
+
+class IsSuperUser(permissions.BasePermission):
+    """
+    Custom permission to only allow superusers, whatever the method
+    """
+    def has_permission(self, request, view):
+        return request.user and request.user.is_superuser
@@ -1,3 +1,13 @@
+import heapq
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, IntegerField, Q, Sum, Value, When
+
+from bridges_api.caching import recommendation_cache
+from bridges_api.models import ProfileAttribute, RecommendedQuestion, UserProfile
+
 attribute_weights = {
     "gender":3,
     "ethnicity":3,
@@ -5,37 +15,252 @@ attribute_weights = {
     "disabilities": 10,
 }
 
-def removeScoresFromList(tupleList) :
-    newList = []
-    for i in range (len(tupleList)-1,-1,-1):
-        newList.append(tupleList[i][0])
-    return newList
-
-def insertQuestion(currentQTuple, sortedQuestionList):
-    if not len(sortedQuestionList)>0 :
-        sortedQuestionList.append(currentQTuple)
-    elif (len(sortedQuestionList) <20) or (currentQTuple[1] > sortedQuestionList[0][1]) :
-        lo = 0
-        hi = len(sortedQuestionList)
-        while lo < hi:
-            mid = (lo+hi)//2
-            if currentQTuple[1] < sortedQuestionList[mid][1]:
-                hi = mid
-            else:
-                lo = mid+1
-        sortedQuestionList.insert(lo,currentQTuple)
-        while len(sortedQuestionList)>20:
-            sortedQuestionList.pop(0)
-
-def recommend(userprofile, Question):
-    recommended_questions = []
-    for question in Question.objects.all():
-        questionscore = 0
-        for tag in question.tags.all():
-            attlist = getattr(userprofile, tag.attribute).split(",")
-            if tag.value in attlist:
-                questionscore += attribute_weights[tag.attribute]
-        questiontuple = (question, questionscore)
-        insertQuestion(questiontuple, recommended_questions)
-    questionslist = removeScoresFromList(recommended_questions)
-    return questionslist
+RECOMMENDATION_LIMIT = 20
+UNSCORED_BATCH_SIZE = 500
+MATERIALIZED_RECOMMENDATIONS = getattr(settings, 'MATERIALIZED_RECOMMENDATIONS', 100)
+REFRESH_BATCH_SIZE = 500
+BATCH_SCORING_THRESHOLD = 10
+
+def top_k(scored_items, k):
+    """
+    Picks the k highest scoring items out of (item, score) pairs with a
+    bounded heap, best first. Ties are broken by the item itself, highest
+    first, so that newer questions win ties and a tie spanning two pages
+    always splits the same way.
+    """
+    best = heapq.nlargest(k, scored_items, key=lambda pair: (pair[1], pair[0]))
+    return [item for item, score in best]
+
+def score_questions(userprofile, Question):
+    """
+    Returns a {question_id: score} map for the questions that share at least
+    one tag with the profile. The Question.tags through-table joined with Tag
+    acts as the inverted index from (attribute, value) to question ids, so
+    this is a single aggregated query no matter how many questions exist
+    """
+    matching_tags = Q()
+    for attribute, values in userprofile.attribute_sets.items():
+        matching_tags |= Q(tag__attribute=attribute, tag__value__in=values)
+
+    weight = Case(*[When(tag__attribute=attribute, then=Value(score))
+                    for attribute, score in attribute_weights.items()],
+                  default=Value(0), output_field=IntegerField())
+
+    rows = (Question.tags.through.objects.filter(matching_tags)
+            .values('question_id').annotate(score=Sum(weight)))
+    return {row['question_id']: row['score'] for row in rows}
+
+class Ranking(object):
+    """
+    The ranked question ids for one profile. The corpus is scored once, and
+    the ranking is only selected as deep as the pages that have actually
+    been asked for.
+    """
+    def __init__(self, scores, total):
+        self.scores = {question_id: score for question_id, score in scores.items()
+                       if score > 0}
+        self.total = total
+        self.question_ids = []
+
+    def top(self, Question, k):
+        if len(self.question_ids) < min(k, self.total):
+            question_ids = top_k(self.scores.items(), k)
+            if len(question_ids) < k:
+                question_ids += self._unscored_ids(Question, k - len(question_ids))
+            self.question_ids = question_ids
+        return self.question_ids[:k]
+
+    def _unscored_ids(self, Question, needed):
+        """
+        Questions sharing no tag with the profile all score zero, so they
+        come after the scored ones, newest first
+        """
+        ordered_ids = Question.objects.order_by('-id').values_list('id', flat=True)
+        batch_size = max(needed, UNSCORED_BATCH_SIZE)
+        unscored = []
+        offset = 0
+        while len(unscored) < needed:
+            batch = list(ordered_ids[offset:offset + batch_size])
+            if not batch:
+                break
+            unscored += [question_id for question_id in batch
+                         if question_id not in self.scores]
+            offset += len(batch)
+        return unscored[:needed]
+
+def get_ranking(userprofile, Question):
+    cache_key = recommendation_cache.key(userprofile.pk)
+    ranking = recommendation_cache.get(cache_key)
+    if ranking is None:
+        ranking = Ranking(score_questions(userprofile, Question),
+                          Question.objects.count())
+        recommendation_cache.set(cache_key, ranking)
+    return ranking
+
+class RecommendedQuestions(object):
+    """
+    Every question, ranked for a profile, behaving like a sequence so that it
+    can be handed straight to the paginator. Pages within the materialized
+    recommendations are read from the RecommendedQuestion table in one
+    indexed query; anything deeper, or not materialized yet, selects the top
+    N * page_size from the cached live ranking rather than rescoring.
+
+    fetch turns a page of question ids into what the page should contain,
+    model instances ready for QuestionSerializer by default.
+    """
+    def __init__(self, userprofile, Question, fetch=None):
+        self.userprofile = userprofile
+        self.Question = Question
+        self.fetch = fetch or Question.objects.for_serializer().in_order
+        self._count = None
+
+    def count(self):
+        if self._count is None:
+            self._count = self.Question.objects.count()
+        return self._count
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.start or 0, index.stop, index.step
+            if stop is None or start < 0 or stop < 0:
+                start, stop, step = index.indices(self.count())
+            return self.fetch(self._question_ids(start, stop))[::step]
+
+        if index < 0:
+            index += self.count()
+        if not 0 <= index < self.count():
+            raise IndexError('recommendation index out of range')
+        return self[index:index + 1][0]
+
+    def _question_ids(self, start, stop):
+        if start >= stop:
+            return []
+
+        question_ids = None
+        if stop <= MATERIALIZED_RECOMMENDATIONS:
+            question_ids = list(RecommendedQuestion.objects.filter(
+                profile=self.userprofile, rank__gt=start, rank__lte=stop
+            ).order_by('rank').values_list('question_id', flat=True))
+            # A full page needs no count to know it is complete
+            if len(question_ids) == stop - start:
+                return question_ids
+
+        stop = min(stop, self.count())
+        if start >= stop:
+            return []
+        if question_ids is not None and len(question_ids) == stop - start:
+            return question_ids
+
+        ranking = get_ranking(self.userprofile, self.Question)
+        return ranking.top(self.Question, stop)[start:stop]
+
+def recommend(userprofile, Question, limit=RECOMMENDATION_LIMIT):
+    return RecommendedQuestions(userprofile, Question)[:limit]
+
+class TagMatrix(object):
+    """
+    The sparse question x (attribute, value) indicator matrix, stored one
+    column per feature as a posting list of question ids and built from a
+    single query over the Question.tags through-table. A profile is a sparse
+    row over the same vocabulary, so its scores are the weighted sum of the
+    columns it holds.
+    """
+    def __init__(self, Question):
+        self.postings = defaultdict(list)
+        rows = Question.tags.through.objects.values_list(
+            'question_id', 'tag__attribute', 'tag__value')
+        for question_id, attribute, value in rows.iterator():
+            self.postings[(attribute, value)].append(question_id)
+
+    def profile_features(self, userprofile):
+        return [(attribute, value)
+                for attribute, values in userprofile.attribute_sets.items()
+                for value in values if (attribute, value) in self.postings]
+
+    def scores(self, userprofile):
+        scores = defaultdict(int)
+        for feature in self.profile_features(userprofile):
+            weight = attribute_weights.get(feature[0], 0)
+            if weight:
+                for question_id in self.postings[feature]:
+                    scores[question_id] += weight
+        return scores
+
+def batch_rank(userprofiles, Question, k=RECOMMENDATION_LIMIT, matrix=None):
+    """
+    Ranks the top k questions for each of many profiles at once, returning
+    {profile pk: [(question_id, score), ...]} in the same order recommend()
+    uses. The tags and the newest questions are each loaded once for the
+    whole batch instead of once per profile.
+    """
+    matrix = matrix or TagMatrix(Question)
+    scores = {profile.pk: matrix.scores(profile) for profile in userprofiles}
+
+    # k unscored questions are always among the newest k + len(scores) ones
+    depth = k + max([len(profile_scores) for profile_scores in scores.values()] or [0])
+    newest_ids = list(Question.objects.order_by('-id')
+                      .values_list('id', flat=True)[:depth])
+
+    ranked = {}
+    for profile_pk, profile_scores in scores.items():
+        question_ids = top_k(profile_scores.items(), k)
+        if len(question_ids) < k:
+            question_ids += [question_id for question_id in newest_ids
+                             if question_id not in profile_scores][:k - len(question_ids)]
+        ranked[profile_pk] = [(question_id, profile_scores.get(question_id, 0))
+                              for question_id in question_ids]
+    return ranked
+
+def batch_recommend(userprofiles, Question, k=RECOMMENDATION_LIMIT):
+    """
+    Recommends k question ids to each of many profiles at once, returning
+    {profile pk: [question_id, ...]}
+    """
+    return {profile_pk: [question_id for question_id, score in ranked_questions]
+            for profile_pk, ranked_questions in batch_rank(userprofiles, Question, k).items()}
+
+def refresh_recommended_questions(userprofiles, Question, matrix=None):
+    """
+    Recomputes the materialized recommendations of the given profiles.
+    A handful of profiles are ranked one by one with the aggregated query,
+    larger batches share one TagMatrix.
+    """
+    userprofiles = list(userprofiles)
+    for offset in range(0, len(userprofiles), REFRESH_BATCH_SIZE):
+        batch = userprofiles[offset:offset + REFRESH_BATCH_SIZE]
+        if matrix is None and len(batch) < BATCH_SCORING_THRESHOLD:
+            ranked = {}
+            for profile in batch:
+                ranking = Ranking(score_questions(profile, Question), Question.objects.count())
+                ranked[profile.pk] = [(question_id, ranking.scores.get(question_id, 0))
+                                      for question_id in ranking.top(Question, MATERIALIZED_RECOMMENDATIONS)]
+        else:
+            matrix = matrix or TagMatrix(Question)
+            ranked = batch_rank(batch, Question, MATERIALIZED_RECOMMENDATIONS, matrix)
+
+        with transaction.atomic():
+            RecommendedQuestion.objects.filter(profile__in=[profile.pk for profile in batch]).delete()
+            RecommendedQuestion.objects.bulk_create([
+                RecommendedQuestion(profile_id=profile_pk, question_id=question_id,
+                                    score=score, rank=rank)
+                for profile_pk, ranked_questions in ranked.items()
+                for rank, (question_id, score) in enumerate(ranked_questions, 1)
+            ])
+
+def profiles_matching_tags(tags):
+    """
+    The profiles holding the (attribute, value) of any of the tags, which are
+    the only ones whose scores change when those tags move between questions
+    """
+    features = set((tag.attribute, tag.value) for tag in tags)
+    if not features:
+        return []
+
+    holding = Q()
+    for attribute, value in features:
+        holding |= Q(attribute=attribute, value=value)
+    return list(UserProfile.objects.filter(
+        pk__in=ProfileAttribute.objects.filter(holding).values('profile_id')))
@@ -0,0 +1,361 @@
+"""
+Full-text search over questions. SQLite keeps an FTS5 table next to the
+question table, PostgreSQL a weighted tsvector column with a GIN index.
+When those find nothing, an in-memory trigram index finds misspelled words.
+All of them are kept in sync from the Question save/delete receivers in
+models.py.
+"""
+import re
+import sys
+import threading
+import time
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Count, Max
+
+QUESTION_TABLE = 'bridges_api_question'
+FTS_TABLE = 'bridges_api_question_fts'
+# How far before the last modified time it saw a trigram index re-reads
+# questions when catching up, for saves that committed after later ones
+CATCH_UP_SLACK = timedelta(seconds=getattr(settings, 'TRIGRAM_CATCH_UP_SLACK', 60))
+
+def search_terms(text):
+    """
+    Splits a query into words. Every word has to match, and matches as a
+    prefix, so 'muffin m' finds 'muffin man'
+    """
+    return re.findall(r'\w+', text or '', re.UNICODE)
+
+class SqliteBackend(object):
+    # bm25() weights for the title, description and answer columns
+    column_weights = (4.0, 1.0, 1.0)
+
+    def create(self, cursor):
+        cursor.execute('CREATE VIRTUAL TABLE %s USING fts5(title, description, answer)'
+                       % FTS_TABLE)
+        cursor.execute('INSERT INTO %s (rowid, title, description, answer) '
+                       'SELECT id, title, description, answer FROM %s'
+                       % (FTS_TABLE, QUESTION_TABLE))
+
+    def drop(self, cursor):
+        cursor.execute('DROP TABLE IF EXISTS %s' % FTS_TABLE)
+
+    def index(self, cursor, question):
+        self.unindex(cursor, question.pk)
+        cursor.execute('INSERT INTO %s (rowid, title, description, answer) '
+                       'VALUES (%%s, %%s, %%s, %%s)' % FTS_TABLE,
+                       [question.pk, question.title, question.description, question.answer])
+
+    def unindex(self, cursor, question_id):
+        cursor.execute('DELETE FROM %s WHERE rowid = %%s' % FTS_TABLE, [question_id])
+
+    def query(self, terms):
+        return ' '.join('"%s"*' % term.replace('"', '""') for term in terms)
+
+    def count(self, cursor, terms):
+        cursor.execute('SELECT count(*) FROM %s WHERE %s MATCH %%s'
+                       % (FTS_TABLE, FTS_TABLE), [self.query(terms)])
+        return cursor.fetchone()[0]
+
+    def ranked_ids(self, cursor, terms, offset, limit):
+        cursor.execute('SELECT rowid FROM %s WHERE %s MATCH %%s '
+                       'ORDER BY bm25(%s, %s), rowid DESC LIMIT %%s OFFSET %%s'
+                       % (FTS_TABLE, FTS_TABLE, FTS_TABLE,
+                          ', '.join(str(weight) for weight in self.column_weights)),
+                       [self.query(terms), limit, offset])
+        return [row[0] for row in cursor.fetchall()]
+
+class PostgresBackend(object):
+    # ts_rank() weighs A (the title) at 1.0 and B (description, answer) at 0.4
+    vector = ("setweight(to_tsvector('english', coalesce(title, '')), 'A') || "
+              "setweight(to_tsvector('english', coalesce(description, '')), 'B') || "
+              "setweight(to_tsvector('english', coalesce(answer, '')), 'B')")
+
+    def create(self, cursor):
+        cursor.execute('ALTER TABLE %s ADD COLUMN search_vector tsvector' % QUESTION_TABLE)
+        cursor.execute('UPDATE %s SET search_vector = %s' % (QUESTION_TABLE, self.vector))
+        cursor.execute('CREATE INDEX %s_search_vector ON %s USING GIN (search_vector)'
+                       % (QUESTION_TABLE, QUESTION_TABLE))
+
+    def drop(self, cursor):
+        cursor.execute('ALTER TABLE %s DROP COLUMN IF EXISTS search_vector' % QUESTION_TABLE)
+
+    def index(self, cursor, question):
+        cursor.execute('UPDATE %s SET search_vector = %s WHERE id = %%s'
+                       % (QUESTION_TABLE, self.vector), [question.pk])
+
+    def unindex(self, cursor, question_id):
+        # The vector is deleted along with the question row
+        pass
+
+    def query(self, terms):
+        return ' & '.join('%s:*' % term for term in terms)
+
+    def count(self, cursor, terms):
+        cursor.execute("SELECT count(*) FROM %s WHERE search_vector @@ to_tsquery('english', %%s)"
+                       % QUESTION_TABLE, [self.query(terms)])
+        return cursor.fetchone()[0]
+
+    def ranked_ids(self, cursor, terms, offset, limit):
+        cursor.execute("SELECT id FROM %s, to_tsquery('english', %%s) query "
+                       "WHERE search_vector @@ query "
+                       "ORDER BY ts_rank(search_vector, query) DESC, id DESC "
+                       "LIMIT %%s OFFSET %%s" % QUESTION_TABLE,
+                       [self.query(terms), limit, offset])
+        return [row[0] for row in cursor.fetchall()]
+
+backends = {
+    'sqlite': SqliteBackend(),
+    'postgresql': PostgresBackend(),
+}
+
+def get_backend(db_connection=connection):
+    """
+    The search backend for the database in use, or None when the database
+    has no full-text search we support
+    """
+    return backends.get(db_connection.vendor)
+
+def trigrams(text):
+    """
+    The character trigrams of every word in text, with words padded the way
+    pg_trgm pads them so that word starts weigh a little more
+    """
+    grams = set()
+    for word in search_terms(text.lower()):
+        padded = '  %s ' % word
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+class TrigramIndex(object):
+    """
+    In-memory inverted index from character trigrams to question ids. A
+    question matches when it holds at least similarity_threshold of the
+    query's trigrams, so 'interveiw' still finds 'interview'.
+
+    Every worker process keeps its own index. The saves and deletes made
+    through it reach it straight away; before searching, it checks the
+    latest Question.modified and the question count, and catches up with
+    what other processes changed when either has moved.
+    """
+    similarity_threshold = 0.5
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.postings = defaultdict(set)
+        self.title_postings = defaultdict(set)
+        self.question_ids = set()
+        self.watermark = None
+        self.built = False
+        self.build_seconds = None
+
+    def corpus_state(self, Question):
+        """
+        The latest modified time and the number of questions
+        """
+        state = Question.objects.aggregate(modified=Max('modified'), count=Count('id'))
+        return state['modified'], state['count']
+
+    def build(self, Question):
+        started = time.time()
+        with self._lock:
+            self.clear()
+            # Read first, so that saves made during the build are caught up
+            self.watermark = self.corpus_state(Question)[0]
+            rows = Question.objects.values_list('id', 'title', 'description', 'answer')
+            for question_id, title, description, answer in rows.iterator():
+                self._add(question_id, title, description, answer)
+            self.built = True
+            self.build_seconds = time.time() - started
+
+    def ensure_current(self, Question):
+        """
+        Builds the index, or catches it up with the questions saved or
+        deleted since it last looked, including by other processes and by
+        bulk_create
+        """
+        if not self.built:
+            self.build(Question)
+            return
+        modified, count = self.corpus_state(Question)
+        if modified == self.watermark and count == len(self.question_ids):
+            return
+        with self._lock:
+            rows = Question.objects.values_list('id', 'title', 'description', 'answer')
+            if self.watermark is not None:
+                rows = rows.filter(modified__gte=self.watermark - CATCH_UP_SLACK)
+            for question_id, title, description, answer in rows.iterator():
+                self._remove(question_id)
+                self._add(question_id, title, description, answer)
+            self.watermark = modified
+            if count != len(self.question_ids):
+                deleted = self.question_ids - set(Question.objects.values_list('id', flat=True))
+                for question_id in deleted:
+                    self._remove(question_id)
+
+    def _add(self, question_id, title, description, answer):
+        title_grams = trigrams(title)
+        for gram in title_grams | trigrams(description) | trigrams(answer):
+            self.postings[gram].add(question_id)
+        for gram in title_grams:
+            self.title_postings[gram].add(question_id)
+        self.question_ids.add(question_id)
+
+    def _remove(self, question_id):
+        # Scans the postings instead of keeping every question's trigrams to
+        # find them by, which would about double the index for the sake of
+        # edits and deletes, rare next to searches
+        if question_id not in self.question_ids:
+            return
+        self.question_ids.discard(question_id)
+        for postings in (self.postings, self.title_postings):
+            for gram in [gram for gram, question_ids in postings.items()
+                         if question_id in question_ids]:
+                postings[gram].discard(question_id)
+                if not postings[gram]:
+                    del postings[gram]
+
+    def update(self, question):
+        if self.built:
+            with self._lock:
+                self._remove(question.pk)
+                self._add(question.pk, question.title, question.description, question.answer)
+
+    def remove(self, question_id):
+        if self.built:
+            with self._lock:
+                self._remove(question_id)
+
+    def search(self, text):
+        """
+        Ids of the questions similar to text, most similar first, then those
+        matching more of it in their title, then the newest
+        """
+        query = trigrams(text)
+        if not query:
+            return []
+
+        hits = defaultdict(int)
+        title_hits = defaultdict(int)
+        with self._lock:
+            for gram in query:
+                for question_id in self.postings.get(gram, ()):
+                    hits[question_id] += 1
+                for question_id in self.title_postings.get(gram, ()):
+                    title_hits[question_id] += 1
+
+        minimum = self.similarity_threshold * len(query)
+        matches = [question_id for question_id, count in hits.items() if count >= minimum]
+        return sorted(matches, reverse=True,
+                      key=lambda question_id: (hits[question_id], title_hits[question_id],
+                                               question_id))
+
+    def memory_bytes(self):
+        """
+        Approximate size of the index, counting its containers and keys
+        """
+        with self._lock:
+            size = sum(sys.getsizeof(container) for container in
+                       (self.postings, self.title_postings, self.question_ids))
+            for postings in (self.postings, self.title_postings):
+                for gram, question_ids in postings.items():
+                    size += sys.getsizeof(gram) + sys.getsizeof(question_ids)
+        return size
+
+    def stats(self):
+        return {
+            'built': self.built,
+            'questions': len(self.question_ids),
+            'trigrams': len(self.postings),
+            'memory_bytes': self.memory_bytes(),
+            'build_seconds': self.build_seconds,
+        }
+
+trigram_index = TrigramIndex()
+
+def index_question(question):
+    backend = get_backend()
+    if backend:
+        with connection.cursor() as cursor:
+            backend.index(cursor, question)
+    trigram_index.update(question)
+
+def unindex_question(question_id):
+    backend = get_backend()
+    if backend:
+        with connection.cursor() as cursor:
+            backend.unindex(cursor, question_id)
+    trigram_index.remove(question_id)
+
+class SearchResults(object):
+    """
+    Questions matching a search, best first, behaving like a sequence so the
+    paginator only ever fetches the page it needs
+    """
+    def __init__(self, Question, text, fetch=None):
+        self.terms = search_terms(text)
+        self.backend = get_backend()
+        self.fetch = fetch or Question.objects.for_serializer().in_order
+        self._count = None
+
+    def count(self):
+        if self._count is None:
+            if not self.terms:
+                self._count = 0
+            else:
+                with connection.cursor() as cursor:
+                    self._count = self.backend.count(cursor, self.terms)
+        return self._count
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return self[index:index + 1][0]
+
+        start, stop, step = index.indices(self.count())
+        if start >= stop:
+            return []
+        with connection.cursor() as cursor:
+            question_ids = self.backend.ranked_ids(cursor, self.terms, start, stop - start)
+        return self.fetch(question_ids)[::step]
+
+class FuzzySearchResults(object):
+    """
+    Questions similar to a search according to the trigram index, most
+    similar first
+    """
+    def __init__(self, Question, text, fetch=None):
+        trigram_index.ensure_current(Question)
+        self.question_ids = trigram_index.search(text)
+        self.fetch = fetch or Question.objects.for_serializer().in_order
+
+    def count(self):
+        return len(self.question_ids)
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return self[index:index + 1][0]
+
+        return self.fetch(self.question_ids[index])
+
+def search_questions(Question, text, fetch=None):
+    """
+    Full-text matches when the database finds any, otherwise the questions
+    that look like a misspelling of the search
+    """
+    if get_backend() is not None:
+        results = SearchResults(Question, text, fetch)
+        if results.count():
+            return results
+    return FuzzySearchResults(Question, text, fetch)
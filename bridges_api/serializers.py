@@ -1,7 +1,12 @@
+import json
+from collections import OrderedDict
+
 from django.contrib.auth.models import User
 from rest_framework import serializers
+from rest_framework.relations import PKOnlyObject
+from rest_framework.settings import api_settings
 from bridges_api.models import (
-    Question, UserProfile, Tag, Employer, Position, Ethnicity, Disability, Gender
+    Question, UserProfile, Tag, Employer, Position, Ethnicity, Disability, Gender, IngestionJob
 )
 
 # Participant attribute serializers
@@ -63,7 +68,24 @@ class UserSerializer(serializers.ModelSerializer):
         instance.save()
         return instance
 
+def requested_fields(request):
+    """
+    The field names asked for with ?fields=id,title (None when the request
+    doesn't restrict them) and the relations asked for with ?expand=owner
+    """
+    if request is None or request.method != 'GET':
+        return None, set()
+    fields = request.query_params.get('fields')
+    expand = request.query_params.get('expand')
+    return (None if fields is None else set(fields.split(',')),
+            set(expand.split(',')) if expand else set())
+
 class QuestionSerializer(serializers.ModelSerializer):
+    """
+    Reads can ask for a subset of the fields with ?fields=. The owner of a
+    question restricted that way is just its id unless ?expand=owner asks
+    for the whole profile.
+    """
     tags = TagSerializer(many=True)
     owner = UserProfileSerializer()
     class Meta:
@@ -71,8 +93,186 @@ class QuestionSerializer(serializers.ModelSerializer):
         fields = ('id', 'title', 'description', 'answer',
                   'tags', 'number_of_views', 'owner')
 
+    def __init__(self, *args, **kwargs):
+        super(QuestionSerializer, self).__init__(*args, **kwargs)
+        self.restricted_fields, self.expand = requested_fields(self.context.get('request'))
+        if self.restricted_fields is not None:
+            for name in set(self.fields) - self.restricted_fields:
+                self.fields.pop(name)
+            if 'owner' in self.fields and 'owner' not in self.expand:
+                self.fields['owner'] = serializers.PrimaryKeyRelatedField(read_only=True)
+
 class EmployerSerializer(serializers.ModelSerializer):
     class Meta:
       model = Employer
       fields = ('name', 'address', 'rating',
                 'averagesalary', 'questions')
+
+class IngestionJobSerializer(serializers.ModelSerializer):
+    data_file = serializers.StringRelatedField()
+    throughput = serializers.FloatField(read_only=True)
+    summary = serializers.SerializerMethodField()
+
+    class Meta:
+        model = IngestionJob
+        fields = ('id', 'data_file', 'status', 'rows_processed', 'throughput', 'summary',
+                  'error', 'created_at', 'started_at', 'finished_at')
+
+    def get_summary(self, job):
+        return json.loads(job.summary) if job.summary else None
+
+class ValuesSerializer(object):
+    """
+    Renders exactly what a read-only ModelSerializer would, but from values()
+    rows instead of model instances. The serializer's fields are walked once
+    up front: scalar fields (including those of nested serializers) become
+    values() keys, read back through the field's own to_representation, and
+    many-to-many fields are filled in with one query per page.
+
+    Walking the fields is the costly part, so for_serializer() keeps one
+    ValuesSerializer per serializer class and requested field set. The
+    request is left out of the compiled fields and only passed to
+    to_representation, for the file URLs that depend on it.
+    """
+    _compiled = {}
+
+    def __init__(self, serializer_class, context=None):
+        serializer = serializer_class(context=context or {})
+        self.model = serializer.Meta.model
+        self.keys = ['pk']
+        self.many_fields = []
+        self.extractors = self.compile(serializer, self.model, '', self.keys)
+        # The fields read their context from here, so they mustn't hold on
+        # to the request they were compiled for
+        serializer._context = {}
+
+    @classmethod
+    def for_serializer(cls, serializer_class, request=None):
+        """
+        The ValuesSerializer of serializer_class for the fields request asks
+        for, compiled on first use
+        """
+        fields, expand = requested_fields(request)
+        key = (serializer_class, None if fields is None else frozenset(fields), frozenset(expand))
+        values_serializer = cls._compiled.get(key)
+        if values_serializer is None:
+            values_serializer = cls._compiled[key] = cls(serializer_class, {'request': request})
+        return values_serializer
+
+    def compile(self, serializer, model, prefix, keys):
+        extractors = []
+        for name, field in serializer.fields.items():
+            if field.write_only:
+                continue
+            source = '__'.join(field.source_attrs)
+            if isinstance(field, (serializers.ListSerializer, serializers.ManyRelatedField)):
+                assert not prefix, 'Many-to-many fields are only supported at the top level'
+                self.many_fields.append((name, self.compile_many(model, source, field)))
+                extractors.append((name, self.many_extractor(name)))
+            elif isinstance(field, serializers.RelatedField):
+                key = prefix + source
+                keys.append(key)
+                extractors.append((name, self.related_extractor(key, field)))
+            elif isinstance(field, serializers.BaseSerializer):
+                nested = self.compile(field, field.Meta.model, prefix + source + '__', keys)
+                extractors.append((name, self.nested_extractor(nested)))
+            else:
+                key = prefix + source
+                keys.append(key)
+                if isinstance(field, serializers.FileField):
+                    model_field = model._meta.get_field(source)
+                    extractors.append((name, self.file_extractor(key, field, model_field)))
+                else:
+                    extractors.append((name, self.scalar_extractor(key, field)))
+        return extractors
+
+    # Extractors take a row and the page it is on, a dict of the page's
+    # request and its many-to-many values by field name
+
+    def scalar_extractor(self, key, field):
+        def extract(row, page):
+            value = row[key]
+            return None if value is None else field.to_representation(value)
+        return extract
+
+    def related_extractor(self, key, field):
+        def extract(row, page):
+            value = row[key]
+            return None if value is None else field.to_representation(PKOnlyObject(value))
+        return extract
+
+    def file_extractor(self, key, field, model_field):
+        use_url = getattr(field, 'use_url', api_settings.UPLOADED_FILES_USE_URL)
+        def extract(row, page):
+            value = row[key]
+            if value is None:
+                return None
+            # Without a request in its context, the field gives a relative URL
+            url = field.to_representation(model_field.attr_class(None, model_field, value))
+            if url and use_url and page['request'] is not None:
+                return page['request'].build_absolute_uri(url)
+            return url
+        return extract
+
+    def nested_extractor(self, extractors):
+        def extract(row, page):
+            return OrderedDict((name, extractor(row, page))
+                               for name, extractor in extractors)
+        return extract
+
+    def many_extractor(self, name):
+        def extract(row, page):
+            return page[name].get(row['pk'], [])
+        return extract
+
+    def compile_many(self, model, source, field):
+        """
+        Returns a function loading {parent pk: [representation, ...]} for a
+        page of parent pks, with the same query prefetch_related() would run
+        """
+        model_field = model._meta.get_field(source)
+        related_model = model_field.related_model
+        related_name = model_field.related_query_name()
+
+        if isinstance(field, serializers.ManyRelatedField):
+            child = field.child_relation
+            def load(pks, page):
+                related = {}
+                for parent_pk, pk in related_model.objects.filter(
+                        **{related_name + '__in': pks}).values_list(related_name, 'pk'):
+                    related.setdefault(parent_pk, []).append(
+                        child.to_representation(PKOnlyObject(pk)))
+                return related
+            return load
+
+        keys = [related_name]
+        extractors = self.compile(field.child, related_model, '', keys)
+        def load(pks, page):
+            related = {}
+            for row in related_model.objects.filter(
+                    **{related_name + '__in': pks}).values(*keys):
+                related.setdefault(row[related_name], []).append(OrderedDict(
+                    (name, extractor(row, page)) for name, extractor in extractors))
+            return related
+        return load
+
+    def values(self, queryset):
+        return queryset.prefetch_related(None).values(*self.keys)
+
+    def fetch(self, pks):
+        """
+        The rows for pks, in the order of pks
+        """
+        rows = dict((row['pk'], row) for row in
+                    self.model.objects.filter(pk__in=pks).values(*self.keys))
+        return [rows[pk] for pk in pks if pk in rows]
+
+    def to_representation(self, rows, request=None):
+        rows = list(rows)
+        pks = [row['pk'] for row in rows]
+        page = {'request': request}
+        for name, load in self.many_fields:
+            page[name] = load(pks, page) if pks else {}
+        return [OrderedDict((name, extractor(row, page))
+                            for name, extractor in self.extractors)
+                for row in rows]
@@ -1,12 +1,44 @@
+import base64
+import csv
+import json
+import logging
+import multiprocessing
+import random
+import tempfile
+import time
+from datetime import timedelta
+
 from django.urls import reverse
 from rest_framework import status
+from rest_framework.request import Request
 from rest_framework.test import APIRequestFactory
-from rest_framework.test import APITestCase
+from rest_framework.test import APITestCase, APITransactionTestCase
 from rest_framework.test import APIClient
-from bridges_api.models import Question, UserProfile
-from bridges_api import recommendations
-
+from rest_framework.test import force_authenticate
+from bridges_api.models import (
+    Question, UserProfile, Tag, Employer, Position, Gender, QuestionActivity, DataFile,
+    DemographicContribution, IngestionJob
+)
+from bridges_api import views
+from bridges_api.serializers import QuestionSerializer, ValuesSerializer
+from bridges_api import benchmarks, ingestion, middleware, parser, recommendations, trending, user_import
+from bridges_api.middleware import route_stats
+from bridges_api.caching import LRUCache, model_versions, recommendation_cache
+from bridges_api.counters import ViewCounter, view_counter
+from bridges_api.search import trigram_index
+
+from django.contrib import admin
+from django.contrib.auth.hashers import check_password
 from django.contrib.auth.models import User
+from rest_framework.authtoken.models import Token
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.db import DatabaseError, connection, transaction
+from django.test import TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.text import slugify
+from django.utils.six import StringIO
 
 example_user_data = {
     "username": "testUser123",
@@ -64,6 +96,78 @@ class QuestionTests(APITestCase):
         self.assertEqual(returned_question['answer'], saved_question.answer)
         self.assertEqual(returned_question['number_of_views'], saved_question.number_of_views)
 
+    def test_count_views(self):
+        set_auth(self.bridges_client)
+        owner = UserProfile.objects.get(user=User.objects.get(username="testUser123"))
+        first = Question.objects.create(title='first', owner=owner, number_of_views=5)
+        second = Question.objects.create(title='second', owner=owner)
+
+        view_counter.clear()
+        self.bridges_client.get('/questions/%d/' % first.id)
+        self.bridges_client.get('/questions/%d/' % first.id)
+        self.assertEqual(view_counter.stats()['pending_views'], 2)
+        self.assertEqual(Question.objects.get(id=first.id).number_of_views, 5)
+        self.assertEqual(view_counter.flush(), 2)
+        self.assertEqual(Question.objects.get(id=first.id).number_of_views, 7)
+
+        # Reaching flush_size writes everything pending in one go, with one
+        # UPDATE for both questions since both got two views
+        counter = ViewCounter(flush_size=4, flush_interval=3600)
+        for question in (first, second, second):
+            counter.increment(question.id)
+        self.assertEqual(counter.stats()['pending_questions'], 2)
+        # savepoint, update, existing questions, activity, release
+        with self.assertNumQueries(5):
+            counter.increment(first.id)
+        self.assertEqual(Question.objects.get(id=first.id).number_of_views, 9)
+        self.assertEqual(Question.objects.get(id=second.id).number_of_views, 2)
+        stats = counter.stats()
+        self.assertEqual((stats['pending_views'], stats['flushes'], stats['flushed_views']),
+                         (0, 1, 4))
+
+        # A flush that fails is logged and doesn't fail the counted request
+        class FailingCounter(ViewCounter):
+            def flush(self):
+                raise DatabaseError('lock timeout')
+
+        counter = FailingCounter(flush_size=1, flush_interval=3600)
+        logging.disable(logging.CRITICAL)
+        try:
+            counter.increment(first.id)
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertEqual(counter.stats()['pending_views'], 1)
+
+    def test_trending(self):
+        set_auth(self.bridges_client)
+        profile = UserProfile.objects.get(user=User.objects.get(username="testUser123"))
+        old, viewed, popular = [Question.objects.create(title=title, owner=profile)
+                                for title in ('old', 'viewed', 'popular')]
+
+        # A bookmark three half lives ago is worth less than a view now
+        profile.bookmarks.add(old)
+        QuestionActivity.objects.update(created_at=timezone.now() - timedelta(
+            hours=3 * trending.HALF_LIFE_HOURS))
+        view_counter.clear()
+        for question in (viewed, popular, popular):
+            view_counter.increment(question.id)
+        view_counter.flush()
+        call_command('refresh_trending', stdout=StringIO())
+        self.assertFalse(QuestionActivity.objects.exists())
+
+        response = self.bridges_client.get('/questions/trending/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([question['title'] for question in response.json()['results']],
+                         ['popular', 'viewed', 'old'])
+
+        # Only the question with new activity is rescored
+        profile.bookmarks.remove(old)
+        profile.bookmarks.add(old)
+        self.assertEqual(trending.refresh_trending(), 1)
+        response = self.bridges_client.get('/questions/trending/')
+        self.assertEqual([question['title'] for question in response.json()['results']],
+                         ['old', 'popular', 'viewed'])
+
     def test_post_question(self):
         """
         Make sure that POST requests are not allowed (i.e questions can't be created)
@@ -120,6 +224,101 @@ class QuestionTests(APITestCase):
         returned_questions = response.json()['results']
         self.assertEqual(len(returned_questions), 0)
 
+    def test_paginate_recommendations(self):
+        """
+        Recommendations should span every page, not just the first 20 questions
+        """
+        set_auth(self.bridges_client)
+        owner = UserProfile.objects.get(user=User.objects.get(username='testUser123'))
+        for x in range(30):
+            Question.objects.create(title='title' + str(x), owner=owner)
+
+        first_page = self.bridges_client.get('/questions/').json()
+        self.assertEqual(first_page['count'], 30)
+        self.assertEqual(len(first_page['results']), 25)
+
+        second_page = self.bridges_client.get('/questions/', {'page': 2}).json()
+        self.assertEqual(len(second_page['results']), 5)
+
+        returned_ids = [question['id'] for question in
+                        first_page['results'] + second_page['results']]
+        self.assertEqual(returned_ids, sorted(returned_ids, reverse=True))
+
+    def test_search_ranking(self):
+        """
+        Title matches should rank above description and answer matches, and
+        every word of a query should match as a prefix
+        """
+        set_auth(self.bridges_client)
+        owner = UserProfile.objects.get(user=User.objects.get(username='testUser123'))
+        in_answer = Question.objects.create(title='Dress codes', owner=owner,
+                                            answer='Wear a suit to the interview')
+        in_title = Question.objects.create(title='Preparing for an interview', owner=owner)
+        Question.objects.create(title='Asking for a raise', owner=owner,
+                                description='Bring numbers to the meeting')
+
+        response = self.bridges_client.get('/questions/', {'search': 'interview'})
+        returned_ids = [question['id'] for question in response.json()['results']]
+        self.assertEqual(returned_ids, [in_title.id, in_answer.id])
+
+        response = self.bridges_client.get('/questions/', {'search': 'interv sui'})
+        returned_ids = [question['id'] for question in response.json()['results']]
+        self.assertEqual(returned_ids, [in_answer.id])
+
+        in_title.title = 'Preparing for a job fair'
+        in_title.save()
+        response = self.bridges_client.get('/questions/', {'search': 'interview'})
+        self.assertEqual(response.json()['count'], 1)
+
+        in_answer.delete()
+        response = self.bridges_client.get('/questions/', {'search': 'interview'})
+        self.assertEqual(response.json()['count'], 0)
+
+    def test_search_typos(self):
+        """
+        Misspelled searches should still find similar questions
+        """
+        trigram_index.clear()
+        set_auth(self.bridges_client)
+        owner = UserProfile.objects.get(user=User.objects.get(username='testUser123'))
+        interview = Question.objects.create(title='Preparing for an interview', owner=owner)
+        resume = Question.objects.create(title='Writing a resume', owner=owner,
+                                         answer='Keep your resume to one page')
+
+        response = self.bridges_client.get('/questions/', {'search': 'interveiw'})
+        returned_ids = [question['id'] for question in response.json()['results']]
+        self.assertEqual(returned_ids, [interview.id])
+
+        # The index is built now, so new questions have to reach it through signals
+        resume_help = Question.objects.create(title='Resume help', owner=owner)
+        response = self.bridges_client.get('/questions/', {'search': 'resumee'})
+        returned_ids = [question['id'] for question in response.json()['results']]
+        self.assertEqual(returned_ids, [resume_help.id, resume.id])
+
+        resume_help.delete()
+        response = self.bridges_client.get('/questions/', {'search': 'resumee'})
+        self.assertEqual(response.json()['count'], 1)
+
+        # Changes that never reach this process's receivers are caught up
+        # from the modified times and the question count
+        Question.objects.bulk_create([Question(title='Resume tips', owner=owner)])
+        Question.objects.filter(pk=resume.pk).update(title='Writing a cover letter',
+                                                     answer='', modified=timezone.now())
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM bridges_api_question WHERE id = %s', [interview.pk])
+        response = self.bridges_client.get('/questions/', {'search': 'resumee'})
+        self.assertEqual([question['title'] for question in response.json()['results']],
+                         ['Resume tips'])
+        response = self.bridges_client.get('/questions/', {'search': 'interveiw'})
+        self.assertEqual(response.json()['count'], 0)
+
+        stats = trigram_index.stats()
+        self.assertEqual(stats['questions'], 2)
+        self.assertTrue(stats['memory_bytes'] > 0)
+
+        response = self.bridges_client.get('/search-index/')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
 class UserTests(APITestCase):
     bridges_client = APIClient()
 
@@ -200,10 +399,66 @@ class UserTests(APITestCase):
         self.assertEqual(profile.first_name, 'Stefan')
         self.assertEqual(profile.last_name, 'Lance')
 
+    def test_import_users(self):
+        client = APIClient()
+        admin = User.objects.create_superuser('admin', 'admin@user.mail', 'adminPassword')
+        client.credentials(HTTP_AUTHORIZATION='Token ' + admin.auth_token.key)
+        rows = [dict(example_user_data, username='cohort' + str(x), ethnicity='asian')
+                for x in range(3)]
+
+        invalid = rows + [dict(example_user_data, username='cohort1'),
+                          dict(example_user_data, username='cohort9', gender='other')]
+        response = client.post('/users/import/', invalid, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(sorted(response.json()['errors']), ['2', '4', '5'])
+        self.assertFalse(User.objects.filter(username__startswith='cohort').exists())
+
+        response = client.post('/users/import/', rows, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        created = response.json()['created']
+        self.assertEqual([user['username'] for user in created], ['cohort0', 'cohort1', 'cohort2'])
+
+        profile = UserProfile.objects.get(user__username='cohort2')
+        self.assertTrue(profile.user.check_password('testPassword'))
+        self.assertEqual(profile.attribute_sets['ethnicity'], frozenset(['asian']))
+        client.credentials(HTTP_AUTHORIZATION='Token ' + created[2]['token'])
+        self.assertEqual(client.get('/user-info/').json()['username'], 'cohort2')
+
+        csv_file = tempfile.NamedTemporaryFile(suffix='.csv')
+        csv_file.write('username,password,gender,disabilities,first_name,last_name,email\n'
+                       'csvUser,csvPassword,female,deaf,CSV,User,csv@user.mail\n')
+        csv_file.flush()
+        call_command('import_users', csv_file.name, stdout=StringIO())
+        self.assertEqual(UserProfile.objects.get(user__username='csvUser').disabilities, 'deaf')
+
+        passwords = ['password%d' % x for x in range(25)]
+        self.assertTrue(check_password('password24', user_import.hash_passwords(passwords)[24]))
+        self.assertTrue(check_password('password24', user_import.hash_passwords(
+            passwords, multiprocessing.Pool, 2)[24]))
+
+        # A username taken after validation is a row error, not a server error
+        validate_rows = user_import.validate_rows
+        def validate_then_register(rows):
+            validated = validate_rows(rows)
+            User.objects.create_user(username='late1')
+            return validated
+        user_import.validate_rows = validate_then_register
+        try:
+            client.credentials(HTTP_AUTHORIZATION='Token ' + admin.auth_token.key)
+            response = client.post('/users/import/', [
+                dict(example_user_data, username='late' + str(x)) for x in range(3)
+            ], format='json')
+        finally:
+            user_import.validate_rows = validate_rows
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.json()['errors'], {
+            '2': {'username': ['A user with that username already exists.']}})
+        self.assertEqual(User.objects.filter(username__startswith='late').count(), 1)
+
 class RecommendationsTests(APITestCase):
     bridges_client = APIClient()
 
-    def test_insert(self):
+    def test_top_k(self):
         out_of_order = [("question17",17),("question16",16),("question15",15),
                         ("question17b",17),("question30",30),("question8",8),
                         ("question7",7),("question6",6),("question29",29),
@@ -215,27 +470,6 @@ class RecommendationsTests(APITestCase):
                         ("question9",9),("question4",4),("question26",26),
                         ("question25",25),("question24",24),("question14b",14),
                         ("question5",5)]
-        in_order = [('question14',14),('question14b',14),('question15',15),
-                         ('question16',16),('question17',17),('question17b',17),
-                         ('question17c',17),('question18',18),('question19',19),
-                         ('question20',20),('question21',21),('question22',22),
-                         ('question23',23),('question24',24),('question25',25),
-                         ('question26',26),('question27',27),('question28',28),
-                         ('question29',29),('question30',30)]
-        test_order = []
-        for q in out_of_order :
-            recommendations.insertQuestion(q,test_order)
-
-        self.assertEqual(in_order,test_order)
-
-    def test_removescores(self):
-        in_order = [('question14',14),('question14b',14),('question15',15),
-                         ('question16',16),('question17',17),('question17b',17),
-                         ('question17c',17),('question18',18),('question19',19),
-                         ('question20',20),('question21',21),('question22',22),
-                         ('question23',23),('question24',24),('question25',25),
-                         ('question26',26),('question27',27),('question28',28),
-                         ('question29',29),('question30',30)]
 
         in_order_just_questions = ['question30','question29','question28',
                         'question27','question26','question25','question24',
@@ -243,9 +477,201 @@ class RecommendationsTests(APITestCase):
                         'question19','question18','question17c','question17b',
                         'question17','question16','question15','question14b',
                         'question14']
-        remove_score_list = recommendations.removeScoresFromList(in_order)
 
-        self.assertEqual(in_order_just_questions, remove_score_list)
+        self.assertEqual(in_order_just_questions,
+                         recommendations.top_k(out_of_order, 20))
+        self.assertEqual(in_order_just_questions[:5],
+                         recommendations.top_k(reversed(out_of_order), 5))
+
+    def test_recommend_matches_full_scan(self):
+        """
+        The inverted index should rank questions exactly like scoring every
+        question's tags one by one does
+        """
+        set_auth(self.bridges_client)
+        profile = UserProfile.objects.get(user=User.objects.get(username='testUser123'))
+        profile.ethnicity = 'asian,hispanic'
+        profile.save()
+
+        tags = [Tag.objects.create(attribute='gender', value='male'),
+                Tag.objects.create(attribute='ethnicity', value='hispanic'),
+                Tag.objects.create(attribute='disabilities', value='n/a'),
+                Tag.objects.create(attribute='gender', value='female')]
+        for x in range(40):
+            question = Question.objects.create(title='title' + str(x), owner=profile)
+            question.tags.add(*[tag for i, tag in enumerate(tags) if (x + i) % (i + 2) == 0])
+
+        scored = []
+        for question in Question.objects.all():
+            score = 0
+            for tag in question.tags.all():
+                if tag.value in getattr(profile, tag.attribute).split(","):
+                    score += recommendations.attribute_weights[tag.attribute]
+            scored.append((question.id, score))
+        expected = [Question.objects.get(id=question_id)
+                    for question_id in recommendations.top_k(scored, len(scored))]
+
+        # materialized ids, questions, tags
+        with self.assertNumQueries(3):
+            recommended = recommendations.recommend(profile, Question)
+        self.assertEqual(expected[:20], recommended)
+
+        ranked = recommendations.RecommendedQuestions(profile, Question)
+        self.assertEqual(len(ranked), 40)
+        with self.assertNumQueries(3):
+            self.assertEqual(expected[20:35], ranked[20:35])
+
+    def test_lru_cache_eviction(self):
+        cache = LRUCache(max_size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual((cache.hits, cache.misses), (3, 1))
+
+    def test_materialized_recommendations(self):
+        """
+        Materialized rows should follow tag and profile changes, refreshing
+        only the profiles those changes affect
+        """
+        owner = User.objects.create_user(username='owner').userprofile
+        asian = Tag.objects.create(attribute='ethnicity', value='asian')
+        questions = [Question.objects.create(title='title' + str(x), owner=owner)
+                     for x in range(3)]
+        profiles = []
+        for x, ethnicity in enumerate(['asian', 'white,hispanic']):
+            profile = User.objects.create_user(username='user' + str(x)).userprofile
+            profile.ethnicity = ethnicity
+            profile.save()
+            profiles.append(profile)
+
+        call_command('materialize_recommendations', stdout=StringIO())
+        untouched = list(profiles[1].recommended_questions.values_list('id', flat=True))
+
+        questions[0].tags.add(asian)
+        self.assertEqual(profiles[0].recommended_questions.first().question, questions[0])
+        self.assertEqual(untouched,
+                         list(profiles[1].recommended_questions.values_list('id', flat=True)))
+
+        profiles[1].ethnicity = 'white,asian'
+        profiles[1].save()
+        with self.assertNumQueries(4):
+            recommended = recommendations.recommend(profiles[1], Question)
+        self.assertEqual(recommended, [questions[0], questions[2], questions[1]])
+
+        questions[0].tags.remove(asian)
+        self.assertEqual(recommendations.recommend(profiles[0], Question), questions[::-1])
+
+    def test_new_question_recommendations(self):
+        """
+        New questions should be slotted into the materialized lists where a
+        full re-ranking would put them, and saving a profile without
+        changing its attributes shouldn't re-rank it
+        """
+        materialized = lambda profile: list(profile.recommended_questions.values_list(
+            'question_id', 'score'))
+        owner = User.objects.create_user(username='owner').userprofile
+        asian = Tag.objects.create(attribute='ethnicity', value='asian')
+        profiles = []
+        for x, ethnicity in enumerate(['asian', 'white', '']):
+            profile = User.objects.create_user(username='user' + str(x)).userprofile
+            profile.ethnicity = ethnicity
+            profile.save()
+            profiles.append(profile)
+
+        limit = recommendations.MATERIALIZED_RECOMMENDATIONS
+        recommendations.MATERIALIZED_RECOMMENDATIONS = 4
+        try:
+            for x in range(8):
+                question = Question.objects.create(title='title' + str(x), owner=owner)
+                if x in (1, 2, 6):
+                    question.tags.add(asian)
+                expected = recommendations.batch_rank(profiles, Question, 4)
+                for profile in profiles:
+                    self.assertEqual(materialized(profile), expected[profile.pk])
+        finally:
+            recommendations.MATERIALIZED_RECOMMENDATIONS = limit
+
+        row_ids = list(profiles[0].recommended_questions.values_list('id', flat=True))
+        profiles[0].first_name = 'Renamed'
+        profiles[0].save()
+        self.assertEqual(row_ids,
+                         list(profiles[0].recommended_questions.values_list('id', flat=True)))
+
+    def test_profile_attributes(self):
+        """
+        The indexed attribute rows should follow the profile's strings
+        """
+        profile = User.objects.create_user(username='user').userprofile
+        other = User.objects.create_user(username='other').userprofile
+        profile.ethnicity = 'asian,white'
+        profile.disabilities = 'deaf'
+        profile.save()
+        self.assertEqual(profile.attribute_sets['ethnicity'], frozenset(['asian', 'white']))
+        self.assertEqual(sorted(profile.attribute_values.values_list('attribute', 'value')),
+                         [('disabilities', 'deaf'), ('ethnicity', 'asian'),
+                          ('ethnicity', 'white')])
+
+        profile.ethnicity = 'white,hispanic'
+        self.assertEqual(profile.attribute_sets['ethnicity'], frozenset(['white', 'hispanic']))
+        kept = profile.attribute_values.get(value='white').pk
+        profile.save()
+        self.assertEqual(profile.attribute_values.get(value='white').pk, kept)
+        self.assertFalse(profile.attribute_values.filter(value='asian').exists())
+
+        tags = [Tag(attribute='ethnicity', value='hispanic'),
+                Tag(attribute='disabilities', value='blind')]
+        self.assertEqual(recommendations.profiles_matching_tags(tags), [profile])
+        other.disabilities = 'blind'
+        other.save()
+        self.assertEqual(sorted(profile.pk for profile in
+                                recommendations.profiles_matching_tags(tags)),
+                         sorted([profile.pk, other.pk]))
+
+    def test_batch_recommend(self):
+        """
+        Scoring a whole cohort at once should agree with recommending to
+        each member on their own
+        """
+        owner = User.objects.create_user(username='owner').userprofile
+        profiles = []
+        for x, ethnicity in enumerate(['asian', 'hispanic', 'asian,white', '']):
+            profile = User.objects.create_user(username='user' + str(x)).userprofile
+            profile.ethnicity = ethnicity
+            profile.disabilities = 'deaf' if x % 2 else ''
+            profile.save()
+            profiles.append(profile)
+
+        tags = [Tag.objects.create(attribute='ethnicity', value='asian'),
+                Tag.objects.create(attribute='ethnicity', value='white'),
+                Tag.objects.create(attribute='disabilities', value='deaf')]
+        for x in range(30):
+            question = Question.objects.create(title='title' + str(x), owner=owner)
+            question.tags.add(*tags[x % 4:])
+
+        recommended = recommendations.batch_recommend(profiles, Question, k=10)
+        for profile in profiles:
+            expected = recommendations.recommend(profile, Question, limit=10)
+            self.assertEqual(recommended[profile.pk], [question.id for question in expected])
+
+    def test_benchmark_corpus_and_baseline(self):
+        generator = benchmarks.CorpusGenerator(seed=1)
+        generator.create_tags()
+        profiles = generator.create_users(5)
+        generator.grow_questions(60, profiles[0])
+        self.assertEqual(Question.objects.count(), 60)
+        self.assertTrue(all(question.tags.exists() for question in Question.objects.all()))
+
+        results = {'60': benchmarks.measure_recommend(profiles[:2])}
+        self.assertEqual(benchmarks.compare_to_baseline(results, results), [])
+
+        slower = {'60': dict(results['60'], queries=results['60']['queries'] + 1,
+                             cold_ms={'p50': results['60']['cold_ms']['p50'] + 50})}
+        self.assertEqual(len(benchmarks.compare_to_baseline(slower, results)), 2)
 
 class BookmarkTests(APITestCase):
     bridges_client = APIClient()
@@ -303,7 +729,672 @@ class BookmarkTests(APITestCase):
         response = self.bridges_client.get('/bookmarks/')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         # Response should contain the questions associated with that user's bookmarks
+        results = response.json()
+        self.assertEqual(results['count'], 5)
+        self.assertEqual(sorted(question['title'] for question in results['results']),
+                         ['title' + str(x) for x in range(1, 6)])
 
+        response = self.bridges_client.get('/bookmarks/', {'ids_only': 'true', 'page_size': 2})
+        results = response.json()
+        self.assertEqual(results['count'], 5)
+        self.assertEqual(len(results['results']), 2)
+
+    def test_bookmark_deltas(self):
+        set_auth(self.bridges_client)
+        owner = UserProfile.objects.get(user=User.objects.get(username='testUser123'))
+        for x in range(1, 6):
+            Question.objects.create(id=x, title='title' + str(x), owner=owner)
+        owner.bookmarks.add(1, 2)
+
+        response = self.bridges_client.patch('/bookmarks/', {'bookmarks': [2, 3, 4]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(sorted(owner.bookmarks.values_list('id', flat=True)), [1, 2, 3, 4])
+
+        # Bookmarking a question that doesn't exist adds nothing
+        response = self.bridges_client.patch('/bookmarks/', {'bookmarks': [5, 99]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(response.json()['missing'], [99])
+        self.assertEqual(owner.bookmarks.count(), 4)
+
+        response = self.bridges_client.delete('/bookmarks/', {'bookmarks': [1, 4]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(sorted(owner.bookmarks.values_list('id', flat=True)), [2, 3])
+
+        response = self.bridges_client.delete('/bookmarks/', {}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        for method in (self.bridges_client.post, self.bridges_client.patch,
+                       self.bridges_client.delete):
+            response = method('/bookmarks/', [1, 4], format='json')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        # Setting bookmarks only touches the rows that change
+        through = UserProfile.bookmarks.through
+        kept = through.objects.get(question_id=3)
+        self.bridges_client.post('/bookmarks/', {'bookmarks': [3, 5]}, format='json')
+        self.assertEqual(sorted(owner.bookmarks.values_list('id', flat=True)), [3, 5])
+        self.assertEqual(through.objects.get(question_id=3).id, kept.id)
+
+
+def legacy_parse_demographic_data(csvFile):
+    """
+    parse_demographic_data as it was before it became a single pass, to
+    check the rewrite against
+    """
+    data = csv.DictReader(csvFile)
+    params = parser.params
+    keys = {'employer', 'position', 'ethnicity', 'gender'}
+    sets = {k : set() for k in keys}
+    avgs = {k : {} for k in keys}
+    counts = {k : {} for k in keys}
+
+    for row in data:
+        for key in sets.keys():
+            val = row[params[key]]
+            if len(val) > 0:
+                sets[key].add(val)
+
+            if len(row[params['wage']]) > 0:
+                try:
+                    salary = float(row[params['wage']])
+                except ValueError:
+                    continue
+                for key in avgs.keys():
+                    val = row[params[key]]
+                    if val in avgs[key].keys():
+                        avgs[key][val] += salary
+                        counts[key][val] += 1
+                    else:
+                        avgs[key][val] = salary
+                        counts[key][val] = 1
+
+    for k in counts.keys():
+        for l in counts[k].keys():
+            if counts[k][l] > 0:
+                avgs[k][l] /= counts[k][l]
+
+    return sets, avgs, counts
+
+def demographic_csv(rows, seed=0):
+    """
+    A wage export with rows random rows, including blank values and wages
+    that don't parse
+    """
+    rng = random.Random(seed)
+    out = StringIO()
+    writer = csv.writer(out)
+    writer.writerow(['Employer Name', 'Position Title', 'Ethnicity', 'Gender',
+                     'Starting Wage', 'Ending Wage'])
+    for _ in range(rows):
+        writer.writerow([
+            rng.choice(['', 'Acme', 'Globex', 'Initech']),
+            rng.choice(['', 'Clerk', 'Cook', 'Driver', 'Welder']),
+            rng.choice(['', 'asian', 'black', 'hispanic', 'white']),
+            rng.choice(['', 'male', 'female']),
+            '10',
+            rng.choice(['', 'n/a', str(rng.uniform(8, 40)), str(rng.randint(8, 40))]),
+        ])
+    return out.getvalue()
 
 class ParticipantAttributeTests(APITestCase):
     bridges_client = APIClient()
+
+    def test_parse_demographic_data_matches_legacy(self):
+        for rows in (0, 1, 500):
+            contents = demographic_csv(rows, seed=rows)
+            self.assertEqual(parser.parse_demographic_data(StringIO(contents)),
+                             legacy_parse_demographic_data(StringIO(contents)))
+
+    def test_parse_in_shards(self):
+        # Quoted line breaks and quotes in every seventh record, so that some
+        # shard targets fall inside them
+        rows = list(csv.reader(StringIO(demographic_csv(3000, seed=4))))
+        for row in rows[1::7]:
+            row[0] = 'Acme\n"North", %d\nLLC' % len(row[0])
+            row[1] = row[1] and row[1] + '\nsenior'
+        out = StringIO()
+        csv.writer(out).writerows(rows)
+        data_file = tempfile.NamedTemporaryFile(suffix='.csv')
+        self.addCleanup(data_file.close)
+        data_file.write(out.getvalue())
+        data_file.flush()
+
+        serial = parser.parse_demographic_data(StringIO(out.getvalue()))
+        sharded = parser.parse_demographic_file(data_file.name, shards=5, serial_below=0)
+        self.assertEqual(sharded[0], serial[0])
+        self.assertEqual(sharded[2], serial[2])
+        for key in parser.demographic_keys:
+            self.assertEqual(sorted(sharded[1][key]), sorted(serial[1][key]))
+            for value, average in serial[1][key].items():
+                self.assertAlmostEqual(sharded[1][key][value], average)
+
+        progress = []
+        serial = parser.parse_salary_statistics(StringIO(out.getvalue()))
+        sharded = parser.parse_salary_statistics_file(data_file.name, progress.append,
+                                                      shards=5, serial_below=0)
+        self.assertEqual(progress[-1], 3000)
+        for key in parser.demographic_keys:
+            self.assertEqual(sorted(sharded[key]), sorted(serial[key]))
+            for value, stats in serial[key].items():
+                self.assertEqual(vars(sharded[key][value]), vars(stats))
+
+        # Every participant counts once, whatever parse_demographic_data does
+        stats = parser.parse_salary_statistics(StringIO(
+            'Employer Name,Position Title,Ethnicity,Gender,Starting Wage,Ending Wage\n'
+            'Acme,Cook,asian,male,10,12\n'))['position']['Cook']
+        self.assertEqual((stats.count, stats.total, stats.total_squares), (1, 12, 144))
+
+    def expected_stats(self, *files):
+        """
+        The stats of every position in files, as they should be stored
+        """
+        stats = {}
+        for contents in files:
+            for name, salary_stats in parser.parse_salary_statistics(
+                    StringIO(contents))['position'].items():
+                contribution = DemographicContribution.from_stats(
+                    None, 'position', slugify(name), salary_stats, name)
+                row = stats.setdefault(contribution.slug, Position(
+                    num_participants=0, salary_sum=0, salary_sum_squares=0))
+                row.add_stats(contribution)
+        return dict((slug, [getattr(row, name) for name in Position.stats_fields])
+                    for slug, row in stats.items())
+
+    def stored_stats(self):
+        return dict((row.slug, [getattr(row, name) for name in Position.stats_fields])
+                    for row in Position.objects.all())
+
+    def upload(self, contents, name):
+        """
+        Saves a data file and runs its ingestion job, returning its summary
+        """
+        data_file = DataFile.objects.create(data_file=ContentFile(contents, name=name))
+        self.assertEqual(data_file.ingestion_job.status, IngestionJob.QUEUED)
+        ingestion.run_pending(processes=1)
+        return data_file, json.loads(IngestionJob.objects.get(data_file=data_file).summary)
+
+    @override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+    def test_demographic_statistics_merge(self):
+        first_contents = demographic_csv(200, seed=1)
+        second_contents = demographic_csv(100, seed=2) + 'Acme,Baker,asian,male,10,99.5\n'
+        first, summary = self.upload(first_contents, 'first.csv')
+        self.assertEqual(summary['position'], {'inserted': 4, 'updated': 0})
+        second, summary = self.upload(second_contents, 'second.csv')
+        self.assertEqual(summary['position'], {'inserted': 1, 'updated': 4})
+        self.assertEqual(self.stored_stats(), self.expected_stats(first_contents, second_contents))
+
+        first.delete()
+        self.assertEqual(self.stored_stats(), self.expected_stats(second_contents))
+        second.delete()
+        self.assertFalse(Position.objects.exists())
+
+    @override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+    def test_hand_entered_statistics(self):
+        """
+        Values entered in the admin outlast the files that add to them
+        """
+        Position.objects.create(name='Clerk', avg_salary='12', num_participants=5)
+        hand_entered = self.stored_stats()['clerk']
+        data_file, summary = self.upload(demographic_csv(200, seed=9), 'wages.csv')
+        self.assertEqual(summary['position']['updated'], 1)
+        data_file.delete()
+        self.assertEqual(self.stored_stats()['clerk'], hand_entered)
+
+        Position.objects.get(slug='clerk').delete()
+        self.assertFalse(DemographicContribution.objects.filter(slug='clerk').exists())
+
+        position_admin = admin.site._registry[Position]
+        cook = Position.objects.create(name='Cook', avg_salary='14', num_participants=2)
+        self.assertIn('num_participants', position_admin.get_readonly_fields(None, cook))
+        self.assertNotIn('num_participants', position_admin.get_readonly_fields(None))
+
+    @override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+    def test_ingestion_jobs(self):
+        client = APIClient()
+        admin = User.objects.create_superuser('admin', 'admin@user.mail', 'adminPassword')
+        client.credentials(HTTP_AUTHORIZATION='Token ' + admin.auth_token.key)
+
+        self.upload(demographic_csv(2500, seed=3), 'wages.csv')
+        DataFile.objects.create(data_file=ContentFile('Name\nSmith\n', name='names.csv'))
+        self.assertEqual(ingestion.run_pending(processes=1), 1)
+
+        jobs = client.get('/ingestion-jobs/').json()['results']
+        self.assertEqual([job['status'] for job in jobs], ['failed', 'done'])
+        self.assertIn('KeyError', jobs[0]['error'])
+        self.assertEqual(jobs[1]['rows_processed'], 2500)
+        self.assertGreater(jobs[1]['throughput'], 0)
+        self.assertEqual(jobs[1]['summary']['gender']['inserted'], 2)
+        self.assertEqual(client.get('/ingestion-jobs/%d/' % jobs[1]['id']).json(), jobs[1])
+        self.assertEqual(self.bridges_client.get('/ingestion-jobs/').status_code,
+                         status.HTTP_401_UNAUTHORIZED)
+
+class IngestionWorkerTests(TransactionTestCase):
+    """
+    A transaction test case, since the pooled workers run in processes of
+    their own and only see committed rows
+    """
+    @override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+    def test_run_pending_in_pool(self):
+        resaved = DataFile.objects.create(data_file=ContentFile(
+            demographic_csv(300, seed=4), name='resaved.csv'))
+        superseded = resaved.ingestion_job
+        resaved.save()
+        other = DataFile.objects.create(data_file=ContentFile(
+            demographic_csv(300, seed=5), name='other.csv'))
+        # Its worker died an hour ago
+        stale = DataFile.objects.create(data_file=ContentFile(
+            demographic_csv(300, seed=6), name='stale.csv'))
+        hour_ago = timezone.now() - timedelta(hours=1)
+        IngestionJob.objects.filter(pk=stale.ingestion_job.pk).update(
+            status=IngestionJob.RUNNING, started_at=hour_ago, heartbeat_at=hour_ago)
+
+        self.assertEqual(ingestion.run_pending(processes=2), 3)
+        statuses = dict(IngestionJob.objects.values_list('id', 'status'))
+        self.assertEqual(statuses, {
+            superseded.pk: IngestionJob.SUPERSEDED,
+            resaved.ingestion_job.pk: IngestionJob.DONE,
+            other.ingestion_job.pk: IngestionJob.DONE,
+            stale.ingestion_job.pk: IngestionJob.DONE,
+        })
+        self.assertEqual(IngestionJob.objects.get(pk=stale.ingestion_job.pk).rows_processed, 300)
+
+        # Files big enough to shard are ingested outside the pool
+        serial_below, shards = parser.SERIAL_BELOW_BYTES, parser.SHARDS
+        parser.SERIAL_BELOW_BYTES, parser.SHARDS = 10000, 3
+        try:
+            large = DataFile.objects.create(data_file=ContentFile(
+                demographic_csv(700, seed=7), name='large.csv'))
+            small = DataFile.objects.create(data_file=ContentFile(
+                demographic_csv(10, seed=8), name='small.csv'))
+            self.assertTrue(ingestion.is_large(large))
+            self.assertFalse(ingestion.is_large(small))
+            self.assertEqual(ingestion.run_pending(processes=2), 2)
+
+            progress = []
+            large.ingest(progress.append)
+        finally:
+            parser.SERIAL_BELOW_BYTES, parser.SHARDS = serial_below, shards
+        self.assertEqual(len(progress), 3)
+        self.assertEqual(progress[-1], 700)
+        for data_file in (large, small):
+            job = IngestionJob.objects.get(data_file=data_file)
+            self.assertEqual(job.status, IngestionJob.DONE)
+        self.assertEqual(IngestionJob.objects.get(data_file=large).rows_processed, 700)
+
+        # A job whose data file is already being ingested waits its turn
+        IngestionJob.objects.filter(pk=resaved.ingestion_job.pk).update(
+            status=IngestionJob.RUNNING, heartbeat_at=timezone.now())
+        resaved.save()
+        self.assertEqual(ingestion.run_pending(processes=2), 0)
+        self.assertEqual(IngestionJob.objects.get(pk=resaved.ingestion_job.pk).status,
+                         IngestionJob.QUEUED)
+
+class ViewCounterThreadTests(TransactionTestCase):
+    """
+    A transaction test case, since the flushing thread has a connection of
+    its own and only sees committed rows
+    """
+    def test_flushes_from_one_thread(self):
+        owner = User.objects.create_user(username='owner').userprofile
+        question = Question.objects.create(title='question', owner=owner)
+        counter = ViewCounter(flush_size=100, flush_interval=0.05)
+        counter.start()
+        try:
+            thread = counter._thread
+            for _ in range(3):
+                counter.increment(question.id)
+                deadline = time.time() + 5
+                while counter.stats()['pending_views'] and time.time() < deadline:
+                    time.sleep(0.01)
+            self.assertIs(counter._thread, thread)
+        finally:
+            counter.stop()
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(Question.objects.get(id=question.id).number_of_views, 3)
+
+class RecommendationCacheTests(APITransactionTestCase):
+    """
+    A transaction test case, since the corpus version is only bumped once
+    the change commits
+    """
+    bridges_client = APIClient()
+
+    def test_recommendation_cache_invalidation(self):
+        """
+        Repeat recommendations should skip scoring until the profile or the
+        question corpus changes
+        """
+        set_auth(self.bridges_client)
+        profile = UserProfile.objects.get(user=User.objects.get(username='testUser123'))
+        question = Question.objects.create(title='title', owner=profile)
+        tag = Tag.objects.create(attribute='gender', value='female')
+        other_question = Question.objects.create(title='title2', owner=profile)
+        other_question.tags.add(tag)
+
+        ranking = recommendations.get_ranking(profile, Question)
+        # Only the corpus version
+        with self.assertNumQueries(1):
+            self.assertIs(recommendations.get_ranking(profile, Question), ranking)
+
+        profile.gender = 'female'
+        profile.save()
+        ranking = recommendations.get_ranking(profile, Question)
+        self.assertEqual(ranking.top(Question, 2), [other_question.id, question.id])
+
+        with transaction.atomic():
+            question.tags.add(tag)
+            # Not before the change commits
+            self.assertIs(recommendations.get_ranking(profile, Question), ranking)
+        ranking = recommendations.get_ranking(profile, Question)
+        self.assertEqual(ranking.scores, {question.id: 3, other_question.id: 3})
+
+        # Another worker's change reaches this one through the shared version
+        model_versions.increment(recommendation_cache.corpus_label)
+        self.assertIsNot(recommendations.get_ranking(profile, Question), ranking)
+
+class QueryCountTests(APITestCase):
+    bridges_client = APIClient()
+
+    def authenticate(self):
+        """
+        Logs in, so that authenticating the requests below takes the one
+        query loading the token, user and profile
+        """
+        set_auth(self.bridges_client)
+
+    def add_questions(self, count):
+        owner = UserProfile.objects.get(user=User.objects.get(username='testUser123'))
+        tags = [Tag.objects.get_or_create(attribute='gender', value='male')[0],
+                Tag.objects.get_or_create(attribute='ethnicity', value='n/a')[0]]
+        questions = []
+        for x in range(count):
+            question = Question.objects.create(title='title' + str(x), owner=owner)
+            question.tags.add(*tags)
+            questions.append(question)
+        return questions
+
+    def assertConstantQueries(self, num, path, data=None):
+        """
+        Serializing more questions should not take more queries
+        """
+        for count in (2, 10):
+            self.add_questions(count)
+            with self.assertNumQueries(num):
+                response = self.bridges_client.get(path, data)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_question_list_queries(self):
+        self.authenticate()
+        # token, count, materialized ids, questions, tags
+        self.assertConstantQueries(5, '/questions/')
+        # token, search count, ranked ids, questions, tags
+        self.assertConstantQueries(5, '/questions/', {'search': 'title'})
+
+    def test_question_detail_queries(self):
+        self.authenticate()
+        question = self.add_questions(1)[0]
+        # token, question with its owner, tags
+        with self.assertNumQueries(3):
+            self.bridges_client.get('/questions/%d/' % question.id)
+
+    def test_bookmarks_queries(self):
+        self.authenticate()
+        profile = UserProfile.objects.get(user=User.objects.get(username='testUser123'))
+        for count in (2, 10):
+            profile.bookmarks.add(*self.add_questions(count))
+            # token, count, bookmarked ids, questions, tags
+            with self.assertNumQueries(5):
+                self.bridges_client.get('/bookmarks/')
+
+    def test_employer_detail_queries(self):
+        employer = Employer.objects.create(name='Employer')
+        self.authenticate()
+        for count in (2, 10):
+            employer.questions.add(*self.add_questions(count))
+            # token, employer, question ids
+            with self.assertNumQueries(3):
+                self.bridges_client.get('/employers/%d/' % employer.id)
+
+    @override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+    def test_data_file_admin_queries(self):
+        admin = User.objects.create_superuser('admin', 'admin@user.mail', 'adminPassword')
+        self.client.force_login(admin)
+        counts = []
+        for x in range(2):
+            DataFile.objects.create(data_file=ContentFile('a,b\n', name='wages.csv'))
+            DataFile.objects.create(data_file=ContentFile('a,b\n', name='wages.csv'))
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get('/admin/bridges_api/datafile/')
+            self.assertContains(response, 'Queued')
+            counts.append(len(queries))
+        self.assertEqual(counts[0], counts[1])
+
+    def test_sql_instrumentation(self):
+        self.authenticate()
+        self.add_questions(3)
+        route_stats.clear()
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        logger = logging.getLogger('bridges_api.sql')
+        logger.addHandler(handler)
+        send_headers, slow_request_ms = middleware.SEND_HEADERS, middleware.SLOW_REQUEST_MS
+        middleware.SEND_HEADERS, middleware.SLOW_REQUEST_MS = True, 0
+        try:
+            with CaptureQueriesContext(connection) as captured:
+                response = self.bridges_client.get('/questions/')
+        finally:
+            middleware.SEND_HEADERS, middleware.SLOW_REQUEST_MS = send_headers, slow_request_ms
+            logger.removeHandler(handler)
+
+        self.assertEqual(response['X-SQL-Queries'], str(len(captured)))
+        self.assertEqual(route_stats.stats()['question-list']['queries'], len(captured))
+        logged = json.loads(records[0].getMessage().split(' ', 2)[2])
+        self.assertEqual((logged['route'], logged['queries']), ('question-list', len(captured)))
+        self.assertEqual(len(logged['slowest']), 3)
+
+    def test_token_authentication(self):
+        set_auth(self.bridges_client)
+        # token, user and profile in one query
+        with self.assertNumQueries(1):
+            response = self.bridges_client.get('/user-info/')
+        self.assertEqual(response.json()['username'], 'testUser123')
+
+        # Changes made anywhere show on the next request
+        profile = UserProfile.objects.get(user__username='testUser123')
+        UserProfile.objects.filter(pk=profile.pk).update(first_name='Changed')
+        response = self.bridges_client.get('/user-info/')
+        self.assertEqual(response.json()['first_name'], 'Changed')
+
+        User.objects.filter(pk=profile.user_id).update(is_superuser=True)
+        self.assertEqual(self.bridges_client.get('/ingestion-jobs/').status_code,
+                         status.HTTP_200_OK)
+        User.objects.filter(pk=profile.user_id).update(is_superuser=False)
+        self.assertNotEqual(self.bridges_client.get('/ingestion-jobs/').status_code,
+                            status.HTTP_200_OK)
+
+        Token.objects.filter(user=profile.user).delete()
+        response = self.bridges_client.get('/user-info/')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_sparse_fields(self):
+        self.authenticate()
+        question = self.add_questions(3)[0]
+        owner_id = question.owner_id
+
+        # token, count, materialized ids, questions
+        with CaptureQueriesContext(connection) as captured:
+            response = self.bridges_client.get('/questions/', {'fields': 'id,title'})
+        self.assertEqual(len(captured), 4)
+        self.assertNotIn('description', captured.captured_queries[-1]['sql'])
+        self.assertEqual(set(response.json()['results'][0]), set(['id', 'title']))
+
+        response = self.bridges_client.get('/questions/', {'fields': 'title,owner'})
+        self.assertEqual(response.json()['results'][0]['owner'], owner_id)
+        response = self.bridges_client.get('/questions/', {'fields': 'title,owner',
+                                                           'expand': 'owner'})
+        self.assertEqual(response.json()['results'][0]['owner']['username'], 'testUser123')
+
+        # token, just the question
+        with self.assertNumQueries(2):
+            response = self.bridges_client.get('/questions/%d/' % question.id,
+                                               {'fields': 'title,owner'})
+        self.assertEqual(response.json(), {'title': question.title, 'owner': owner_id})
+        with self.assertNumQueries(2):
+            response = self.bridges_client.get('/questions/%d/' % question.id,
+                                               {'fields': 'title,owner', 'expand': 'owner'})
+        self.assertEqual(response.json()['owner']['user_id'], owner_id)
+
+    def walk_cursor(self, path, page_size):
+        """
+        Follows the next links of a cursor paginated list, returning every
+        page and the queries each one took
+        """
+        pages = []
+        url, data = path, {'cursor': '', 'page_size': page_size}
+        while url:
+            with CaptureQueriesContext(connection) as captured:
+                response = self.bridges_client.get(url, data)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertNotIn('count', response.data)
+            pages.append((response.data['results'], captured.captured_queries))
+            url, data = response.data['next'], None
+        return pages
+
+    def test_cursor_pagination(self):
+        self.authenticate()
+        questions = self.add_questions(25)
+
+        pages = self.walk_cursor('/questions/', 10)
+        self.assertEqual([len(results) for results, queries in pages], [10, 10, 5])
+        self.assertEqual(sorted(question['id'] for results, queries in pages
+                                for question in results),
+                         sorted(question.id for question in questions))
+        # Full pages of recommendations never count the questions
+        for results, queries in pages[:2]:
+            self.assertFalse([query for query in queries if 'COUNT(' in query['sql']])
+        response = self.bridges_client.get('/questions/', {'cursor': base64.b64encode('p=-10')})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+        pages = self.walk_cursor('/tags/', 1)
+        self.assertEqual([results for results, queries in pages],
+                         [[{'attribute': 'gender', 'value': 'male'}],
+                          [{'attribute': 'ethnicity', 'value': 'n/a'}]])
+        for results, queries in pages:
+            self.assertFalse([query for query in queries if 'COUNT(' in query['sql']])
+
+class ConditionalGetTests(APITransactionTestCase):
+    """
+    A transaction test case, since ETag versions are only bumped once the
+    change commits
+    """
+    bridges_client = APIClient()
+
+    def authenticate(self):
+        set_auth(self.bridges_client)
+
+    def test_conditional_get(self):
+        self.authenticate()
+        for x in range(10):
+            Tag.objects.create(attribute='position', value='position' + str(x))
+
+        response = self.bridges_client.get('/tags/', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        etag = response['ETag']
+        self.assertTrue(etag.startswith('W/'))
+
+        # token, the versions of the listed models
+        with self.assertNumQueries(2):
+            response = self.bridges_client.get('/tags/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        # Other pages and other lists have their own ETags
+        response = self.bridges_client.get('/tags/', {'page_size': 2}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.bridges_client.get('/employers/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        Tag.objects.create(attribute='position', value='new')
+        response = self.bridges_client.get('/tags/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()['count'], 11)
+
+        # A change that is rolled back keeps the ETag
+        etag = response['ETag']
+        try:
+            with transaction.atomic():
+                Tag.objects.create(attribute='position', value='rolled back')
+                raise DatabaseError
+        except DatabaseError:
+            pass
+        response = self.bridges_client.get('/tags/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        # Bad credentials are still turned away
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION='Token invalid')
+        response = client.get('/tags/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class ValuesRenderingTests(APITestCase):
+    factory = APIRequestFactory()
+
+    def assertSameJSON(self, view_class, path, data=None, user=None):
+        """
+        The values() rendering should produce the very same bytes as the
+        serializer does
+        """
+        responses = []
+        for values_rendering in (True, False):
+            request = self.factory.get(path, data)
+            force_authenticate(request, user=user)
+            view = view_class.as_view(values_rendering=values_rendering)
+            responses.append(view(request).render().content)
+        self.assertEqual(responses[0], responses[1])
+        return responses[0]
+
+    def test_values_rendering_matches_serializers(self):
+        user = User.objects.create_user(username='user')
+        profile = user.userprofile
+        profile.date_of_birth = '1990-05-01'
+        profile.profile_picture = 'profile_pictures/user.png'
+        profile.ethnicity = 'asian'
+        profile.save()
+
+        tags = [Tag.objects.create(attribute='ethnicity', value='asian'),
+                Tag.objects.create(attribute='gender', value='female')]
+        questions = []
+        for x in range(5):
+            question = Question.objects.create(title='title' + str(x), owner=profile,
+                                               answer='answer', number_of_views=x)
+            question.tags.add(*tags[:x % 3])
+            questions.append(question)
+        employer = Employer.objects.create(name='Employer', rating=4, averagesalary='1234.5')
+        employer.questions.add(*questions[:3])
+        Employer.objects.create(name='Nobody')
+        Position.objects.create(name='Cashier', avg_salary='10.5', num_participants=3)
+        Gender.objects.create(name='Female', avg_salary='11', num_participants=4)
+
+        content = self.assertSameJSON(views.QuestionList, '/questions/', user=user)
+        self.assertIn(b'"profile_picture":"http://testserver/static/media/profile_pictures/user.png"',
+                      content)
+        # The compiled fields are shared, but the URLs follow each request
+        request = self.factory.get('/questions/', SERVER_NAME='other')
+        force_authenticate(request, user=user)
+        self.assertIn(b'"profile_picture":"http://other/static/media/profile_pictures/user.png"',
+                      views.QuestionList.as_view()(request).render().content)
+        compiled = ValuesSerializer.for_serializer(QuestionSerializer)
+        self.assertIs(ValuesSerializer.for_serializer(QuestionSerializer, Request(request)),
+                      compiled)
+        self.assertIsNot(ValuesSerializer.for_serializer(QuestionSerializer, Request(
+            self.factory.get('/questions/', {'fields': 'id'}))), compiled)
+        self.assertSameJSON(views.QuestionList, '/questions/', {'search': 'title'}, user=user)
+        self.assertSameJSON(views.QuestionList, '/questions/', {'search': 'titel'}, user=user)
+        self.assertSameJSON(views.TagList, '/tags/')
+        self.assertIn(b'"averagesalary":"1234.50"',
+                      self.assertSameJSON(views.EmployerList, '/employers/'))
+        self.assertSameJSON(views.PositionList, '/positions/')
+        self.assertSameJSON(views.GenderList, '/genders/')
+        self.assertSameJSON(views.EthnicityList, '/ethnicities/')
+        self.assertSameJSON(views.DisabilityList, '/disabilities/')
@@ -0,0 +1,95 @@
+"""
+The "popular right now" ranking. Each view or bookmark adds
+weight * 2 ** (hours since EPOCH / half life) to the score of its question,
+which orders questions exactly as decaying every score by 2 ** (-age / half
+life) would, but never touches a question without new activity. Scores are
+stored as the base 2 logarithm of that sum so that they can't overflow.
+"""
+import math
+from datetime import datetime
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from bridges_api.models import QuestionActivity, TrendingQuestion
+
+HALF_LIFE_HOURS = getattr(settings, 'TRENDING_HALF_LIFE_HOURS', 24)
+VIEW_WEIGHT = 1
+BOOKMARK_WEIGHT = 5
+EPOCH = datetime(2017, 1, 1, tzinfo=timezone.utc)
+REFRESH_BATCH_SIZE = 500
+
+def log_score(weight, when):
+    """
+    The base 2 logarithm of what weight, gained at when, adds to a score
+    """
+    return math.log(weight, 2) + (when - EPOCH).total_seconds() / 3600.0 / HALF_LIFE_HOURS
+
+def log_add(a, b):
+    """
+    log2(2 ** a + 2 ** b), without ever computing 2 ** a
+    """
+    if a is None:
+        return b
+    high, low = max(a, b), min(a, b)
+    return high + math.log(1 + 2 ** (low - high), 2)
+
+def refresh_trending():
+    """
+    Folds the activity recorded since the last refresh into the trending
+    scores and returns how many questions it updated. Only the questions
+    that had activity are read and rewritten.
+    """
+    with transaction.atomic():
+        scores = {}
+        last_id = None
+        for activity_id, question_id, views, bookmarks, created_at in (
+                QuestionActivity.objects.order_by('id').values_list(
+                    'id', 'question_id', 'views', 'bookmarks', 'created_at').iterator()):
+            weight = views * VIEW_WEIGHT + bookmarks * BOOKMARK_WEIGHT
+            if weight:
+                scores[question_id] = log_add(scores.get(question_id),
+                                              log_score(weight, created_at))
+            last_id = activity_id
+        if last_id is None:
+            return 0
+
+        question_ids = list(scores)
+        for offset in range(0, len(question_ids), REFRESH_BATCH_SIZE):
+            batch = question_ids[offset:offset + REFRESH_BATCH_SIZE]
+            previous = TrendingQuestion.objects.filter(question_id__in=batch)
+            for question_id, score in previous.values_list('question_id', 'score'):
+                scores[question_id] = log_add(score, scores[question_id])
+            previous.delete()
+            TrendingQuestion.objects.bulk_create([
+                TrendingQuestion(question_id=question_id, score=scores[question_id])
+                for question_id in batch])
+
+        # Activity recorded while we were refreshing waits for the next run
+        QuestionActivity.objects.filter(id__lte=last_id).delete()
+    return len(scores)
+
+class TrendingQuestions(object):
+    """
+    The questions with any activity, most popular right now first, behaving
+    like a sequence so the paginator reads one page of the score index
+    """
+    def __init__(self, Question, fetch=None):
+        self.fetch = fetch or Question.objects.for_serializer().in_order
+        self._count = None
+
+    def count(self):
+        if self._count is None:
+            self._count = TrendingQuestion.objects.count()
+        return self._count
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return self[index:index + 1][0]
+
+        question_ids = TrendingQuestion.objects.values_list('question_id', flat=True)
+        return self.fetch(list(question_ids[index]))
@@ -8,7 +8,10 @@ from bridges_api import views
 urlpatterns = [
     url(r'^questions/$', views.QuestionList.as_view(), name='question-list'),
     url(r'^questions/(?P<pk>[0-9]+)/$', views.QuestionDetail.as_view()),
+    url(r'^questions/trending/$', views.TrendingQuestionList.as_view(),
+        name='trending-questions'),
     url(r'^users/$', views.UserList.as_view(), name='user-list'),
+    url(r'^users/import/$', views.UserImport.as_view(), name='user-import'),
     url(r'^user-info/$', views.UserDetail.as_view(), name='user-info'),
     url(r'^tags/$', views.TagList.as_view(), name='tag-list'),
     url(r'^employers/$', views.EmployerList.as_view(), name='employer-list'),
@@ -16,7 +19,12 @@ urlpatterns = [
     url(r'^positions/$', views.PositionList.as_view(), name='position-list'),
     url(r'^ethnicities/$', views.EthnicityList.as_view(), name='ethnicity-list'),
     url(r'^genders/$', views.GenderList.as_view(), name='gender-list'),
-    url(r'^bookmarks/', views.BookmarksManager.as_view(), name='bookmarks')
+    url(r'^bookmarks/', views.BookmarksManager.as_view(), name='bookmarks'),
+    url(r'^search-index/$', views.SearchIndexStats.as_view(), name='search-index'),
+    url(r'^view-counts/$', views.ViewCountStats.as_view(), name='view-counts'),
+    url(r'^sql-stats/$', views.SqlStats.as_view(), name='sql-stats'),
+    url(r'^ingestion-jobs/$', views.IngestionJobList.as_view(), name='ingestion-job-list'),
+    url(r'^ingestion-jobs/(?P<pk>[0-9]+)/$', views.IngestionJobDetail.as_view())
 ]
 
 urlpatterns = format_suffix_patterns(urlpatterns)
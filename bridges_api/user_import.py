@@ -0,0 +1,190 @@
+"""
+Creates a whole cohort of users at once, for the import_users management
+command and the /users/import/ endpoint. Every row is validated before
+anything is written, and the users, profiles and tokens are then inserted
+with one bulk_create each instead of a save (and its receivers) per user.
+"""
+import csv
+import json
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import IntegrityError, transaction
+from rest_framework.authtoken.models import Token
+from rest_framework.validators import UniqueValidator
+
+from bridges_api.models import (
+    profile_attribute_rows, ProfileAttribute, Question, UserProfile
+)
+from bridges_api.serializers import UserProfileSerializer, UserSerializer
+from bridges_api import recommendations
+
+# Process pools are for the import_users command; forking a web worker is
+# not safe, so the endpoint hashes on threads
+HASH_PROCESSES = getattr(settings, 'USER_IMPORT_HASH_PROCESSES', None)
+HASH_THREADS = getattr(settings, 'USER_IMPORT_HASH_THREADS', None)
+# Below this many passwords a pool costs more than it saves
+POOL_THRESHOLD = 20
+BULK_BATCH_SIZE = 500
+
+class UserImportError(Exception):
+    """
+    Raised with {row number: errors} when any row is invalid, row 0 standing
+    for the file as a whole
+    """
+    def __init__(self, errors):
+        super(UserImportError, self).__init__('%d invalid rows' % len(errors))
+        self.errors = errors
+
+def read_rows(stream, format):
+    """
+    The rows of a CSV file with a header line, or of a JSON list of objects
+    """
+    try:
+        if format == 'json':
+            rows = json.load(stream)
+            if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+                raise UserImportError({0: ['Expected a list of objects']})
+            return rows
+        if format == 'csv':
+            return [dict((key, value.decode('utf-8') if isinstance(value, bytes) else value)
+                         for key, value in row.items() if value not in (None, ''))
+                    for row in csv.DictReader(stream)]
+    except (ValueError, csv.Error) as error:
+        raise UserImportError({0: [str(error)]})
+    raise UserImportError({0: ['Unknown format %r, expected csv or json' % format]})
+
+def user_serializer(data):
+    """
+    A UserSerializer that leaves username uniqueness to validate_rows, which
+    checks the whole cohort in one query
+    """
+    serializer = UserSerializer(data=data)
+    username = serializer.fields['username']
+    username.validators = [validator for validator in username.validators
+                           if not isinstance(validator, UniqueValidator)]
+    return serializer
+
+def user_ids(usernames):
+    """
+    (username, id) for the users among usernames, looked up a batch at a
+    time to stay under the database's limit on query parameters
+    """
+    for offset in range(0, len(usernames), BULK_BATCH_SIZE):
+        for pair in User.objects.filter(
+                username__in=usernames[offset:offset + BULK_BATCH_SIZE]
+        ).values_list('username', 'id'):
+            yield pair
+
+def validate_rows(rows):
+    """
+    Validates every row like POST /users/ would, returning the validated
+    (user data, profile data) pairs or raising UserImportError
+    """
+    user_fields = UserSerializer().fields.keys()
+    profile_fields = [name for name, field in UserProfileSerializer().fields.items()
+                      if not field.read_only and name != 'profile_picture']
+
+    validated, errors = [], {}
+    for number, row in enumerate(rows, 1):
+        user = user_serializer(dict((key, row[key]) for key in user_fields if key in row))
+        profile = UserProfileSerializer(data=dict((key, row[key]) for key in profile_fields
+                                                  if key in row))
+        row_errors = {}
+        if not user.is_valid():
+            row_errors.update(user.errors)
+        if not profile.is_valid():
+            row_errors.update(profile.errors)
+        if row_errors:
+            errors[number] = row_errors
+        else:
+            validated.append((number, user.validated_data, profile.validated_data))
+
+    numbers = {}
+    for number, user_data, profile_data in validated:
+        numbers.setdefault(user_data['username'], []).append(number)
+    taken = set(username for username, user_id in user_ids(list(numbers)))
+    for username, row_numbers in numbers.items():
+        if username in taken or len(row_numbers) > 1:
+            for number in row_numbers:
+                errors.setdefault(number, {}).setdefault('username', []).append(
+                    'A user with that username already exists.')
+
+    if errors:
+        raise UserImportError(errors)
+    return [(user_data, profile_data) for number, user_data, profile_data in validated]
+
+def hash_passwords(passwords, pool_class=ThreadPool, size=HASH_THREADS):
+    """
+    Hashes the passwords across a pool of size workers, since each hash is
+    deliberately slow. The hashing releases the GIL, so threads spread it
+    across cores too; the import_users command passes multiprocessing.Pool.
+    """
+    if len(passwords) < POOL_THRESHOLD or size == 1:
+        return [make_password(password) for password in passwords]
+    pool = pool_class(size)
+    try:
+        return pool.map(make_password, passwords)
+    finally:
+        pool.close()
+        pool.join()
+
+def username_conflicts(validated):
+    """
+    {row number: errors} for the rows whose username was taken after
+    validate_rows checked it
+    """
+    numbers = dict((user_data['username'], number)
+                   for number, (user_data, _) in enumerate(validated, 1))
+    return dict((numbers[username], {'username': ['A user with that username already exists.']})
+                for username, user_id in user_ids(list(numbers)))
+
+def import_users(rows, pool_class=ThreadPool, pool_size=HASH_THREADS):
+    """
+    Creates a user, profile and token for every row, all or none of them,
+    hashing the passwords on a pool_class of pool_size. Returns
+    [{'username', 'user_id', 'token'}] in the order of rows.
+    """
+    validated = validate_rows(rows)
+    passwords = hash_passwords([user_data.get('password') for user_data, _ in validated],
+                               pool_class, pool_size)
+
+    try:
+        tokens = create_users(validated, passwords)
+    except IntegrityError:
+        # Someone took a username between the validation and the insert
+        conflicts = username_conflicts(validated)
+        if not conflicts:
+            raise
+        raise UserImportError(conflicts)
+
+    return [{'username': user_data['username'], 'user_id': token.user_id, 'token': token.key}
+            for (user_data, _), token in zip(validated, tokens)]
+
+def create_users(validated, passwords):
+    """
+    Inserts the users, profiles, attributes and tokens of validated rows,
+    returning the tokens in the same order
+    """
+    with transaction.atomic():
+        User.objects.bulk_create([
+            User(username=user_data['username'], password=password)
+            for (user_data, _), password in zip(validated, passwords)
+        ], batch_size=BULK_BATCH_SIZE)
+        created_ids = dict(user_ids([user_data['username'] for user_data, _ in validated]))
+
+        profiles = [UserProfile(id=created_ids[user_data['username']],
+                                user_id=created_ids[user_data['username']], **profile_data)
+                    for user_data, profile_data in validated]
+        UserProfile.objects.bulk_create(profiles, batch_size=BULK_BATCH_SIZE)
+        ProfileAttribute.objects.bulk_create(profile_attribute_rows(profiles),
+                                             batch_size=BULK_BATCH_SIZE)
+
+        tokens = [Token(key=Token().generate_key(), user_id=profile.id) for profile in profiles]
+        Token.objects.bulk_create(tokens, batch_size=BULK_BATCH_SIZE)
+
+        recommendations.refresh_recommended_questions(profiles, Question)
+    return tokens
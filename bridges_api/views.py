@@ -1,20 +1,23 @@
+import hashlib
 import operator
 
 from django.contrib.auth.models import User
-from django.db.models import Q
+from django.db.models.query import QuerySet
+from django.utils.http import parse_etags
 
 from rest_framework import generics
-from rest_framework import permissions, authentication
+from rest_framework import permissions
 from rest_framework import status
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 from rest_framework.reverse import reverse
-from rest_framework.parsers import JSONParser
-from rest_framework.renderers import JSONRenderer
+from rest_framework.parsers import JSONParser, MultiPartParser
 from rest_framework.authtoken.models import Token
 from rest_framework.views import APIView
 
-from bridges_api.models import Question, UserProfile, Employer, Tag, Position, Ethnicity, Gender, Disability
+from bridges_api.models import (
+    Question, UserProfile, Employer, Tag, Position, Ethnicity, Gender, Disability, IngestionJob
+)
 from bridges_api.serializers import (
     QuestionSerializer,
     UserSerializer,
@@ -24,12 +27,29 @@ from bridges_api.serializers import (
     PositionSerializer,
     EthnicitySerializer,
     DisabilitySerializer,
-    GenderSerializer
+    GenderSerializer,
+    IngestionJobSerializer,
+    ValuesSerializer
 )
 
-from .permissions import MustBeSuperUserToGET, IsOwnerOrCreateOnly
+from .authentication import ProfileTokenAuthentication
+from .pagination import StandardResultsSetPagination
+from .permissions import MustBeSuperUserToGET, IsOwnerOrCreateOnly, IsSuperUser
+
+from bridges_api import recommendations, search, trending, user_import
+from bridges_api.caching import model_versions
+from bridges_api.counters import view_counter
+from bridges_api.middleware import route_stats
 
-from bridges_api import recommendations
+def request_profile(request):
+    """
+    The profile of the user making the request, which the authentication
+    has usually loaded already, or None when they don't have one
+    """
+    try:
+        return request.user.userprofile
+    except (UserProfile.DoesNotExist, AttributeError):
+        return None
 
 def restrict_fields(query_dict, fields):
     """
@@ -59,7 +79,65 @@ def api_root(request, format=None):
         'tags': reverse('tag-list', request=request, format=format)
     })
 
-class QuestionList(generics.ListAPIView):
+class ValuesListMixin(object):
+    """
+    Renders list responses from values() rows through a ValuesSerializer
+    instead of building and serializing model instances. The JSON is the
+    same serializer_class would produce; writes still go through it.
+    Views whose list is a sequence taking a fetch function rather than a
+    queryset override get_values_queryset, which is given the fetch that
+    turns a page of ids into values() rows.
+    """
+    values_rendering = True
+
+    def get_values_queryset(self, fetch):
+        return self.get_queryset()
+
+    def list(self, request, *args, **kwargs):
+        if not self.values_rendering:
+            return super(ValuesListMixin, self).list(request, *args, **kwargs)
+
+        values_serializer = ValuesSerializer.for_serializer(self.get_serializer_class(), request)
+        object_list = self.filter_queryset(self.get_values_queryset(values_serializer.fetch))
+        if isinstance(object_list, QuerySet):
+            object_list = values_serializer.values(object_list)
+
+        page = self.paginate_queryset(object_list)
+        if page is not None:
+            return self.get_paginated_response(
+                values_serializer.to_representation(page, request))
+        return Response(values_serializer.to_representation(object_list, request))
+
+class VersionedListMixin(object):
+    """
+    Gives list responses an ETag built from the change counters of
+    etag_models, and answers a matching If-None-Match with a 304 after
+    reading nothing but those counters
+    """
+    etag_models = ()
+
+    def get_etag(self, request):
+        versions = ','.join(str(version) for version in
+                            model_versions.get_many(self.etag_models))
+        key = '%s|%s|%s' % (versions, request.get_full_path(),
+                            request.META.get('HTTP_ACCEPT', ''))
+        return '"%s"' % hashlib.md5(key.encode('utf-8')).hexdigest()
+
+    def list(self, request, *args, **kwargs):
+        # The version is read before the rows, so a change made while they
+        # are being read gives the next request a new ETag
+        etag = self.get_etag(request)
+        # GZipMiddleware weakens the ETags of the responses it compresses
+        etags = [tag[2:] if tag.startswith('W/') else tag
+                 for tag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))]
+        if etag in etags or '*' in etags:
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            response = super(VersionedListMixin, self).list(request, *args, **kwargs)
+        response['ETag'] = etag
+        return response
+
+class QuestionList(ValuesListMixin, generics.ListAPIView):
     """
     This uses that generic API list view to return a list
     of Question models as a response to GET requests. The queryset
@@ -67,42 +145,68 @@ class QuestionList(generics.ListAPIView):
     serialized and returned to the User
     """
 
-    queryset = Question.objects.all()
+    queryset = Question.objects.for_serializer()
     serializer_class = QuestionSerializer
     permission_classes = (permissions.IsAuthenticated,)
+    cursor_ordering = '-pk'
 
     def get_queryset(self):
+        return self.get_values_queryset(None)
+
+    def get_values_queryset(self, fetch):
         search_term = self.request.query_params.get('search')
 
         # searching takes precendence over recommending
         if (search_term and self.request.method == 'GET'):
-            queryset = Question.objects.filter(
-                Q(answer__icontains = search_term) |
-                Q(title__icontains = search_term) |
-                Q(description__icontains = search_term)
-            )
-
-            return queryset
+            return search.search_questions(Question, search_term, fetch)
 
         # If we're not searching, send back some recommendations
-        try:
-            profile = UserProfile.objects.get(user=self.request.user)
-        except UserProfile.DoesNotExist:
-            profile = None
+        profile = request_profile(self.request)
 
         if (profile):
-            return recommendations.recommend(profile, Question)
+            return recommendations.RecommendedQuestions(profile, Question, fetch)
         else:
-            return Question.objects.all()
+            return Question.objects.for_serializer()
+
+class TrendingQuestionList(ValuesListMixin, generics.ListAPIView):
+    """
+    The questions most viewed and bookmarked lately, from the scores the
+    refresh_trending command keeps up to date
+    """
+    queryset = Question.objects.for_serializer()
+    serializer_class = QuestionSerializer
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def get_queryset(self):
+        return self.get_values_queryset(None)
+
+    def get_values_queryset(self, fetch):
+        return trending.TrendingQuestions(Question, fetch)
 
 class QuestionDetail(generics.RetrieveUpdateDestroyAPIView):
     """
     Returns the specific Question object with its corresponding id
     """
-    queryset = Question.objects.all()
+    queryset = Question.objects.for_serializer()
     serializer_class = QuestionSerializer
     permission_classes = (permissions.IsAuthenticated,)
 
+    def get_queryset(self):
+        serializer = self.get_serializer()
+        if serializer.restricted_fields is None:
+            return Question.objects.for_serializer()
+        return Question.objects.for_serializer(list(serializer.fields),
+                                               'owner' in serializer.expand)
+
+    def retrieve(self, request, *args, **kwargs):
+        """
+        Counts the view. The count is written behind, so the number_of_views
+        returned may not include the most recent views yet
+        """
+        response = super(QuestionDetail, self).retrieve(request, *args, **kwargs)
+        view_counter.increment(int(kwargs['pk']))
+        return response
+
 class UserList(generics.ListCreateAPIView):
     queryset = UserProfile.objects.all()
     serializer_class = UserProfileSerializer
@@ -144,6 +248,35 @@ class UserList(generics.ListCreateAPIView):
             'errors': user_serializer.errors
         }, status=status.HTTP_400_BAD_REQUEST)
 
+class UserImport(APIView):
+    permission_classes = (IsSuperUser,)
+    parser_classes = (JSONParser, MultiPartParser)
+
+    def post(self, request, format=None):
+        """
+        Creates a user for every row of a CSV or JSON file uploaded as
+        file, or of a posted JSON list, with the same fields as POST /users/.
+        If any row is invalid, creates nobody and lists each row's errors.
+        """
+        try:
+            upload = request.FILES.get('file')
+            if upload is not None:
+                rows = user_import.read_rows(upload, upload.name.rsplit('.', 1)[-1].lower())
+            elif isinstance(request.data, list):
+                rows = request.data
+            else:
+                raise user_import.UserImportError(
+                    {0: ['Upload a CSV or JSON file as file, or post a JSON list']})
+            created = user_import.import_users(rows)
+        except user_import.UserImportError as error:
+            return Response({
+                'errors': error.errors
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response({
+            'created': created
+        }, status=status.HTTP_201_CREATED)
+
 class UserDetail(generics.RetrieveAPIView):
     queryset = UserProfile.objects.all()
     serializer_class = UserProfileSerializer
@@ -154,9 +287,8 @@ class UserDetail(generics.RetrieveAPIView):
         If you have your token, and you are the person hitting /user-info/,
         then you'll receive your own info.
         """
-        try:
-            requested_profile = UserProfile.objects.get(user=request.user)
-        except:
+        requested_profile = request_profile(request)
+        if requested_profile is None:
             return Response({
                 'errors': 'There is no profile corresponding to those credentials'
             }, status=status.HTTP_404_NOT_FOUND)
@@ -166,26 +298,40 @@ class UserDetail(generics.RetrieveAPIView):
         return Response(serialized_profile.data)
 
 class BookmarksManager(APIView):
-    authentication_classes = (authentication.TokenAuthentication,)
+    authentication_classes = (ProfileTokenAuthentication,)
     permission_classes = (permissions.IsAuthenticated,)
+    cursor_ordering = '-pk'
 
     def get(self, request, format=None):
         """
-        Get the bookmarks associated with the user who is querying
+        Get the bookmarks associated with the user who is querying, most
+        recently bookmarked first and paginated like every other list.
+        Pass ids_only=true to get just the question ids.
         """
-        profile = UserProfile.objects.get(user=request.user)
-        serialized_bookmarks = QuestionSerializer(profile.bookmarks.all(), many=True)
-        return Response({
-            'bookmarks': JSONRenderer().render(serialized_bookmarks.data)
-        }, status=status.HTTP_200_OK)
+        bookmarks = UserProfile.bookmarks.through.objects.filter(
+            userprofile=request.user.userprofile
+        ).order_by('-pk').values('pk', 'question_id')
+
+        paginator = StandardResultsSetPagination()
+        page = [row['question_id'] for row in
+                paginator.paginate_queryset(bookmarks, request, view=self)]
+
+        if request.query_params.get('ids_only') in ('true', '1'):
+            return paginator.get_paginated_response(page)
+
+        values_serializer = ValuesSerializer.for_serializer(QuestionSerializer, request)
+        return paginator.get_paginated_response(
+            values_serializer.to_representation(values_serializer.fetch(page), request))
 
     def post(self, request, format=None):
         """
         Set the bookmarks on the user who is querying based on question ids
         If any of the question ids are invalid, raise an error and add none
         """
-        profile = UserProfile.objects.get(user=request.user)
-        bookmark_ids = request.data.get('bookmarks')
+        profile = request.user.userprofile
+        bookmark_ids = None
+        if isinstance(request.data, dict):
+            bookmark_ids = request.data.get('bookmarks')
 
         # If we really post an empty list, clear bookmarks
         if (bookmark_ids == []):
@@ -195,14 +341,17 @@ class BookmarksManager(APIView):
             })
 
         # If we're not posting an empty list
-        # we only clear the bookmarks if the request succeeds
+        # we only change the bookmarks if the request succeeds
         elif (bookmark_ids):
             try:
-                requested_bookmarks = Question.objects.filter(id__in=bookmark_ids)
-                if len(requested_bookmarks) > 0:
-                    profile.bookmarks.clear()
-                    profile.bookmarks.add(*requested_bookmarks)
-                    profile.save()
+                requested_ids = set(Question.objects.filter(
+                    id__in=bookmark_ids).values_list('id', flat=True))
+                if len(requested_ids) > 0:
+                    current_ids = set(profile.bookmarks.values_list('id', flat=True))
+                    if current_ids - requested_ids:
+                        profile.bookmarks.remove(*(current_ids - requested_ids))
+                    if requested_ids - current_ids:
+                        profile.bookmarks.add(*(requested_ids - current_ids))
                     return Response({
                         'response': 'bookmarks set successfully'
                     }, status=status.HTTP_200_OK)
@@ -216,30 +365,131 @@ class BookmarksManager(APIView):
             with desired bookmarks to set'
         }, status=status.HTTP_400_BAD_REQUEST)
 
-class TagList(generics.ListAPIView):
+    def patch(self, request, format=None):
+        """
+        Add the given question ids to the bookmarks of the user who is
+        querying, leaving the others alone
+        If any of the question ids are invalid, raise an error and add none
+        """
+        bookmark_ids = self.requested_ids(request)
+        if bookmark_ids is None:
+            return self.missing_ids_response()
+
+        existing_ids = set(Question.objects.filter(
+            id__in=bookmark_ids).values_list('id', flat=True))
+        if existing_ids != bookmark_ids:
+            return Response({
+                'error': 'One or more of the question ids does not exist',
+                'missing': sorted(bookmark_ids - existing_ids)
+            }, status=status.HTTP_404_NOT_FOUND)
+
+        # add() only inserts the rows that aren't there yet, in one statement
+        request.user.userprofile.bookmarks.add(*bookmark_ids)
+        return Response({
+            'response': 'bookmarks added successfully'
+        }, status=status.HTTP_200_OK)
+
+    def delete(self, request, format=None):
+        """
+        Remove the given question ids from the bookmarks of the user who is
+        querying, leaving the others alone
+        """
+        bookmark_ids = self.requested_ids(request)
+        if bookmark_ids is None:
+            return self.missing_ids_response()
+
+        request.user.userprofile.bookmarks.remove(*bookmark_ids)
+        return Response({
+            'response': 'bookmarks removed successfully'
+        }, status=status.HTTP_200_OK)
+
+    def requested_ids(self, request):
+        if not isinstance(request.data, dict):
+            return None
+        bookmark_ids = request.data.get('bookmarks')
+        if not isinstance(bookmark_ids, list) or not bookmark_ids:
+            return None
+        try:
+            return set(int(bookmark_id) for bookmark_id in bookmark_ids)
+        except (TypeError, ValueError):
+            return None
+
+    def missing_ids_response(self):
+        return Response({
+            'error': 'Must include a non-empty list of question ids in the bookmarks field'
+        }, status=status.HTTP_400_BAD_REQUEST)
+
+class TagList(VersionedListMixin, ValuesListMixin, generics.ListAPIView):
     queryset = Tag.objects.all()
     serializer_class = TagSerializer
+    etag_models = (Tag,)
 
-class PositionList(generics.ListAPIView):
+class PositionList(VersionedListMixin, ValuesListMixin, generics.ListAPIView):
     queryset = Position.objects.all()
     serializer_class = PositionSerializer
+    etag_models = (Position,)
 
-class EthnicityList(generics.ListAPIView):
+class EthnicityList(VersionedListMixin, ValuesListMixin, generics.ListAPIView):
     queryset = Ethnicity.objects.all()
     serializer_class = EthnicitySerializer
+    etag_models = (Ethnicity,)
 
-class GenderList(generics.ListAPIView):
+class GenderList(VersionedListMixin, ValuesListMixin, generics.ListAPIView):
     queryset = Gender.objects.all()
     serializer_class = GenderSerializer
+    etag_models = (Gender,)
 
-class EmployerList(generics.ListAPIView):
-    queryset = Employer.objects.all()
+class EmployerList(VersionedListMixin, ValuesListMixin, generics.ListAPIView):
+    queryset = Employer.objects.prefetch_related('questions')
     serializer_class = EmployerSerializer
+    etag_models = (Employer,)
 
-class DisabilityList(generics.ListAPIView):
+class DisabilityList(VersionedListMixin, ValuesListMixin, generics.ListAPIView):
     queryset = Disability.objects.all()
     serializer_class = DisabilitySerializer
+    etag_models = (Disability,)
 
 class EmployerDetail(generics.RetrieveAPIView):
-    queryset = Employer.objects.all()
+    queryset = Employer.objects.prefetch_related('questions')
     serializer_class = EmployerSerializer
+
+class SearchIndexStats(APIView):
+    permission_classes = (IsSuperUser,)
+
+    def get(self, request, format=None):
+        """
+        Size and build time of this process's trigram search index
+        """
+        return Response(search.trigram_index.stats())
+
+class ViewCountStats(APIView):
+    permission_classes = (IsSuperUser,)
+
+    def get(self, request, format=None):
+        """
+        Views this process has counted but not written yet, and how long
+        writing them has taken
+        """
+        return Response(view_counter.stats())
+
+class SqlStats(APIView):
+    permission_classes = (IsSuperUser,)
+
+    def get(self, request, format=None):
+        """
+        Requests, queries and SQL time per route, as seen by this process
+        """
+        return Response(route_stats.stats())
+
+class IngestionJobList(generics.ListAPIView):
+    """
+    The data file ingestion jobs, newest first, with their progress
+    """
+    permission_classes = (IsSuperUser,)
+    queryset = IngestionJob.objects.select_related('data_file')
+    serializer_class = IngestionJobSerializer
+
+class IngestionJobDetail(generics.RetrieveAPIView):
+    permission_classes = (IsSuperUser,)
+    queryset = IngestionJob.objects.select_related('data_file')
+    serializer_class = IngestionJobSerializer
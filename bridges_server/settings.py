@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/1.10/ref/settings/
 """
 
 import os
+import sys
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -53,11 +54,13 @@ REST_FRAMEWORK = {
     'DEFAULT_PAGINATION_CLASS': 'bridges_api.pagination.StandardResultsSetPagination',
     'TEST_REQUEST_DEFAULT_FORMAT': 'json',
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework.authentication.TokenAuthentication',
+        'bridges_api.authentication.ProfileTokenAuthentication',
     ),
 }
 
 MIDDLEWARE = [
+    'django.middleware.gzip.GZipMiddleware',
+    'bridges_api.middleware.QueryInstrumentationMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -69,6 +72,33 @@ MIDDLEWARE = [
 
 ROOT_URLCONF = 'bridges_server.urls'
 
+# Requests slower than SLOW_REQUEST_MS are logged to bridges_api.sql with
+# their slowest statements. SQL_INSTRUMENTATION_HEADERS adds X-SQL-Queries
+# and X-SQL-Time-Ms to every response.
+SLOW_REQUEST_MS = 500
+SQL_INSTRUMENTATION_HEADERS = False
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'bridges_api': {
+            'handlers': ['console'],
+            'level': 'WARNING',
+        },
+    },
+}
+
+# Keep slow request reports out of the test run's output; tests that check
+# them attach a handler of their own
+if sys.argv[1:2] == ['test']:
+    LOGGING['loggers']['bridges_api.sql'] = {'handlers': [], 'propagate': False}
+
 TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
@@ -109,6 +139,9 @@ else:
         'default': {
             'ENGINE': 'django.db.backends.sqlite3',
             'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+            # A file rather than in memory, so the ingestion worker
+            # processes the tests fork can see it
+            'TEST': {'NAME': os.path.join(BASE_DIR, 'test_db.sqlite3')},
         }
     }
 
@@ -14,3 +14,12 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "bridges_server.settings")
 
 application = get_wsgi_application()
+
+# Build the in-memory trigram search index before the first search needs it
+from bridges_api.models import Question
+from bridges_api.search import trigram_index
+trigram_index.build(Question)
+
+# Write question views out even when no request comes in to trigger a flush
+from bridges_api.counters import view_counter
+view_counter.start()